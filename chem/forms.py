@@ -1,4 +1,3 @@
-import re
 import json
 
 from django import forms
@@ -9,9 +8,13 @@ from crispy_forms.layout import Layout, Div, HTML
 
 from data.models import JobTemplate
 from cluster.models import Credential
-from utils import run_standard_jobs, convert_logs, parse_file_list, find_sets
+from utils import run_standard_jobs, run_queued_jobs, dump_job_settings, \
+    convert_logs, parse_file_list, find_sets
 from models import ErrorReport
 from chemtools.constants import KEYWORDS
+from chemtools.percent import PERCENT_WINDOW
+from chemtools.interface import get_job_data
+from tasks.utils import enqueue, get_queued_response, get_task_user
 
 
 class MultiFileInput(forms.FileInput):
@@ -83,6 +86,11 @@ class UploadForm(forms.Form):
         ("structureview", "Structure View"),
         ("gjfreset", "Gjf Reset"),
         ("percent", "Percent"),
+        ("percenttable", "Percent Table"),
+    )
+    TABLE_FORMATS = (
+        ("csv", "CSV"),
+        ("json", "JSON"),
     )
     files = MultiFileField()
     options = forms.ChoiceField(widget=forms.RadioSelect, choices=CHOICES)
@@ -90,6 +98,11 @@ class UploadForm(forms.Form):
     gjf_submit = forms.BooleanField(required=False,  label="GJF Submit")
     store = forms.BooleanField(required=False,  label="Store Log File")
     split_iter = forms.BooleanField(required=False,  label="Split Log Iterations")
+    orbital_window = forms.IntegerField(required=False, min_value=0,
+                                        initial=PERCENT_WINDOW,
+                                        label="Orbitals Around HOMO/LUMO")
+    table_format = forms.ChoiceField(required=False, choices=TABLE_FORMATS,
+                                     initial="csv")
 
     helper = FormHelper()
     helper.form_tag = False
@@ -101,10 +114,16 @@ class UploadForm(forms.Form):
         'gjf_submit',
         'store',
         'split_iter',
+        'orbital_window',
+        'table_format',
     )
 
     def clean(self):
         files = parse_file_list(self.cleaned_data.get("files"))
+        if self.cleaned_data.get("orbital_window") is None:
+            self.cleaned_data["orbital_window"] = PERCENT_WINDOW
+        if not self.cleaned_data.get("table_format"):
+            self.cleaned_data["table_format"] = "csv"
         if self.cleaned_data.get("options") == "longchain":
             logsets, files = find_sets(files)
             files.extend(convert_logs(logsets))
@@ -263,9 +282,7 @@ class JobForm(forms.Form):
         return super(JobForm, self).is_valid()
 
     def get_single_data(self, name):
-        d = dict(self.cleaned_data)
-        d["name"] = re.sub(r"{{\s*name\s*}}", name, d["name"])
-        return d
+        return get_job_data(self.cleaned_data, name)
 
     def clean(self):
         if not (self.cleaned_data.get("base_template") or
@@ -288,6 +305,13 @@ class JobForm(forms.Form):
             return response
         elif request.method == "POST":
             cred = job_settings.pop("credential")
+            if request.REQUEST.get("background"):
+                args = (cred.id, string, mol_settings,
+                        dump_job_settings(job_settings))
+                task = enqueue(run_queued_jobs, args=args,
+                               user=get_task_user(request))
+                return get_queued_response(task)
+
             do_html = request.REQUEST.get("html", False)
             results = run_standard_jobs(
                 cred, string, mol_settings, job_settings)
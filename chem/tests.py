@@ -1,20 +1,27 @@
 import os
 import csv
+import shutil
+import tempfile
 import zipfile
 import itertools
 import urllib
 import json
 
 from django.test import Client, TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
 import mock
 
-from project.utils import StringIO, SSHClient, SFTPClient
+from project.utils import StringIO, SSHClient, SFTPClient, stream_zip
 from data.models import DataPoint
 from cluster.models import Cluster, Credential
+from cluster.utils import CONNECTION_POOL
+from tasks.models import Task
+from tasks.utils import run_tasks
 from chemtools.constants import KEYWORDS
+from chemtools import fileparser
 import views
 import utils
 
@@ -109,6 +116,14 @@ SUBMIT_ERROR = "You must be a staff user to submit a job."
 CRED_ERROR = "Invalid credential"
 
 
+def get_content(response):
+    '''Returns the body of a normal or a streaming response.'''
+    if response.streaming:
+        return ''.join(response.streaming_content)
+    return response.content
+
+
+@override_settings(IMAGE_CACHE_PATH=':memory:')
 class MainPageTestCase(TestCase):
 
     def setUp(self):
@@ -189,10 +204,29 @@ class MainPageTestCase(TestCase):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(string, )))
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(get_content(response)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), gjf_names)
 
+    def test_multi_molecule_zip_background(self):
+        string = ','.join(NAMES)
+        url = reverse(views.multi_molecule_zip, args=(string, ))
+        response = self.client.get(url + "?background=true")
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.content)["token"]
+
+        media_root = tempfile.mkdtemp()
+        try:
+            with self.settings(MEDIA_ROOT=media_root):
+                self.assertEqual(run_tasks(), 1)
+                task = Task.objects.get(token=token)
+                self.assertEqual(task.status, Task.DONE)
+                with zipfile.ZipFile(task.output.path, "r") as zfile:
+                    self.assertEqual(set(zfile.namelist()),
+                                     set(x + ".gjf" for x in NAMES))
+        finally:
+            shutil.rmtree(media_root)
+
     def test_multi_molecule_zip_invalid(self):
         names, errors = zip(*BAD_NAMES)
         string = ','.join(names)
@@ -200,7 +234,7 @@ class MainPageTestCase(TestCase):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(string, )))
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(get_content(response)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), filenames)
                 for name in zfile.namelist():
@@ -220,7 +254,7 @@ class MainPageTestCase(TestCase):
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
 
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     for gjf_name in zfile.namelist():
                         with zfile.open(gjf_name) as f1:
@@ -237,7 +271,7 @@ class MainPageTestCase(TestCase):
         params = "?new=true"
         response = self.client.get(url + params)
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(get_content(response)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), gjf_names)
 
@@ -262,7 +296,7 @@ class MainPageTestCase(TestCase):
 
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     self.assertEqual(set(zfile.namelist()), comparenames)
 
@@ -289,7 +323,7 @@ class MainPageTestCase(TestCase):
 
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     self.assertEqual(set(zfile.namelist()), comparenames)
 
@@ -302,7 +336,7 @@ class MainPageTestCase(TestCase):
         response = self.client.get(url + encoded_options)
 
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(get_content(response)) as f:
             with zipfile.ZipFile(f, "r") as zf:
                 self.assertEqual(set(zf.namelist()), jobnames)
                 for name in [x for x in zf.namelist() if not x.endswith("/")]:
@@ -367,6 +401,22 @@ class MainPageTestCase(TestCase):
                                                args=(name, )))
             self.assertEqual(response.status_code, 200)
 
+    @mock.patch("chemtools.structure.Structure.draw")
+    def test_write_png_etag(self, draw):
+        draw.return_value = StringIO("image")
+        url = reverse(views.write_png, args=("24a_TON", ))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, "image")
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url + "?scale=20",
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
     def test_write_job(self):
         options = OPTIONS.copy()
         del options["job"]
@@ -416,7 +466,7 @@ class MainPageTestCase(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
-        with StringIO(response.content) as f:
+        with StringIO(get_content(response)) as f:
             with zipfile.ZipFile(f, "r") as zf:
                 for name in [x for x in zf.namelist() if not x.endswith("/")]:
                     with zf.open(name) as f2:
@@ -446,6 +496,25 @@ class MainPageTestCase(TestCase):
         value = json.loads(response.content)["error"]
         self.assertEqual(value, "The operation has timed out.")
 
+    def test_molecule_predictions(self):
+        string = ','.join(NAMES)
+        response = self.client.get(reverse(views.molecule_predictions,
+                                           args=(string, )))
+        self.assertEqual(response.status_code, 200)
+        values = json.loads(response.content)
+        self.assertIsNone(values["error"])
+        names = [x["molecule"] for x in values["molecules"]]
+        self.assertEqual(names, NAMES)
+        for value in values["molecules"]:
+            self.assertEqual(set(value["property_limits"]), set("nm"))
+
+    def test_molecule_predictions_timeout(self):
+        response = self.client.get(reverse(views.molecule_predictions,
+                                           args=(TIMEOUT_NAMES, )))
+        self.assertEqual(response.status_code, 200)
+        value = json.loads(response.content)["error"]
+        self.assertEqual(value, "The operation has timed out.")
+
     def test_multi_molecule_zip_timeout(self):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(TIMEOUT_NAMES, )))
@@ -533,6 +602,7 @@ class MainPageTestCase(TestCase):
             self.assertIn("Enter a valid email address", response.content)
 
 
+@override_settings(LOG_CACHE_PATH=':memory:')
 class PostsFailTestCase(TestCase):
 
     def setUp(self):
@@ -789,6 +859,8 @@ def build_mock_connections(obj):
     obj.addCleanup(patcher_ssh.stop)
     patcher_sftp = mock.patch('cluster.models.get_sftp_connection')
     obj.addCleanup(patcher_sftp.stop)
+    # The pool would otherwise hand out the mocks of an earlier test
+    obj.addCleanup(CONNECTION_POOL.clear)
 
     mock_ssh = mock.MagicMock(SSHClient, name='SSH', autospec=True)
     mock_ssh.exec_command.side_effect = mock_exec_command
@@ -799,6 +871,7 @@ def build_mock_connections(obj):
     mock_sftp_conn.return_value = mock_sftp
     return mock_ssh, mock_sftp
 
+@override_settings(LOG_CACHE_PATH=':memory:')
 class PostsTestCase(TestCase):
 
     def setUp(self):
@@ -849,6 +922,26 @@ class PostsTestCase(TestCase):
         self.assertEqual(len(results["worked"]), len(NAMES))
         self.assertEqual(len(results["failed"]), 0)
 
+    def test_post_multi_background(self):
+        r = self.client.login(**SUPER_USER_LOGIN)
+        self.assertTrue(r)
+
+        name = ','.join(NAMES)
+        options = SUB_OPTIONS.copy()
+        options["name"] = "{{ name }}"
+        options["background"] = "true"
+        url = reverse(views.multi_molecule, args=(name, ))
+        response = self.client.post(url, options)
+        token = json.loads(response.content)["token"]
+
+        task = Task.objects.get(token=token)
+        self.assertNotIn(CREDENTIAL["password"], str(task.arguments))
+        self.assertEqual(run_tasks(), 1)
+        response = self.client.get(reverse("task_status", args=(token, )))
+        results = json.loads(response.content)["result"]
+        self.assertIsNone(results["error"])
+        self.assertEqual(len(results["worked"]), len(NAMES))
+
     def test_post_multi_html(self):
         r = self.client.login(**SUPER_USER_LOGIN)
         self.assertTrue(r)
@@ -1045,6 +1138,27 @@ class UtilsTestCase(TestCase):
         }
         self.assertEqual(results, expected)
 
+    def test_stream_zip(self):
+        entries = [("a.txt", "a" * 1000), ("b/c.txt", ''), ("d.gjf", "d")]
+        for level in (0, 1, 9):
+            chunks = list(stream_zip(entries, level=level))
+            self.assertEqual(len(chunks), len(entries) + 1)
+            with StringIO(''.join(chunks)) as f:
+                with zipfile.ZipFile(f, "r") as zfile:
+                    self.assertIsNone(zfile.testzip())
+                    results = [(x, zfile.read(x)) for x in zfile.namelist()]
+            self.assertEqual(results, entries)
+
+    def test_stream_zip_unicode(self):
+        entries = [("a.job", u"x\u00e9"), ("b.job", u"y")]
+        for level in (0, 6):
+            with StringIO(''.join(stream_zip(entries, level=level))) as f:
+                with zipfile.ZipFile(f, "r") as zfile:
+                    self.assertIsNone(zfile.testzip())
+                    self.assertEqual(zfile.read("a.job").decode("utf-8"),
+                                     u"x\u00e9")
+                    self.assertEqual(zfile.read("b.job"), "y")
+
     def test_StringIO_size(self):
         string = "some test string"
         s = StringIO(string)
@@ -1100,6 +1214,7 @@ class UtilsServerTestCase(TestCase):
             self.assertEqual(error, "Bad Substituent Name(s): ['N']")
 
 
+@override_settings(LOG_CACHE_PATH=':memory:')
 class UploadsTestCase(TestCase):
 
     def setUp(self):
@@ -1111,6 +1226,23 @@ class UploadsTestCase(TestCase):
         response = self.client.get(reverse(views.upload_data))
         self.assertEqual(response.status_code, 200)
 
+    def test_log_parse_background(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            data = {"files": f, "options": "logparse"}
+            response = self.client.post(reverse(views.upload_data), data)
+            expected = response.content
+        with open(path, 'r') as f:
+            data = {"files": f, "options": "logparse", "background": "true"}
+            response = self.client.post(reverse(views.upload_data), data)
+        token = json.loads(response.content)["token"]
+
+        self.assertEqual(run_tasks(), 1)
+        response = self.client.get(reverse("task_status", args=(token, )))
+        value = json.loads(response.content)
+        self.assertEqual(value["status"], "Done")
+        self.assertEqual(value["result"], expected)
+
     def test_log_parse(self):
         test_path = os.path.join(settings.MEDIA_ROOT, "tests")
         with open(os.path.join(test_path, "A_TON_A_A.log"), 'r') as f:
@@ -1178,6 +1310,29 @@ class UploadsTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(len(response.content.split('\n')), 6)
 
+    def test_log_parse_cache(self):
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        try:
+            cache_path = os.path.join(tempdir, "logcache")
+            with self.settings(LOG_CACHE_PATH=cache_path):
+                results = []
+                for i in xrange(2):
+                    with open(path, 'r') as f:
+                        data = {
+                            "files": f,
+                            "options": "logparse",
+                        }
+                        response = self.client.post(
+                            reverse(views.upload_data), data)
+                        self.assertEqual(response.status_code, 200)
+                        results.append(response.content)
+            self.assertEqual(results[0], results[1])
+            with fileparser.LogCache(cache_path) as cache:
+                self.assertEqual(len(cache), 1)
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_log_store(self):
         r = self.client.login(**SUPER_USER_LOGIN)
         self.assertTrue(r)
@@ -1202,7 +1357,7 @@ class UploadsTestCase(TestCase):
             }
             response = self.client.post(reverse(views.upload_data), data)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     with zfile.open("A_TON_A_A.gjf") as f2:
                         self.assertEqual(f2.read().lower(), gjf.read().lower())
@@ -1219,7 +1374,7 @@ class UploadsTestCase(TestCase):
             }
             response = self.client.post(reverse(views.upload_data), data)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     with zfile.open("A_TON_A_A_TD.gjf") as f2:
                         self.assertEqual(f2.read().lower(), gjf.read().lower())
@@ -1233,7 +1388,7 @@ class UploadsTestCase(TestCase):
             }
             response = self.client.post(reverse(views.upload_data), data)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     with zfile.open("errors.txt") as f2:
                         msg = "A_TON_A_A.gjf - The log file was invalid"
@@ -1249,11 +1404,28 @@ class UploadsTestCase(TestCase):
             }
             response = self.client.post(reverse(views.upload_data), data)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f, open(outputtxt, 'r') as out:
+            with StringIO(get_content(response)) as f, open(outputtxt, 'r') as out:
                 with zipfile.ZipFile(f, "r") as zfile:
                     with zfile.open("output.txt") as f2:
                         self.assertEqual(f2.read(), out.read())
 
+    @mock.patch("chemtools.dataparser.DataParser.get_graphs",
+                side_effect=ValueError("bad graph"))
+    def test_data_parse_error(self, mock_graphs):
+        datatxt = os.path.join(settings.MEDIA_ROOT, "tests", "data.txt")
+        with open(datatxt, 'r') as txt:
+            data = {
+                "files": txt,
+                "options": "longchain",
+            }
+            response = self.client.post(reverse(views.upload_data), data)
+            self.assertEqual(response.status_code, 200)
+            with StringIO(get_content(response)) as f:
+                with zipfile.ZipFile(f, "r") as zfile:
+                    self.assertEqual(zfile.namelist(), ["errors.txt"])
+                    self.assertEqual(zfile.read("errors.txt"),
+                                     "data.txt - bad graph")
+
     def test_data_parse_set(self):
         for filename in ["CON.tar.gz", "TON.tar.bz2"]:
             filepath = os.path.join(settings.MEDIA_ROOT, "tests", filename)
@@ -1264,7 +1436,7 @@ class UploadsTestCase(TestCase):
                 }
                 response = self.client.post(reverse(views.upload_data), data)
                 self.assertEqual(response.status_code, 200)
-                with StringIO(response.content) as f:
+                with StringIO(get_content(response)) as f:
                     with zipfile.ZipFile(f, "r") as zfile2:
                         with zfile2.open("output.txt") as f2:
                             self.assertIn("Errors (0)", f2.read())
@@ -1290,7 +1462,7 @@ class UploadsTestCase(TestCase):
             }
             response = self.client.post(reverse(views.upload_data), data)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(get_content(response)) as f:
                 with zipfile.ZipFile(f, "r") as zfile2:
                     for folder in ["CON__TD/", "TON__TD/"]:
                         with zfile2.open(folder + "output.txt") as f2:
@@ -1361,3 +1533,42 @@ class UploadsTestCase(TestCase):
             self.assertIn("0.32", response.content)
             self.assertIn("65.75%", response.content)
 
+    def test_get_percent_table(self):
+        values = [(-1.0, 2.0, 1.5, 75.0, 0.5, 25.0),
+                  (-0.5, 1.0, 0.25, 25.0, 0.75, 75.0),
+                  (0.5, 4.0, 1.0, 25.0, 3.0, 75.0)]
+        name = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with mock.patch('chemtools.percent.compute_orbital_percents',
+                        return_value=(1, values)):
+            with open(name, 'r') as log:
+                data = {
+                    "files": log,
+                    "options": "percenttable",
+                    "orbital_window": 1,
+                }
+                response = self.client.post(reverse(views.upload_data), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        with StringIO(response.content) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0][:3], ["Name", "Orbital", "Number"])
+        self.assertEqual([x[1] for x in rows[1:]],
+                         ["HOMO-1", "HOMO", "LUMO"])
+        self.assertEqual(rows[2], ["A_TON_A_A.log", "HOMO", "2", "-0.5",
+                                   "1.0", "0.25", "25.0", "0.75", "75.0"])
+
+    def test_get_percent_table_json(self):
+        name = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(name, 'r') as log:
+            data = {
+                "files": log,
+                "options": "percenttable",
+                "table_format": "json",
+            }
+            response = self.client.post(reverse(views.upload_data), data)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)
+        self.assertEqual(results["rows"], [])
+        self.assertEqual(len(results["errors"]), 1)
+        self.assertIn("A_TON_A_A.log", results["errors"][0])
+
@@ -33,4 +33,7 @@ urlpatterns = patterns('chem.views',
 
                        url(r"^(?P<string>[%s]*)/check/$" %
                            multimolname, "molecule_check", name="mol_check"),
+                       url(r"^(?P<string>[%s]*)/predictions/$" %
+                           multimolname, "molecule_predictions",
+                           name="mol_predictions"),
                        )
@@ -1,24 +1,34 @@
 import time
 import zipfile
 import tarfile
+import tempfile
 import re
 import collections
 import logging
 
+from django.conf import settings
+from django.core.files import File
 from django.shortcuts import redirect
 
 from models import ErrorReport
 
 from chemtools import gjfwriter
 from chemtools import fileparser
-from chemtools.mol_name import name_expansion, get_exact_name
-from data.models import DataPoint
+from chemtools.interface import get_multi_molecule
+from chemtools.mol_name import name_expansion, name_expansion_count
+from data.models import DataPoint, JobTemplate
+from data import load_data
+from cluster.models import Credential
 from cluster.interface import run_jobs
-from project.utils import StringIO
+from project.utils import StringIO, stream_zip
 
 
 logger = logging.getLogger(__name__)
 
+# Expansions with more names than this can not be checked within the time
+# limit, so they are rejected before any of them are generated.
+MAX_MOLECULE_NAMES = 10000
+
 
 def get_molecule_status(name, autoflip=False):
     mol = gjfwriter.NamedMolecule(name, autoflip=autoflip)
@@ -47,6 +57,10 @@ def get_molecule_info_status(name):
 def get_multi_molecule_status(string, autoflip=False):
     unique_molecules = collections.OrderedDict()
 
+    if name_expansion_count(string) > MAX_MOLECULE_NAMES:
+        logger.warn("%s -- The operation timed out" % (string))
+        raise ValueError("The operation has timed out.")
+
     start = time.time()
     for name in name_expansion(string):
         if time.time() - start > 1:
@@ -63,6 +77,84 @@ def get_multi_molecule_status(string, autoflip=False):
     return zip(*unique_molecules.values())
 
 
+def get_multi_molecule_predictions(string, autoflip=False):
+    if name_expansion_count(string) > MAX_MOLECULE_NAMES:
+        logger.warn("%s -- The operation timed out" % (string))
+        raise ValueError("The operation has timed out.")
+
+    molecules = [gjfwriter.NamedMolecule(name, autoflip=autoflip)
+                 for name in name_expansion(string)]
+    results = []
+    for mol, (predictions, limits) in zip(molecules,
+                                          gjfwriter.predict_molecules(molecules)):
+        results.append({
+            "molecule": mol.name,
+            "exact_name": mol.get_exact_name(),
+            "property_predictions": predictions,
+            "property_limits": limits,
+        })
+    return results
+
+
+def dump_job_settings(job_settings):
+    '''Returns a copy of the job settings that can be queued. The base
+    template is replaced by its id, since model instances are not stored with
+    tasks.'''
+    d = dict(job_settings)
+    if d.get("base_template") is not None:
+        d["base_template"] = d["base_template"].id
+    return d
+
+
+def load_job_settings(job_settings):
+    '''Undoes dump_job_settings in the task worker.'''
+    d = dict(job_settings)
+    if d.get("base_template") is not None:
+        d["base_template"] = JobTemplate.objects.get(id=d["base_template"])
+    return d
+
+
+def get_multi_molecule_zip(molecules, options, mol_settings,
+                           job_settings=None):
+    '''Returns a File with the zip of the files of the molecules. This is
+    how a queued zip is made, so the task worker builds the molecules in the
+    worker pool. job_settings are from dump_job_settings.'''
+    if job_settings is not None:
+        job_settings = load_job_settings(job_settings)
+    f = tempfile.TemporaryFile()
+    with gjfwriter.ImageCache(settings.IMAGE_CACHE_PATH) as cache:
+        entries = get_multi_molecule(molecules, options, mol_settings,
+                                     job_settings, cache=cache, pool=True)
+        for chunk in stream_zip(entries, level=settings.ZIP_COMPRESSION_LEVEL):
+            f.write(chunk)
+    f.seek(0)
+    return File(f, name="molecules.zip")
+
+
+def parse_logs(files, split_iter=False, store=False):
+    '''Returns the parsed values of the log files, adding them to the
+    database first if store is set.'''
+    with fileparser.LogCache(settings.LOG_CACHE_PATH) as cache:
+        parser = fileparser.LogSet(split_iter=split_iter, cache=cache)
+        for f in files:
+            parser.parse_file(f)
+
+    output = parser.format_output()
+    if store:
+        number_added = load_data.main(StringIO(output))
+        string = "%d datapoint(s) added to database." % number_added
+        logger.info(string)
+        output += "\n\n\n" + string
+    return output
+
+
+def parse_log_contents(contents, split_iter=False, store=False):
+    '''Returns parse_logs of the (name, data) pairs of the log files. This
+    is how queued logs are passed, because uploaded files can not be.'''
+    files = [StringIO(data, name=name) for name, data in contents]
+    return parse_logs(files, split_iter=split_iter, store=store)
+
+
 def run_standard_jobs(credential, string, mol_settings, job_settings):
     results = {
         "worked": [],
@@ -105,6 +197,15 @@ def run_standard_jobs(credential, string, mol_settings, job_settings):
     return results
 
 
+def run_queued_jobs(credential_id, string, mol_settings, job_settings):
+    '''run_standard_jobs for a queued submission. The credential is loaded
+    again from its id so that its decrypted password is never stored with the
+    task. job_settings are from dump_job_settings.'''
+    credential = Credential.objects.get(id=credential_id)
+    return run_standard_jobs(credential, string, mol_settings,
+                             load_job_settings(job_settings))
+
+
 def parse_file_list(files):
     for f in files:
         if f.name.endswith(".zip"):
@@ -1,12 +1,15 @@
 import os
-import zipfile
+import csv
 import logging
 import json
 
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.template import RequestContext
 from django.template.loader import render_to_string
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+    HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
 from django.core.urlresolvers import reverse
 from django.core.servers.basehttp import FileWrapper
 from django.core.serializers.json import DjangoJSONEncoder
@@ -15,21 +18,33 @@ from crispy_forms.utils import render_crispy_form
 from models import ErrorReport
 from forms import ErrorReportForm, JobForm, UploadForm, MoleculeForm
 from utils import get_multi_molecule_status, get_molecule_info_status, \
-                autoflip_check, get_molecule_status
+                autoflip_check, get_molecule_status, \
+                get_multi_molecule_predictions, get_multi_molecule_zip, \
+                parse_logs, parse_log_contents, dump_job_settings
 
 from chemtools import gjfwriter
 from chemtools import fileparser, dataparser
 from chemtools.mol_name import name_expansion
 from chemtools.interface import get_multi_molecule, get_multi_job
-from chemtools.percent import compute_axes_percents
+from chemtools.percent import compute_axes_percents, get_percent_table, \
+    PERCENT_VERSION, PERCENT_HEADER
 import cluster.interface
-from project.utils import StringIO
-from data import load_data
+from project.utils import StringIO, stream_zip
+from tasks.utils import enqueue, get_queued_response, get_task_user
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_zip_response(entries, name):
+    '''Returns a response that streams a zip of the (filename, data)
+    entries, compressing each one as it is made.'''
+    chunks = stream_zip(entries, level=settings.ZIP_COMPRESSION_LEVEL)
+    response = StreamingHttpResponse(chunks, content_type="application/zip")
+    response["Content-Disposition"] = "attachment; filename=%s.zip" % name
+    return response
+
+
 def index(request):
     molecules = [x for x in request.REQUEST.getlist("molecules[]") if x]
     if molecules:
@@ -86,10 +101,7 @@ def multi_job(request):
                                 content_type="application/json")
 
     string = request.REQUEST.get('filenames', '').replace('\r\n', ',').replace('\n', ',')
-    ret_zip = get_multi_job(string, form)
-    response = HttpResponse(ret_zip, content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=output.zip"
-    return response
+    return get_zip_response(get_multi_job(string, form), "output")
 
 
 def molecule_check(request, string):
@@ -115,6 +127,22 @@ def molecule_check(request, string):
         return HttpResponse(json.dumps(a), content_type="application/json")
 
 
+def molecule_predictions(request, string):
+    a = {
+        "error": None,
+    }
+    try:
+        autoflip = request.REQUEST.get("autoflip")
+        a["molecules"] = get_multi_molecule_predictions(string,
+                                                        autoflip=autoflip)
+    except ValueError as e:
+        logger.warn(str(e))
+        a["error"] = str(e)
+        a["molecules"] = None
+    return HttpResponse(json.dumps(a, cls=DjangoJSONEncoder),
+                        content_type="application/json")
+
+
 @autoflip_check
 def molecule_detail(request, molecule):
     job_form = JobForm.get_form(request, molecule)
@@ -224,11 +252,24 @@ def multi_molecule_zip(request, string):
     options = [x for x in selection if request.REQUEST.get(x)]
     if request.REQUEST.get("new", ''):
         molecules = [x for i, x in enumerate(molecules) if news[i]]
-    ret_zip = get_multi_molecule(molecules, options, mol_form, job_form)
+    mol_settings = dict(mol_form.cleaned_data)
+    job_settings = dict(job_form.cleaned_data) if job_form else None
 
-    response = HttpResponse(ret_zip, content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=molecules.zip"
-    return response
+    if request.REQUEST.get("background"):
+        if job_settings is not None:
+            job_settings = dump_job_settings(job_settings)
+        args = (list(molecules), options, mol_settings, job_settings)
+        task = enqueue(get_multi_molecule_zip, args=args,
+                       user=get_task_user(request))
+        return get_queued_response(task)
+
+    def get_entries():
+        with gjfwriter.ImageCache(settings.IMAGE_CACHE_PATH) as cache:
+            for entry in get_multi_molecule(molecules, options, mol_settings,
+                                            job_settings, cache=cache):
+                yield entry
+
+    return get_zip_response(get_entries(), "molecules")
 
 
 @autoflip_check
@@ -257,29 +298,38 @@ def write_mol2(request, molecule):
     return response
 
 
-@autoflip_check
-def write_png(request, molecule):
+def get_image_response(request, molecule, svg=False):
     mol_form = MoleculeForm(request.REQUEST)
     mol_form.is_valid()
     mol_settings = dict(mol_form.cleaned_data)
 
     out = gjfwriter.NamedMolecule(molecule, **mol_settings)
-    response = HttpResponse(out.get_png(), content_type="image/png")
-    response['Content-Disposition'] = 'filename=%s.png' % molecule
+    key = out.get_image_key(svg=svg)
+    if key is not None:
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ''))
+        if key in etags:
+            return HttpResponseNotModified()
+
+    with gjfwriter.ImageCache(settings.IMAGE_CACHE_PATH) as cache:
+        data = out.get_image(svg=svg, cache=cache)
+
+    ext = "svg" if svg else "png"
+    content_type = "image/svg+xml" if svg else "image/png"
+    response = HttpResponse(data, content_type=content_type)
+    response['Content-Disposition'] = 'filename=%s.%s' % (molecule, ext)
+    if key is not None:
+        response['ETag'] = quote_etag(key)
     return response
 
 
 @autoflip_check
-def write_svg(request, molecule):
-    mol_form = MoleculeForm(request.REQUEST)
-    mol_form.is_valid()
-    mol_settings = dict(mol_form.cleaned_data)
+def write_png(request, molecule):
+    return get_image_response(request, molecule)
 
-    out = gjfwriter.NamedMolecule(molecule, **mol_settings)
-    response = HttpResponse(
-        out.get_svg(), content_type="image/svg+xml")
-    response['Content-Disposition'] = 'filename=%s.svg' % molecule
-    return response
+
+@autoflip_check
+def write_svg(request, molecule):
+    return get_image_response(request, molecule, svg=True)
 
 ###########################################################
 ###########################################################
@@ -295,6 +345,7 @@ def upload_data(request):
         "gjfreset": reset_gjf,
         "structureview": view_structure,
         "percent": get_percent,
+        "percenttable": get_percent_table_output,
     }
 
     if request.method == "POST":
@@ -311,52 +362,57 @@ def upload_data(request):
 
 
 def parse_log(request, upload_form):
-    split_iter = upload_form.cleaned_data['split_iter']
-    parser = fileparser.LogSet(split_iter=split_iter)
-    for f in upload_form.cleaned_data["files"]:
-        parser.parse_file(f)
-
-    output = parser.format_output()
-    f2 = StringIO(output)
-
-    if upload_form.cleaned_data['store'] and request.user.is_staff:
-        number_added = load_data.main(f2)
-        string = "%d datapoint(s) added to database." % number_added
-        logger.info(string)
-        output += "\n\n\n" + string
+    files = upload_form.cleaned_data["files"]
+    kwargs = {
+        "split_iter": upload_form.cleaned_data['split_iter'],
+        "store": upload_form.cleaned_data['store'] and request.user.is_staff,
+    }
+    if request.REQUEST.get("background"):
+        contents = [(f.name, f.read()) for f in files]
+        task = enqueue(parse_log_contents, args=(contents, ), kwargs=kwargs,
+                       user=get_task_user(request))
+        return get_queued_response(task)
 
+    output = parse_logs(files, **kwargs)
     response = HttpResponse(output, content_type="text/plain")
     return response
 
 
 def long_chain_limit(request, upload_form):
-    buff = StringIO()
-    zfile = zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED)
-    for f in upload_form.cleaned_data["files"]:
-        parser = dataparser.DataParser(f)
-        homolumo, gap = parser.get_graphs()
-
-        name, _ = os.path.splitext(f.name)
-        if len(upload_form.cleaned_data["files"]) > 1:
-            zfile.writestr(name + "/output.txt", parser.format_output())
-            zfile.writestr(name + "/homolumo.eps", homolumo.getvalue())
-            zfile.writestr(name + "/gap.eps", gap.getvalue())
-        else:
-            zfile.writestr("output.txt", parser.format_output())
-            zfile.writestr("homolumo.eps", homolumo.getvalue())
-            zfile.writestr("gap.eps", gap.getvalue())
-
-    if len(upload_form.cleaned_data["files"]) > 1:
-        name = "output"
-    zfile.close()
-    buff.flush()
+    files = upload_form.cleaned_data["files"]
+    # Parse everything first so bad files fail before the response starts
+    parsers = [dataparser.DataParser(f) for f in files]
+
+    def get_entries():
+        # The response has already started, so the errors of a file are
+        # added to the zip instead of raised
+        errors = []
+        for f, parser in zip(files, parsers):
+            name, _ = os.path.splitext(f.name)
+            try:
+                homolumo, gap = parser.get_graphs()
+                values = [
+                    ("output.txt", parser.format_output()),
+                    ("homolumo.eps", homolumo.getvalue()),
+                    ("gap.eps", gap.getvalue()),
+                ]
+            except Exception as e:
+                logger.warn("Long chain error: %s - %s" % (f.name, e))
+                errors.append("%s - %s" % (f.name, e))
+                continue
 
-    ret_zip = buff.getvalue()
-    buff.close()
+            for filename, data in values:
+                if len(files) > 1:
+                    filename = name + "/" + filename
+                yield filename, data
+        if errors:
+            yield "errors.txt", '\n'.join(errors)
 
-    response = HttpResponse(ret_zip, content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=%s.zip" % name
-    return response
+    if len(files) > 1:
+        name = "output"
+    else:
+        name, _ = os.path.splitext(files[-1].name)
+    return get_zip_response(get_entries(), name)
 
 
 def reset_gjf(request, upload_form):
@@ -365,20 +421,21 @@ def reset_gjf(request, upload_form):
     errors = []
     strings = []
     names = []
-    for f in upload_form.cleaned_data["files"]:
-        try:
-            parser = fileparser.Log(f)
-
-            name, _ = os.path.splitext(f.name)
-            td = False
-            if request.REQUEST.get("td_reset"):
-                name += '_TD'
-                td = True
-            strings.append(parser.format_gjf(td=td))
-            names.append(name)
-        except Exception as e:
-            logger.warn("There was an error when trying to reset a gjf: '%s'" % str(e))
-            errors.append((f.name, e))
+    with fileparser.LogCache(settings.LOG_CACHE_PATH) as cache:
+        for f in upload_form.cleaned_data["files"]:
+            try:
+                parser = cache.get_log(f)
+
+                name, _ = os.path.splitext(f.name)
+                td = False
+                if request.REQUEST.get("td_reset"):
+                    name += '_TD'
+                    td = True
+                strings.append(parser.format_gjf(td=td))
+                names.append(name)
+            except Exception as e:
+                logger.warn("There was an error when trying to reset a gjf: '%s'" % str(e))
+                errors.append((f.name, e))
 
     if request.REQUEST.get("gjf_submit"):
         if not job_form.is_valid(request.method):
@@ -414,21 +471,12 @@ def reset_gjf(request, upload_form):
             return HttpResponse(json.dumps(a),
                                 content_type="application/json")
 
-    buff = StringIO()
-    zfile = zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED)
-    for name, string in zip(names, strings):
-        zfile.writestr("%s.gjf" % name, string)
+    entries = [("%s.gjf" % name, string)
+               for name, string in zip(names, strings)]
     if errors:
         temp = ['%s - %s' % (name, error) for (name, error) in errors]
-        zfile.writestr("errors.txt", '\n'.join(temp))
-    zfile.close()
-    buff.flush()
-    ret_zip = buff.getvalue()
-    buff.close()
-
-    response = HttpResponse(ret_zip, content_type="application/zip")
-    response["Content-Disposition"] = "attachment; filename=output.zip"
-    return response
+        entries.append(("errors.txt", '\n'.join(temp)))
+    return get_zip_response(entries, "output")
 
 
 def view_structure(request, upload_form):
@@ -456,15 +504,44 @@ def view_structure(request, upload_form):
 
 def get_percent(request, upload_form):
     results = []
-    for f in upload_form.cleaned_data["files"]:
-        homo, lumo, image = compute_axes_percents(f)
-        results.append((f.name, (homo, lumo), image))
+    with fileparser.LogCache(settings.LOG_CACHE_PATH) as cache:
+        for f in upload_form.cleaned_data["files"]:
+            homo, lumo, image = cache.get_value(f, "percent", PERCENT_VERSION,
+                                                compute_axes_percents)
+            results.append((f.name, (homo, lumo), image))
 
     c = {
         "results": results,
     }
     return render(request, "chem/percent_view.html", c)
 
+
+def get_percent_table_output(request, upload_form):
+    window = upload_form.cleaned_data["orbital_window"]
+    with fileparser.LogCache(settings.LOG_CACHE_PATH) as cache:
+        rows, errors = get_percent_table(upload_form.cleaned_data["files"],
+                                         window=window, cache=cache)
+
+    if upload_form.cleaned_data["table_format"] == "json":
+        a = {
+            "header": PERCENT_HEADER,
+            "rows": rows,
+            "errors": errors,
+        }
+        return HttpResponse(json.dumps(a), content_type="application/json")
+
+    buff = StringIO()
+    writer = csv.writer(buff)
+    writer.writerow(PERCENT_HEADER)
+    writer.writerows(rows)
+    if errors:
+        buff.write("\n---- Errors (%i) ----\n" % len(errors))
+        buff.write('\n'.join(errors) + '\n')
+
+    response = HttpResponse(buff.getvalue(), content_type="text/csv")
+    response["Content-Disposition"] = "attachment; filename=percents.csv"
+    return response
+
 ###########################################################
 ###########################################################
 # Other
@@ -22,8 +22,16 @@ collect information with more complex types (such as vectors).
 from __future__ import print_function
 
 import os
+import re
+import mmap
+import time
+import zlib
+import hashlib
+import collections
 import multiprocessing
 import logging
+import cStringIO
+import cPickle
 
 try:
     # Fix for issues with openblas and multiprocessing
@@ -35,6 +43,12 @@ except ImportError:
     # not be able to convert standard orientation calculations.
     pass
 
+try:
+    import sqlite3
+except ImportError:
+    # Without sqlite, parsed logs can not be cached (see LogCache).
+    sqlite3 = None
+
 logger = logging.getLogger(__name__)
 HARTREE_TO_EV = 27.211383858491185
 BOHR_TO_ANGSTROM = 0.529177249
@@ -162,6 +176,21 @@ START = 'Start'
 STEP = 'Step'
 FINAL = 'Final'
 NULL = '---'
+# Markers of the sections of a log file that LogReader indexes
+SECTION_MARKERS = {
+    "start": "******************************************",
+    "command": "Initial command",
+    "orientation": " orientation:",
+    "basis": "NBasis=",
+    "orbitals": "Molecular Orbital Coefficients",
+    "archive": "\\@",
+    "termination": "Normal termination of Gaussian",
+}
+# The version of the parsed values of Logs in a LogCache (see SQLiteCache)
+LOG_CACHE_VERSION = 1
+# The most values that are kept in a LogCache
+LOG_CACHE_SIZE = 10000
+HASH_BLOCK_SIZE = 1 << 20
 
 
 def catch(fn):
@@ -256,6 +285,87 @@ class Output(object):
         raise NotImplementedError
 
 
+class LogReader(object):
+    '''Reads a log file without copying it into memory. Files on disk are
+    memory mapped, anything else is read once. The offsets of the lines with
+    each of the SECTION_MARKERS are indexed (the first time that marker is
+    used) so that a section can be read without going through the lines
+    before it.'''
+
+    def __init__(self, f):
+        if not hasattr(f, "read"):  # filename
+            f = open(f, 'r')
+        self.file = f
+        self.name = getattr(f, "name", '')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stream = self.data
+        except (AttributeError, EnvironmentError, ValueError):
+            # Not a real file (or an empty one) so it can not be mapped. Like
+            # the map, this reads from the start no matter where f is.
+            if hasattr(f, "seek"):
+                f.seek(0)
+            self.data = f.read()
+            self.stream = cStringIO.StringIO(self.data)
+        self.index = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def offsets(self, name):
+        '''Returns the offsets of the starts of the lines with the marker.'''
+        if name not in self.index:
+            data = self.data
+            marker = SECTION_MARKERS[name]
+            offsets = []
+            idx = data.find(marker)
+            while idx != -1:
+                offsets.append(data.rfind('\n', 0, idx) + 1)
+                end = data.find('\n', idx)
+                if end == -1:
+                    break
+                idx = data.find(marker, end)
+            self.index[name] = offsets
+        return self.index[name]
+
+    def build_index(self):
+        for name in SECTION_MARKERS:
+            self.offsets(name)
+        return self.index
+
+    def first(self, name, default=None):
+        offsets = self.offsets(name)
+        return offsets[0] if offsets else default
+
+    def last(self, name, default=None):
+        offsets = self.offsets(name)
+        return offsets[-1] if offsets else default
+
+    def lines(self, start=0, end=None):
+        '''Yields the lines from the offset start up to the offset end. All of
+        the lines are read from the same stream, so only one of these should
+        be iterated over at a time.'''
+        if end is None:
+            end = len(self.data)
+        self.stream.seek(start)
+        for line in iter(self.stream.readline, ''):
+            if start >= end:
+                break
+            start += len(line)
+            yield line
+
+
 class Log(object):
     PARSERS = dict()
     ORDER = ["ExactName", "Features", "Options",
@@ -267,66 +377,71 @@ class Log(object):
              "OscillatorStrength1", "OscillatorStrength2", "OscillatorStrength3",
              "ExcitationType1", "ExcitationType2", "ExcitationType3",
              "SpatialExtent", "StepNumber", "Polarizability", "MP2Energy"]
+    # The combined matcher for the TRIGGERS of all the parsers. This gets
+    # built the first time a log is parsed. See get_matcher.
+    MATCHER = None
 
     def __init__(self, f, fname=None):
-        if not hasattr(f, "read"):  # filename
-            f = open(f, 'r')
-        with f:
-            self.fname = fname if fname else f.name
-            self.name = self.cleanup_name()
-
-            self.parsers = [self.setup_parsers()]
-            self.parser_labels = [START]
-            completed = False
-            current_parsers = self.parsers[0]
-            self.windows_file = False
-            start = False
-
-            for line in f:
-                if '\r' in line:
-                    line = line.replace('\r', '')
-                    self.windows_file = True
-
-                if "******************************************" in line:
-                    start = True
-
-                if not start:
-                    continue
-
-                if "Normal termination of Gaussian" in line:
-                    completed = True
+        with LogReader(f) as reader:
+            self.fname = fname if fname else reader.name
+            self.setup_log()
 
-                init_command = "Initial command" in line
-                orientation = " orientation:" in line
-                # This check ensures that it does not create a new
-                # parser set just because it has both Input and Standard
-                # orientation geometries printed.
-                empty = self.previous_parsers_empty()
-                if init_command or (orientation and not empty):
-                    label = START if init_command else STEP
-                    self.parser_labels.append(label)
-
-                    if not completed:
-                        current_parsers["Geometry"].value = None
-                    completed = False
-                    self.parsers.append(self.setup_parsers())
-                    current_parsers = self.parsers[-1]
-
-                for k, parser in current_parsers.items():
-                    parser.parse(line)
-
-            if not completed:
-                current_parsers["Geometry"].value = None
-
-        # major memory saver by deleting all the line parser objects
-        self.parsers = [self.cleanup_parsers(
-            parsers) for parsers in self.parsers]
+            # Nothing before the first line of stars gets parsed
+            start = reader.first("start", len(reader))
+            self.windows_file = reader.data.find('\r', 0, start) != -1
+            self.parse_lines(reader.lines(start))
+        self.finish_parsers()
 
         # Determine transformation
         self.Rot = None
         self.trans = None
         self.get_transformation()
 
+    def setup_log(self):
+        self.name = self.cleanup_name()
+        self.parsers = [self.setup_parsers()]
+        self.parser_labels = [START]
+        self.completed = False
+        self.setup_dispatch(self.parsers[0])
+
+    def parse_lines(self, lines):
+        current_parsers = self.parsers[-1]
+        for line in lines:
+            if '\r' in line:
+                line = line.replace('\r', '')
+                self.windows_file = True
+
+            if "Normal termination of Gaussian" in line:
+                self.completed = True
+
+            init_command = "Initial command" in line
+            orientation = " orientation:" in line
+            # This check ensures that it does not create a new
+            # parser set just because it has both Input and Standard
+            # orientation geometries printed.
+            empty = self.previous_parsers_empty()
+            if init_command or (orientation and not empty):
+                label = START if init_command else STEP
+                self.parser_labels.append(label)
+
+                if not self.completed:
+                    current_parsers["Geometry"].value = None
+                self.completed = False
+                # major memory saver by deleting all the line parser objects
+                # once nothing more can be added to them
+                self.parsers[-1] = self.cleanup_parsers(current_parsers)
+                self.parsers.append(self.setup_parsers())
+                current_parsers = self.parsers[-1]
+                self.setup_dispatch(current_parsers)
+
+            self.parse_line(line, current_parsers)
+
+    def finish_parsers(self):
+        if not self.completed:
+            self.parsers[-1]["Geometry"].value = None
+        self.setup_dispatch({})
+        self.parsers[-1] = self.cleanup_parsers(self.parsers[-1])
+
     def previous_parsers_empty(self):
         prev = self.parsers[-1]
         return not prev["Energy"].done or not prev["StepNumber"].done
@@ -341,6 +456,36 @@ class Log(object):
             name = name[:-6]
         return name
 
+    @classmethod
+    def get_version(cls):
+        '''A stamp of the parsers so that cached values are only used with the
+        same set of parsers that made them.'''
+        parts = [str(LOG_CACHE_VERSION)] + sorted(cls.PARSERS) + cls.ORDER
+        return hashlib.sha1(','.join(parts)).hexdigest()
+
+    def get_state(self):
+        '''Returns the parsed values, everything needed to rebuild the Log
+        with from_state.'''
+        return {
+            "parsers": self.parsers,
+            "parser_labels": self.parser_labels,
+            "windows_file": self.windows_file,
+        }
+
+    @classmethod
+    def from_state(cls, state, fname):
+        log = cls.__new__(cls)
+        log.fname = fname
+        log.name = log.cleanup_name()
+        log.parsers = state["parsers"]
+        log.parser_labels = state["parser_labels"]
+        log.windows_file = state["windows_file"]
+
+        log.Rot = None
+        log.trans = None
+        log.get_transformation()
+        return log
+
     def __getitem__(self, key):
         '''Return the value of the last parser with a value'''
         return self.get_most_recent(key)
@@ -363,6 +508,57 @@ class Log(object):
     def setup_parsers(self):
         return {k: v(self) for k, v in Log.PARSERS.items()}
 
+    @classmethod
+    def get_matcher(cls):
+        '''Returns a regex that matches any of the parser triggers, the length
+        of the longest trigger, and a list of (trigger, parser names) pairs.'''
+        if cls.MATCHER is None:
+            names = collections.defaultdict(list)
+            for name, parser in cls.PARSERS.items():
+                for trigger in parser.TRIGGERS or ():
+                    names[trigger.lower()].append(name)
+            # The triggers are matched against lower case lines because
+            # IGNORECASE makes the regex much slower.
+            regex = re.compile('|'.join(re.escape(x) for x in names))
+            size = max([len(x) for x in names] + [1])
+            cls.MATCHER = (regex, size, list(names.items()))
+        return cls.MATCHER
+
+    def setup_dispatch(self, parsers):
+        '''Groups a new set of parsers by the triggers they are waiting for.'''
+        _, _, triggers = self.get_matcher()
+        self.prevline = ''
+        self._triggered = [(trigger, [parsers[x] for x in names])
+                           for trigger, names in triggers if parsers]
+        self._always = [x for x in parsers.values() if x.TRIGGERS is None]
+        self._active = []
+
+    def parse_line(self, line, parsers):
+        '''Passes the line to the parsers that are in the middle of a block and
+        to the parsers that have a trigger in it. The triggers are also looked
+        for across the end of the previous line so the parsers of the archive
+        block can find keys that were split over two lines.'''
+        regex, size, _ = self.MATCHER
+        stripped = line.strip()
+        joined = self.prevline + stripped
+        pos = max(0, len(self.prevline) - size + 1)
+
+        use = self._always + self._active
+        window = joined[pos:].lower()
+        if regex.search(window):
+            for trigger, group in self._triggered:
+                if trigger in window:
+                    use.extend(group)
+
+        self._active = []
+        for parser in set(use):
+            if parser.done:
+                continue
+            parser.parse(line)
+            if not parser.done and parser.active:
+                self._active.append(parser)
+        self.prevline = stripped
+
     def cleanup_parsers(self, parsers):
         # major memory saver by deleting all the line parser objects
         return {k: (v.value, v.done) for k, v in parsers.items()}
@@ -443,6 +639,7 @@ class Log(object):
                 use = name
                 parser.__name__ = name
             cls.PARSERS[use] = parser
+            cls.MATCHER = None
             return parser
         return inner
 
@@ -535,33 +732,406 @@ class Log(object):
         return ','.join(nonparsed + values)
 
 
+class PartialLog(Log):
+    '''A Log of a file that is still being written. Each update only parses
+    the complete lines that were added since the last one. The parse can be
+    saved with get_state and picked back up with from_state, so a job can be
+    followed without ever reading its log twice.'''
+    STATUS_ORDER = ["StepNumber", "Energy", "Convergence"]
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.offset = 0
+        self.started = False
+        self.windows_file = False
+        self.setup_log()
+
+    def update(self, f=None):
+        '''Parses the lines added to f (the file name if not given) since the
+        last update. Returns the number of bytes read.'''
+        if f is None:
+            f = self.fname
+        with LogReader(f) as reader:
+            if len(reader) < self.offset:
+                # The file was replaced, so start over
+                self.__init__(self.fname)
+
+            data = reader.data
+            start = self.offset
+            end = data.rfind('\n') + 1
+            if end <= start:
+                return 0
+
+            if not self.started:
+                # Nothing before the first line of stars gets parsed
+                idx = data.find(SECTION_MARKERS["start"], start, end)
+                before = end if idx == -1 else data.rfind('\n', 0, idx) + 1
+                if data.find('\r', start, before) != -1:
+                    self.windows_file = True
+                self.started = idx != -1
+                start = before
+
+            self.parse_lines(reader.lines(start, end))
+            read = end - self.offset
+            self.offset = end
+        return read
+
+    def get_state(self):
+        current = self.parsers[-1]
+        return {
+            "fname": self.fname,
+            "offset": self.offset,
+            "started": self.started,
+            "completed": self.completed,
+            "windows_file": self.windows_file,
+            "prevline": self.prevline,
+            "parser_labels": self.parser_labels,
+            "parsers": self.parsers[:-1],
+            "current": {k: self.get_parser_state(v) for k, v in current.items()},
+        }
+
+    @staticmethod
+    def get_parser_state(parser):
+        return {k: v for k, v in parser.__dict__.items() if k != "log"}
+
+    @classmethod
+    def from_state(cls, state, fname=None):
+        log = cls.__new__(cls)
+        log.fname = fname if fname else state["fname"]
+        log.name = log.cleanup_name()
+        for key in ("offset", "started", "completed", "windows_file",
+                    "parser_labels"):
+            setattr(log, key, state[key])
+
+        current = {}
+        for key, values in state["current"].items():
+            parser = Log.PARSERS[key].__new__(Log.PARSERS[key])
+            parser.__dict__.update(values)
+            parser.log = log
+            current[key] = parser
+        log.parsers = state["parsers"] + [current]
+
+        log.setup_dispatch(current)
+        log.prevline = state["prevline"]
+        log._active = [x for x in current.values() if not x.done and x.active]
+        return log
+
+    def get_log(self):
+        '''Returns a Log of everything that has been parsed so far.'''
+        current = self.cleanup_parsers(self.parsers[-1])
+        if not self.completed:
+            current["Geometry"] = (None, current["Geometry"][1])
+        state = {
+            "parsers": self.parsers[:-1] + [current],
+            "parser_labels": list(self.parser_labels),
+            "windows_file": self.windows_file,
+        }
+        return Log.from_state(state, self.fname)
+
+    def format_status(self):
+        log = self.get_log()
+        values = [log[key] for key in self.STATUS_ORDER]
+        values = [NULL if x is None else x for x in values]
+        completed = "Completed" if self.completed else "Running"
+        return ','.join([self.fname, log.name, completed] + values)
+
+    @classmethod
+    def format_status_header(cls):
+        return ','.join(["Filename", "Name", "Status"] + cls.STATUS_ORDER)
+
+
+class SQLiteCache(object):
+    '''The base of the caches kept in an sqlite file. Subclasses give the
+    TABLE the values are kept in and the SCHEMA queries that create it, which
+    needs an accessed column so that once there are more than maxsize rows the
+    least recently used ones are dropped. Values that depend on the code that
+    computed them carry a version, either stored with them or in their key,
+    which has to be bumped whenever that code changes the value it gives for
+    the same input so that values cached by older versions are not used.'''
+    NAME = "cache"
+    TABLE = None
+    SCHEMA = ()
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        if sqlite3 is None:
+            raise ImportError("The sqlite3 module is needed for the %s" %
+                              self.NAME)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.execute(*self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.execute(("SELECT COUNT(*) FROM %s" % self.TABLE, ()))[0][0]
+
+    def close(self):
+        self.conn.close()
+
+    def execute(self, *queries):
+        '''Runs the (sql, args) pairs in one transaction and returns the rows
+        from the last one. Problems with the cache file are logged and give
+        no rows, so the values are just computed again.'''
+        try:
+            with self.conn:
+                for sql, args in queries:
+                    cursor = self.conn.execute(sql, args)
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.warn("Problem with the %s %s: %s" %
+                        (self.NAME, self.path, e))
+            return []
+
+    def touch(self, where, args):
+        '''Marks the rows matching the where clause as just used.'''
+        self.execute((
+            "UPDATE %s SET accessed = ? WHERE %s" % (self.TABLE, where),
+            (time.time(), ) + args))
+
+    def get_evict_query(self):
+        '''Returns the query that drops all but the maxsize most recently used
+        rows.'''
+        return ("DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)".format(self.TABLE),
+                (self.maxsize, ))
+
+
+class LogCache(SQLiteCache):
+    '''An sqlite file of values computed from log files, mostly the parsed
+    values of Logs. A value is keyed by the sha1 of the contents of its log
+    (so a re-uploaded or copied log is still found) and by what was computed.
+    Paths are also stored with their size and mtime so that an unchanged file
+    does not have to be read again. Values are only used if their version
+    still matches.'''
+    NAME = "log cache"
+    TABLE = "logs"
+    SCHEMA = (
+        ("CREATE TABLE IF NOT EXISTS logs (digest TEXT, key TEXT, "
+         "version TEXT, data BLOB, accessed REAL, "
+         "PRIMARY KEY (digest, key))", ()),
+        ("CREATE INDEX IF NOT EXISTS logs_accessed ON logs (accessed)", ()),
+        ("CREATE TABLE IF NOT EXISTS paths (path TEXT PRIMARY KEY, "
+         "size INTEGER, mtime REAL, digest TEXT)", ()),
+    )
+
+    def __init__(self, path, maxsize=LOG_CACHE_SIZE):
+        super(LogCache, self).__init__(path, maxsize)
+
+    @staticmethod
+    def hash_file(f):
+        f.seek(0)
+        digest = hashlib.sha1()
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ''):
+            digest.update(block)
+        f.seek(0)
+        return digest.hexdigest()
+
+    def get_digest(self, f):
+        '''Returns the sha1 of the contents of f, a path or a file object.'''
+        if hasattr(f, "read"):
+            return self.hash_file(f)
+
+        path = os.path.abspath(f)
+        stat = os.stat(path)
+        args = (path, stat.st_size, stat.st_mtime)
+        rows = self.execute((
+            "SELECT digest FROM paths WHERE path = ? AND size = ? AND mtime = ?",
+            args))
+        if rows:
+            return rows[0][0]
+
+        with open(path, 'r') as fh:
+            digest = self.hash_file(fh)
+        self.execute(
+            ("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)",
+             args + (digest, )))
+        return digest
+
+    def get(self, digest, key, version):
+        '''Returns the cached value or None if there is not one.'''
+        rows = self.execute((
+            "SELECT version, data FROM logs WHERE digest = ? AND key = ?",
+            (digest, key)))
+        if not rows or rows[0][0] != str(version):
+            self.misses += 1
+            return None
+
+        self.touch("digest = ? AND key = ?", (digest, key))
+        self.hits += 1
+        return cPickle.loads(zlib.decompress(rows[0][1]))
+
+    def set(self, digest, key, version, value):
+        data = zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        self.execute(
+            ("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)",
+             (digest, key, str(version), sqlite3.Binary(data), time.time())),
+            self.get_evict_query(),
+            ("DELETE FROM paths WHERE digest NOT IN "
+             "(SELECT digest FROM logs)", ()),
+        )
+
+    def get_value(self, f, key, version, function):
+        '''Returns function(f), only calling it if the value for the log is
+        not cached.'''
+        digest = self.get_digest(f)
+        value = self.get(digest, key, version)
+        if value is None:
+            value = function(f)
+            self.set(digest, key, version, value)
+        return value
+
+    def get_log_key(self, f):
+        '''Returns the file name, digest and key that the Log of f is stored
+        with.'''
+        fname = getattr(f, "name", '') if hasattr(f, "read") else f
+        digest = self.get_digest(f)
+        # The name is part of the key because some parsers use it
+        return fname, digest, "Log:" + os.path.basename(fname)
+
+    def get_log(self, f):
+        '''Returns the Log of f, only parsing it if it is not cached.'''
+        fname, digest, key = self.get_log_key(f)
+        version = Log.get_version()
+        state = self.get(digest, key, version)
+        if state is not None:
+            return Log.from_state(state, fname)
+
+        log = Log(f)
+        self.set(digest, key, version, log.get_state())
+        return log
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+
+# The worker pool that is shared by all LogSets (and by the zips of
+# chemtools.interface). See get_pool.
+POOL = None
+
+
+def get_pool():
+    '''Returns the shared worker pool, starting it the first time it is
+    needed.'''
+    global POOL
+    if POOL is None:
+        POOL = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    return POOL
+
+
+def parse_state(job):
+    '''Parses the log of an (index, path) job in a worker and returns
+    (index, parsed values, error).'''
+    i, f = job
+    try:
+        return i, Log(f).get_state(), None
+    except Exception as e:
+        return i, None, repr(e)
+
+
 class LogSet(Output):
 
-    def __init__(self, split_iter=False):
+    def __init__(self, split_iter=False, cache=None):
         super(LogSet, self).__init__()
         self.logs = []
         self.header = ''
         self.split_iter = split_iter
+        self.cache = cache
 
     @catch
     def parse_file(self, f):
-        x = Log(f)
+        if self.cache is not None:
+            x = self.cache.get_log(f)
+        else:
+            x = Log(f)
         self.logs.append(x)
         new = x.format_header()
         if len(new) > len(self.header):
             self.header = new
         self.write(x.format_data(self.split_iter))
 
-    def parse_files(self, files):
+    @staticmethod
+    def map_states(jobs, ordered=True, chunksize=None):
+        if len(jobs) <= 1:
+            return (parse_state(x) for x in jobs)
+
+        pool = get_pool()
+        if chunksize is None:
+            chunksize = max(1, len(jobs) // (4 * multiprocessing.cpu_count()))
+        if ordered:
+            return pool.imap(parse_state, jobs, chunksize)
+        return pool.imap_unordered(parse_state, jobs, chunksize)
+
+    def iter_logs(self, files, ordered=True, chunksize=None):
+        '''Yields (fname, log, error) for each of the files, in the order of
+        files or, if not ordered, as soon as each one is done. The files are
+        parsed in the shared worker pool, which only sends back their parsed
+        values, and a file that can not be parsed gives its error instead of
+        stopping the rest.'''
+        version = Log.get_version()
+        done = {}
+        keys = {}
+        jobs = []
+        for i, f in enumerate(files):
+            if self.cache is None:
+                jobs.append((i, f))
+                continue
+            try:
+                fname, digest, key = self.cache.get_log_key(f)
+                state = self.cache.get(digest, key, version)
+            except Exception as e:
+                done[i] = (f, None, repr(e))
+                continue
+            if state is None:
+                keys[i] = (digest, key)
+                jobs.append((i, f))
+            else:
+                done[i] = (fname, Log.from_state(state, fname), None)
+
+        if not ordered:
+            for i in sorted(done):
+                yield done.pop(i)
+
+        idx = 0
+        for i, state, error in self.map_states(jobs, ordered, chunksize):
+            fname = files[i]
+            if error is None:
+                if i in keys:
+                    self.cache.set(keys[i][0], keys[i][1], version, state)
+                done[i] = (fname, Log.from_state(state, fname), None)
+            else:
+                done[i] = (fname, None, error)
+
+            if not ordered:
+                yield done.pop(i)
+            while idx in done:
+                yield done.pop(idx)
+                idx += 1
+
+        for i in sorted(done):
+            yield done[i]
+
+    def parse_files(self, files, ordered=True, chunksize=None):
         if not files:
             return
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        self.logs = pool.map(Log, files)
-        pool.close()
-        pool.join()
-
-        self.header = self.logs[0].format_header()
-        for log in self.logs:
+        self.header = Log.format_header()
+        for fname, log, error in self.iter_logs(files, ordered, chunksize):
+            if error is not None:
+                logger.info("%s: %s" % (fname, error))
+                self.errors.append("%s: %s" % (fname, error))
+                continue
+            self.logs.append(log)
             self.write(log.format_data(self.split_iter))
 
     def format_output(self, errors=True):
@@ -585,15 +1155,26 @@ def is_done(fn):
 
 class LineParser(object):
     UNITS = None
+    # Parts of the lines that an idle parser acts on. A line is only passed to
+    # the parser if it contains one of these or if the parser is active. None
+    # means that the parser gets every line.
+    TRIGGERS = None
+
     def __init__(self, log):
         self.log = log
         self.done = False
         self.value = None
         self.newfile = False
+        self.start = False
 
     def parse(self, line):
         raise NotImplementedError
 
+    @property
+    def active(self):
+        '''True while the parser is in the middle of a block of lines.'''
+        return bool(self.start)
+
     @property
     def delimiter(self):
         if self.log.windows_file:
@@ -605,6 +1186,8 @@ class LineParser(object):
         return str(self.value)
 
     def find_in_end_block(self, key, line):
+        if not self.start:
+            self.prevline = self.log.prevline
         modline = self.prevline + line.strip()
 
         if "{0}{1}=".format(self.delimiter, key) in modline:
@@ -617,14 +1200,13 @@ class LineParser(object):
             self.value += line.split(self.delimiter)[0].strip()
             if self.delimiter in line:
                 self.done = True
-        else:
-            self.prevline = line.strip()
 
 ##############################################################################
 ##############################################################################
 
 @Log.add_parser()
 class ExactName(LineParser):
+    TRIGGERS = ()
 
     def __init__(self, *args, **kwargs):
         super(ExactName, self).__init__(*args, **kwargs)
@@ -643,6 +1225,7 @@ class ExactName(LineParser):
 
 @Log.add_parser()
 class Features(LineParser):
+    TRIGGERS = ()
 
     def __init__(self, *args, **kwargs):
         super(Features, self).__init__(*args, **kwargs)
@@ -669,6 +1252,7 @@ class Features(LineParser):
 
 @Log.add_parser()
 class Options(LineParser):
+    TRIGGERS = ("#", )
 
     def __init__(self, *args, **kwargs):
         super(Options, self).__init__(*args, **kwargs)
@@ -696,6 +1280,7 @@ class Options(LineParser):
 
 @Log.add_parser()
 class ChargeMultiplicity(LineParser):
+    TRIGGERS = ("Multiplicity =", )
 
     def __init__(self, *args, **kwargs):
         super(ChargeMultiplicity, self).__init__(*args, **kwargs)
@@ -713,6 +1298,7 @@ class ChargeMultiplicity(LineParser):
 
 @Log.add_parser()
 class HomoOrbital(LineParser):
+    TRIGGERS = ("Alpha  occ. eigenvalues", )
 
     def __init__(self, *args, **kwargs):
         super(HomoOrbital, self).__init__(*args, **kwargs)
@@ -732,10 +1318,15 @@ class HomoOrbital(LineParser):
             self.value = str(self.value)
             self.done = True
 
+    @property
+    def active(self):
+        return self.value is not None
+
 
 @Log.add_parser()
 class Polarizability(LineParser):
     UNITS = 'Angstrom^3'
+    TRIGGERS = ("\\Polar=", "|Polar=")
 
     def __init__(self, *args, **kwargs):
         super(Polarizability, self).__init__(*args, **kwargs)
@@ -757,6 +1348,7 @@ class Polarizability(LineParser):
 @Log.add_parser()
 class PolarizabilityMatrix(LineParser):
     UNITS = 'Angstrom^3'
+    TRIGGERS = ("\\Polar=", "|Polar=")
 
     def __init__(self, *args, **kwargs):
         super(PolarizabilityMatrix, self).__init__(*args, **kwargs)
@@ -776,6 +1368,7 @@ class PolarizabilityMatrix(LineParser):
 @Log.add_parser()
 class Energy(LineParser):
     UNITS = 'Hartrees'
+    TRIGGERS = ("SCF Done", "\\HF=", "|HF=")
 
     def __init__(self, *args, **kwargs):
         super(Energy, self).__init__(*args, **kwargs)
@@ -798,6 +1391,7 @@ class Energy(LineParser):
 @Log.add_parser()
 class MP2Energy(LineParser):
     UNITS = 'Hartrees'
+    TRIGGERS = ("\\MP2=", "|MP2=")
 
     def __init__(self, *args, **kwargs):
         super(MP2Energy, self).__init__(*args, **kwargs)
@@ -813,6 +1407,7 @@ class MP2Energy(LineParser):
 @Log.add_parser()
 class Time(LineParser):
     UNITS = 'Hours'
+    TRIGGERS = ("Job cpu time", )
 
     def __init__(self, *args, **kwargs):
         super(Time, self).__init__(*args, **kwargs)
@@ -830,6 +1425,7 @@ class Time(LineParser):
 @Log.add_parser()
 class HOMO(LineParser):
     UNITS = 'eV'
+    TRIGGERS = ("occ. eigenvalues", "virt. eigenvalues")
 
     def __init__(self, *args, **kwargs):
         super(HOMO, self).__init__(*args, **kwargs)
@@ -851,6 +1447,7 @@ class HOMO(LineParser):
 @Log.add_parser()
 class LUMO(LineParser):
     UNITS = 'eV'
+    TRIGGERS = ("occ. eigenvalues", "virt. eigenvalues")
 
     def __init__(self, *args, **kwargs):
         super(LUMO, self).__init__(*args, **kwargs)
@@ -892,6 +1489,7 @@ class BetaLUMO(LUMO):
 @Log.add_parser()
 class Geometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("\\", "|")
 
     def __init__(self, *args, **kwargs):
         super(Geometry, self).__init__(*args, **kwargs)
@@ -951,6 +1549,7 @@ class Geometry(LineParser):
 @Log.add_parser()
 class PartialGeometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("Number       Type", )
 
     def __init__(self, *args, **kwargs):
         super(PartialGeometry, self).__init__(*args, **kwargs)
@@ -992,6 +1591,7 @@ class PartialGeometry(LineParser):
 @Log.add_parser()
 class InputGeometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("Multiplicity =", )
 
     def __init__(self, *args, **kwargs):
         super(InputGeometry, self).__init__(*args, **kwargs)
@@ -1046,6 +1646,7 @@ class InputGeometry(LineParser):
 
 @Log.add_parser()
 class Header(LineParser):
+    TRIGGERS = ("%", )
 
     def __init__(self, *args, **kwargs):
         super(Header, self).__init__(*args, **kwargs)
@@ -1071,6 +1672,7 @@ class Header(LineParser):
 @Log.add_parser()
 class Dipole(LineParser):
     UNITS = 'Debye'
+    TRIGGERS = ("X=", )
 
     def __init__(self, *args, **kwargs):
         super(Dipole, self).__init__(*args, **kwargs)
@@ -1087,6 +1689,7 @@ class Dipole(LineParser):
 @Log.add_parser()
 class DipoleVector(LineParser):
     UNITS = 'Debye'
+    TRIGGERS = ("X=", )
 
     def __init__(self, *args, **kwargs):
         super(DipoleVector, self).__init__(*args, **kwargs)
@@ -1109,6 +1712,7 @@ def generate_excitation_parsers(n):
     @Log.add_parser("ExcitationEnergy%d" % n)
     class ExcitationEnergy(LineParser):
         UNITS = 'eV'
+        TRIGGERS = ("Excited State   %d:" % n, )
 
         def __init__(self, *args, **kwargs):
             super(ExcitationEnergy, self).__init__(*args, **kwargs)
@@ -1125,6 +1729,7 @@ def generate_excitation_parsers(n):
     @Log.add_parser("ExcitationDipoleVector%d" % n)
     class ExcitationDipoleVector(LineParser):
         UNITS = 'Au'
+        TRIGGERS = ("transition electric dipole", )
 
         def __init__(self, *args, **kwargs):
             super(ExcitationDipoleVector, self).__init__(*args, **kwargs)
@@ -1148,6 +1753,7 @@ def generate_excitation_parsers(n):
 
     @Log.add_parser("OscillatorStrength%d" % n)
     class OscillatorStrength(LineParser):
+        TRIGGERS = ("Excited State   %d:" % n, )
 
         def __init__(self, *args, **kwargs):
             super(OscillatorStrength, self).__init__(*args, **kwargs)
@@ -1162,6 +1768,7 @@ def generate_excitation_parsers(n):
 
     @Log.add_parser("ExcitationType%d" % n)
     class ExcitationType(LineParser):
+        TRIGGERS = ("Excited State   %d:" % n, )
 
         def __init__(self, *args, **kwargs):
             super(ExcitationType, self).__init__(*args, **kwargs)
@@ -1185,6 +1792,7 @@ for i in range(1, 4):
 @Log.add_parser()
 class SpatialExtent(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("Electronic spatial extent", )
 
     def __init__(self, *args, **kwargs):
         super(SpatialExtent, self).__init__(*args, **kwargs)
@@ -1200,6 +1808,7 @@ class SpatialExtent(LineParser):
 @Log.add_parser()
 class ForceVectors(LineParser):
     UNITS = 'eV/Angstrom'
+    TRIGGERS = ("Forces (Hartrees/Bohr)", )
 
     def __init__(self, *args, **kwargs):
         super(ForceVectors, self).__init__(*args, **kwargs)
@@ -1258,6 +1867,7 @@ class ForceVectors(LineParser):
 @Log.add_parser()
 class MullikenCharges(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("Mulliken", )
 
     def __init__(self, *args, **kwargs):
         super(MullikenCharges, self).__init__(*args, **kwargs)
@@ -1292,6 +1902,7 @@ class MullikenCharges(LineParser):
 @Log.add_parser()
 class SumMullikenCharges(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("summed into heavy atoms", )
 
     def __init__(self, *args, **kwargs):
         super(SumMullikenCharges, self).__init__(*args, **kwargs)
@@ -1328,6 +1939,7 @@ class SumMullikenCharges(LineParser):
 
 @Log.add_parser()
 class StepNumber(LineParser):
+    TRIGGERS = ("Step number", )
 
     def __init__(self, *args, **kwargs):
         super(StepNumber, self).__init__(*args, **kwargs)
@@ -1341,6 +1953,38 @@ class StepNumber(LineParser):
             self.done = True
 
 
+@Log.add_parser()
+class Convergence(LineParser):
+    TRIGGERS = ("Converged?", )
+
+    def __init__(self, *args, **kwargs):
+        super(Convergence, self).__init__(*args, **kwargs)
+        self.start = False
+
+    @is_done
+    def parse(self, line):
+        # "         Item               Value     Threshold  Converged?"
+        # " Maximum Force            0.095055     0.000450     NO "
+        # " RMS     Force            0.095055     0.000300     NO "
+        # " Maximum Displacement     0.150000     0.001800     NO "
+        # " RMS     Displacement     0.212132     0.001200     NO "
+        if "Converged?" in line:
+            self.start = True
+            self.value = ''
+            return
+
+        if self.start:
+            temp = line.split()
+            if not temp or temp[-1] not in ("YES", "NO"):
+                self.start = False
+                self.done = True
+                return
+            self.value = (self.value + ' ' + temp[-1]).strip()
+            if "RMS" in line and "Displacement" in line:
+                self.start = False
+                self.done = True
+
+
 ##############################################################################
 # StandAlone
 ##############################################################################
@@ -1370,6 +2014,12 @@ if __name__ == "__main__":
             self.output_outx = args.outx
             self.td = args.td
             self.split_iter = args.split_iter
+            self.cache = None
+            if args.cache:
+                if sqlite3 is None:
+                    logger.warn("Not caching logs, there is no sqlite3")
+                else:
+                    self.cache = LogCache(args.cache)
 
         def check_input_files(self, filelist):
             files = []
@@ -1432,22 +2082,78 @@ if __name__ == "__main__":
                     "Problem parsing file: %s - %s" % (log.name, str(e)))
 
         def write_file(self):
-            logs = LogSet(self.split_iter)
-            logs.parse_files(self.files)
+            '''Writes the row (and the side files) of each log as soon as it
+            is parsed, so only one log needs to be kept at a time.'''
+            logs = LogSet(self.split_iter, cache=self.cache)
 
             names = [".out", ".gjf", ".outx"]
             mask = [self.output_out, self.output_gjf, self.output_outx]
-
             endings = [x for x, y in zip(names, mask) if y]
-            for ending in endings:
-                for log in logs.logs:
-                    self.do_writer(log, ending)
 
-            if self.outputfilename:
-                with open(self.outputfilename, 'w') as outputfile:
-                    outputfile.write(logs.format_output(errors=self.error))
-            else:
-                print(logs.format_output(errors=self.error))
+            errors = []
+            with self.open_output() as outputfile:
+                outputfile.write(Log.format_header() + '\n')
+                for fname, log, error in logs.iter_logs(self.files):
+                    if error is not None:
+                        logger.info("%s: %s" % (fname, error))
+                        errors.append("%s: %s" % (fname, error))
+                        continue
+                    outputfile.write(log.format_data(self.split_iter) + '\n')
+                    for ending in endings:
+                        self.do_writer(log, ending)
+
+                if self.error:
+                    outputfile.write("\n---- Errors (%i) ----\n" % len(errors))
+                    for error in errors:
+                        outputfile.write(error + '\n')
+
+                # The output to stdout has always ended with a blank line
+                if self.writes_stdout():
+                    outputfile.write('\n')
+
+        def follow_files(self, path):
+            '''Writes the status of each of the files while only parsing what
+            was added to them since the last run that used the same path.'''
+            try:
+                with open(path, 'rb') as f:
+                    states = cPickle.load(f)
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                states = {}
+
+            new_states = {}
+            lines = [PartialLog.format_status_header()]
+            for fname in self.files:
+                key = os.path.abspath(fname)
+                if key in states:
+                    log = PartialLog.from_state(states[key], fname)
+                else:
+                    log = PartialLog(fname)
+                try:
+                    log.update()
+                except Exception as e:
+                    logger.info(
+                        "Problem parsing file: %s - %s" % (fname, str(e)))
+                    continue
+                new_states[key] = log.get_state()
+                lines.append(log.format_status())
+
+            with open(path, 'wb') as f:
+                cPickle.dump(new_states, f, cPickle.HIGHEST_PROTOCOL)
+            self.write_output('\n'.join(lines) + '\n')
+
+        def write_output(self, string):
+            with self.open_output() as outputfile:
+                outputfile.write(string)
+
+        def writes_stdout(self):
+            return not self.outputfilename or self.outputfilename == '-'
+
+        def open_output(self):
+            if not self.writes_stdout():
+                return open(self.outputfilename, 'w')
+            # A line buffered copy of stdout, so that rows show up as soon as
+            # they are written
+            return os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1)
 
     parser = argparse.ArgumentParser(
         description="This program extracts data from Gaussian log files.")
@@ -1460,7 +2166,8 @@ if __name__ == "__main__":
                         dest="folders", type=str,
                         help='A folder with a collection of files.')
     parser.add_argument('-o', metavar='output', action="store",
-                        dest="outputfile", type=str, help='The output file.')
+                        dest="outputfile", type=str,
+                        help='The output file ("-" for stdout).')
     parser.add_argument('-E', action="store_true", dest="error", default=False,
                         help='Toggles showing error messages.')
     parser.add_argument('-P', action="store_true", dest="paths", default=False,
@@ -1483,10 +2190,21 @@ if __name__ == "__main__":
                         help='Sets the location to save out files')
     parser.add_argument('-X', action="store_true", dest="outx", default=False,
                         help='Toggles writing .outx files from logs.')
+    parser.add_argument('-C', metavar='cache', action="store", dest="cache",
+                        type=str, default=None,
+                        help='An sqlite file to cache parsed logs in.')
+    parser.add_argument('-F', metavar='state', action="store", dest="follow",
+                        type=str, default=None,
+                        help='Toggles writing the status of running logs. '
+                        'Parsing resumes from the last run using this file.')
 
     if len(sys.argv) > 1:
         args = sys.argv[1:]
     else:
         args = raw_input('Arguments: ').strip().split()
-    a = StandAlone(parser.parse_args(args))
-    a.write_file()
+    args = parser.parse_args(args)
+    a = StandAlone(args)
+    if args.follow:
+        a.follow_files(args.follow)
+    else:
+        a.write_file()
@@ -1,20 +1,35 @@
 import functools
 import collections
 import base64
+import hashlib
 import logging
 import re
+import time
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 import structure
 from constants import KEYWORDS
-from mol_name import get_exact_name, autoflip_name, get_structure_type
+from mol_name import analyze_name, autoflip_name
 from ml import get_decay_distance_correction_feature_vector, \
     get_binary_feature_vector, get_decay_feature_vector, \
-    get_properties_from_decay_with_predictions
+    get_decay_feature_matrix, predict_properties
+from fileparser import SQLiteCache
 import dataparser
 
 
 logger = logging.getLogger(__name__)
 
+LIMIT_DIRECTIONS = ["n", "m"]
+LIMIT_XVALS = range(1, 5)
+LIMIT_PROPERTIES = ["homo", "lumo", "gap"]
+# The version of the images in an ImageCache (see SQLiteCache)
+IMAGE_CACHE_VERSION = 1
+# The most images that are kept in an ImageCache
+IMAGE_CACHE_SIZE = 5000
+
 
 def cache(f):
     @functools.wraps(f)
@@ -28,6 +43,40 @@ def cache(f):
     return wrapper
 
 
+class ImageCache(SQLiteCache):
+    '''An sqlite file of drawn molecule images keyed by
+    Molecule.get_image_key.'''
+    NAME = "image cache"
+    TABLE = "images"
+    SCHEMA = (
+        ("CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, "
+         "data BLOB, accessed REAL)", ()),
+        ("CREATE INDEX IF NOT EXISTS images_accessed ON images "
+         "(accessed)", ()),
+    )
+
+    def __init__(self, path, maxsize=IMAGE_CACHE_SIZE):
+        super(ImageCache, self).__init__(path, maxsize)
+
+    def get(self, key):
+        '''Returns the cached image or None if there is not one.'''
+        rows = self.execute(("SELECT data FROM images WHERE key = ?", (key, )))
+        if not rows:
+            self.misses += 1
+            return None
+
+        self.touch("key = ?", (key, ))
+        self.hits += 1
+        return str(rows[0][0])
+
+    def set(self, key, data):
+        self.execute(
+            ("INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+             (key, sqlite3.Binary(data), time.time())),
+            self.get_evict_query(),
+        )
+
+
 class Molecule(object):
 
     def __init__(self, name, **kwargs):
@@ -97,10 +146,49 @@ class Molecule(object):
         body = self.structure.mol2
         return header + body
 
-    def get_png(self, scale=None):
+    def get_canonical_name(self):
+        '''Returns a name that is the same for all molecules with the same
+        structure, or None if there is not one.'''
+        return None
+
+    def get_image_key(self, scale=None, svg=False, hydrogens=True,
+                      colors=True):
+        '''Returns a key that is unique to the image of the molecule drawn
+        with these options, or None if the image can not be cached.'''
+        name = self.get_canonical_name()
+        if name is None:
+            return None
         if scale is None:
             scale = self.scale
-        return self.structure.draw(scale).getvalue()
+        parts = [IMAGE_CACHE_VERSION, name, float(scale),
+                 "svg" if svg else "png", bool(hydrogens), bool(colors)]
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get_image(self, scale=None, svg=False, hydrogens=True, colors=True,
+                  cache=None):
+        '''Returns the drawn image of the molecule. If an ImageCache is
+        given, the image is only drawn if it is not already in it.'''
+        if scale is None:
+            scale = self.scale
+        key = None
+        if cache is not None:
+            key = self.get_image_key(scale, svg=svg, hydrogens=hydrogens,
+                                     colors=colors)
+        if key is not None:
+            data = cache.get(key)
+            if data is not None:
+                return data
+
+        f = self.structure.draw(scale, svg=svg, hydrogens=hydrogens,
+                                colors=colors)
+        data = f.getvalue()
+        if key is not None:
+            cache.set(key, data)
+        return data
+
+    def get_png(self, scale=None, hydrogens=True, colors=True, cache=None):
+        return self.get_image(scale, hydrogens=hydrogens, colors=colors,
+                              cache=cache)
 
     def get_png_data_url(self, scale=None):
         if scale is None:
@@ -108,10 +196,9 @@ class Molecule(object):
         string = "data:image/png;base64,"
         return string + base64.b64encode(self.get_png(scale))
 
-    def get_svg(self, scale=None):
-        if scale is None:
-            scale = self.scale
-        return self.structure.draw(scale, svg=True).getvalue()
+    def get_svg(self, scale=None, hydrogens=True, colors=True, cache=None):
+        return self.get_image(scale, svg=True, hydrogens=hydrogens,
+                              colors=colors, cache=cache)
 
     def get_svg_data_url(self, scale=None):
         if scale is None:
@@ -137,8 +224,6 @@ class NamedMolecule(Molecule):
         super(NamedMolecule, self).__init__(name, **kwargs)
         if kwargs.get("autoflip"):
             self.name = autoflip_name(name)
-        self._exact_name = None
-        self._name_error = None
 
     @property
     @cache
@@ -148,26 +233,30 @@ class NamedMolecule(Molecule):
             struct.perturb(delta=self.perturb)
         return struct
 
-    def get_exact_name(self, spacers=False):
-        if self._exact_name is None:
-            try:
-                self._exact_name = get_exact_name(self.name, spacers=True)
-            except Exception as e:
-                self._name_error = str(e)
-                self._exact_name = ''
+    def get_name_info(self):
+        return analyze_name(self.name)
 
+    def get_exact_name(self, spacers=False):
+        info = self.get_name_info()
+        if info.exact_name is None:
+            return ''
         if spacers:
-            return self._exact_name
+            return info.exact_name_spacers
         else:
-            return self._exact_name.replace('*', '')
+            return info.exact_name
+
+    def get_canonical_name(self):
+        if self.perturb:
+            return None
+        return self.get_exact_name(spacers=True) or None
 
-    @cache
     def get_structure_type(self):
-        return get_structure_type(self.name)
+        return self.get_name_info().structure_type
 
     def get_name_error(self):
-        self.get_exact_name()
-        return self._name_error
+        error = self.get_name_info().error
+        if error is not None:
+            return str(error)
 
     @cache
     def get_binary_feature_vector(self, **kwargs):
@@ -196,51 +285,11 @@ class NamedMolecule(Molecule):
 
     @cache
     def get_property_predictions(self):
-        try:
-            feature = [self.get_decay_feature_vector()]
-            results = get_properties_from_decay_with_predictions(feature)
-        except ValueError as e:
-            logger.info("Property prediction error: %s" % e)
-            results = {}
-        return results
+        return predict_molecules([self], limits=False)[0][0]
 
     @cache
     def get_property_limits(self):
-        results = {
-            "n": [None, None, None],
-            "m": [None, None, None]
-        }
-        use = ["homo", "lumo", "gap"]
-        for direction in results:
-            try:
-                groups = []
-                xvals = range(1, 5)
-                for j in xvals:
-                    if direction in self.name:
-                        expr = "%s\d+" % direction
-                        replace = "%s%d" % (direction, j)
-                        temp_name = re.sub(expr, replace, self.name)
-                    else:
-                        temp_name = self.name + "_%s%d" % (direction, j)
-                    struct = NamedMolecule(temp_name)
-                    properties = struct.get_property_predictions()
-                    groups.append([x.value for x in properties if x.short in use])
-
-                lim_results = dataparser.predict_values(xvals, *zip(*groups))
-
-                results[direction] = []
-                for prop in properties:
-                    try:
-                        x = lim_results[prop.short][0]
-                    except KeyError:
-                        x = None
-                    results[direction].append(x)
-
-            except (KeyError, TypeError):
-                logger.info("Improper property limits: %s - %s" %
-                            (self.name, direction))
-                pass
-        return results
+        return predict_molecules([self])[0][1]
 
     def get_info(self):
         features = {
@@ -257,3 +306,79 @@ class NamedMolecule(Molecule):
             "name_error": self.get_name_error(),
             "structure_type": self.get_structure_type(),
         }
+
+
+def get_limit_name(name, direction, j):
+    if direction in name:
+        expr = "%s\d+" % direction
+        replace = "%s%d" % (direction, j)
+        return re.sub(expr, replace, name)
+    else:
+        return name + "_%s%d" % (direction, j)
+
+
+def predict_molecules(molecules, limits=True):
+    '''Returns a list with the property predictions and the n/m property
+    limits of each NamedMolecule. The molecules, and the limit variants that
+    the limits are extrapolated from, are all predicted with one call to the
+    model.'''
+    groups = []
+    for mol in molecules:
+        variants = {}
+        if limits:
+            for direction in LIMIT_DIRECTIONS:
+                names = [get_limit_name(mol.name, direction, j)
+                         for j in LIMIT_XVALS]
+                variants[direction] = [NamedMolecule(x) for x in names]
+        groups.append((mol, variants))
+
+    exact_names = collections.OrderedDict.fromkeys(
+        x.get_exact_name(spacers=True)
+        for mol, variants in groups
+        for x in [mol] + sum(variants.values(), [])).keys()
+    errors = []
+    features = get_decay_feature_matrix(exact_names, errors=errors)
+    invalid = set(i for i, _ in errors)
+    rows = [i for i in xrange(len(exact_names)) if i not in invalid]
+
+    predictions = {}
+    if rows:
+        try:
+            values = predict_properties(features[rows])
+            predictions = dict(zip([exact_names[i] for i in rows], values))
+        except ValueError as e:
+            logger.info("Property prediction error: %s" % e)
+
+    def get_predictions(mol):
+        return predictions.get(mol.get_exact_name(spacers=True), {})
+
+    results = []
+    for mol, variants in groups:
+        mol_limits = {}
+        for direction in LIMIT_DIRECTIONS:
+            mol_limits[direction] = [None, None, None]
+            if direction not in variants:
+                continue
+            try:
+                values = []
+                for variant in variants[direction]:
+                    properties = get_predictions(variant)
+                    values.append([x.value for x in properties
+                                   if x.short in LIMIT_PROPERTIES])
+
+                lim_results = dataparser.predict_values(LIMIT_XVALS,
+                                                        *zip(*values))
+
+                mol_limits[direction] = []
+                for prop in properties:
+                    try:
+                        x = lim_results[prop.short][0]
+                    except KeyError:
+                        x = None
+                    mol_limits[direction].append(x)
+
+            except (KeyError, TypeError):
+                logger.info("Improper property limits: %s - %s" %
+                            (mol.name, direction))
+        results.append((get_predictions(mol), mol_limits))
+    return results
@@ -1,4 +1,5 @@
 import logging
+from collections import deque, defaultdict
 
 from constants import CORE_COMBO, CORE_FREE
 
@@ -6,149 +7,178 @@ from constants import CORE_COMBO, CORE_FREE
 logger = logging.getLogger(__name__)
 
 
-class Tree(object):
+class Graph(object):
+    '''The bonds of a structure as adjacency lists (from its cached
+    Connectivity). The atoms are referred to by their position in
+    structure.atoms (their id - 1).'''
 
-    def __init__(self, value, parent=None):
-        self.parent = parent
-        self.value = value
-        self.children = []
+    def __init__(self, structure):
+        self.atoms = list(structure.atoms)
+        self.neighbors = structure.adjacency.neighbor_lists()
 
-    def add(self, value):
-        new = Tree(value, parent=self)
-        self.children.append(new)
-        return new
+    def __len__(self):
+        return len(self.atoms)
 
-    def search(self):
-        if self.parent is not None:
-            parent_value = self.parent.value
-        else:
-            parent_value = None
-
-        atoms = []
-        for bond in self.value.bonds:
-            for atom in bond.atoms:
-                if atom != self.value and atom != parent_value:
-                    node = self.add(atom)
-                    atoms.append(node)
-        return atoms
-
-    def get_common_parent(self, node):
-        if self == node:
-            return self.parent
-
-        visited = []
-        nodes = [self, node]
-        i = 0
-        while nodes[0] != nodes[1]:
-            if nodes[i] in visited:
-                break
-            if nodes[i].parent is not None:
-                visited.append(nodes[i])
-                nodes[i] = nodes[i].parent
-            i = (i + 1) % 2
-
-        parent = nodes[i]
-        return parent
-
-    def get_common_set(self, parent, node):
-        nodes = [self]
-        while nodes[-1].parent != parent:
-            nodes.append(nodes[-1].parent)
-
-        temp_nodes = [node]
-        while temp_nodes[-1].parent != parent:
-            temp_nodes.append(temp_nodes[-1].parent)
-
-        return nodes + [parent] + temp_nodes[::-1]
-
-    def __str__(self, level=0):
-        ret = "    " * level + str((self.value.id, self.value.element)) + '\n'
-        for child in self.children:
-            ret += child.__str__(level + 1)
-        return ret
+    def element(self, i):
+        return self.atoms[i].element
 
+    def count_hydrogens(self, i):
+        return sum(1 for j in self.neighbors[i] if self.element(j) == "H")
 
-def breadth_first_search(structure):
-    point = structure.atoms[0]
-    tree = Tree(point)
-    visited = [tree.value]
-    points = tree.search()
 
-    links = []
+def breadth_first_search(graph, start, ignore=()):
+    '''Yields the (atom, distance) of each of the atoms that can be reached
+    from start without going through any of the atoms in ignore.'''
+    visited = [False] * len(graph)
+    for i in ignore:
+        visited[i] = True
+    visited[start] = True
+    points = deque([(start, 0)])
     while points:
-        point = points.pop(0)
-        if point.value not in visited:
-            visited.append(point.value)
-            points.extend(point.search())
-        else:
-            link = sorted(
-                [point.value, point.parent.value], key=lambda x: x.id)
-            links.append((link, point))
-    return links, tree
-
-
-def graph_distance(start, end):
-    point = start
-    tree = Tree(point)
-    visited = {tree.value: 0}
-    points = tree.search()
-
-    while points:
-        point = points.pop(0)
-        if point.value not in visited:
-            parent = point.parent.value
-            visited[point.value] = visited[parent] + 1
-            points.extend(point.search())
-        if point.value is end:
-            return visited[point.value]
+        i, distance = points.popleft()
+        yield i, distance
+        for j in graph.neighbors[i]:
+            if not visited[j]:
+                visited[j] = True
+                points.append((j, distance + 1))
+
+
+def graph_distance(graph, start, end):
+    for i, distance in breadth_first_search(graph, start):
+        if i == end:
+            return distance
     return None
 
 
-def print_links(links):
-    return [[(f.id, f.element) for f in x] for x, y in links]
-
-
-def get_cycles(links, tree):
-    sorted_links = sorted(links, key=lambda y: [x.id for x in y[0]])
-    cycles = []
-    link_nodes = []
-    for i in xrange(len(sorted_links) / 2):
-        first = sorted_links[2 * i][1].parent
-        second = sorted_links[2 * i + 1][1].parent
-        link_nodes.extend([first, second])
-
-        parent = first.get_common_parent(second)
-        common_set = first.get_common_set(parent, second)
-        temp = [x for x in common_set]
-        cycles.append(temp)
-    return cycles, link_nodes
-
-
-def prune_cycles(cycles, link_nodes):
-    link_set = set(link_nodes)
-    final = []
-    for cycle in cycles:
-        temp = [x in link_set for x in cycle]
-        if sum(temp) <= 2:
-            final.append(cycle)
+def get_ring_systems(graph):
+    '''Returns the bonds of each of the biconnected components of the graph
+    that have rings in them. Every ring is inside one of these, so they can
+    be searched for rings separately.'''
+    depth = [-1] * len(graph)
+    low = [0] * len(graph)
+    systems = []
+    bonds = []
+    for root in xrange(len(graph)):
+        if depth[root] != -1:
             continue
-        if sum(temp) == 3:
-            logger.warning("Something is not right")
+        depth[root] = 0
+        stack = [(root, -1, iter(graph.neighbors[root]))]
+        while stack:
+            i, parent, children = stack[-1]
+            for j in children:
+                if j == parent:
+                    continue
+                if depth[j] == -1:
+                    depth[j] = low[j] = depth[i] + 1
+                    bonds.append((i, j))
+                    stack.append((j, i, iter(graph.neighbors[j])))
+                    break
+                elif depth[j] < depth[i]:
+                    low[i] = min(low[i], depth[j])
+                    bonds.append((i, j))
+            else:
+                stack.pop()
+                if not stack:
+                    continue
+                parent = stack[-1][0]
+                low[parent] = min(low[parent], low[i])
+                if low[i] >= depth[parent]:
+                    # Everything since the bond to i is one component
+                    system = []
+                    while not system or system[-1] != (parent, i):
+                        system.append(bonds.pop())
+                    # A single bond (a bridge) can not be part of a ring
+                    if len(system) > 1:
+                        systems.append(system)
+    return systems
+
+
+def order_ring(ring):
+    '''Rotates and orients a ring so that it starts at its lowest atom and
+    goes towards the lower of that atom's neighbors.'''
+    i = ring.index(min(ring))
+    ring = ring[i:] + ring[:i]
+    if ring[-1] < ring[1]:
+        ring = ring[:1] + ring[:0:-1]
+    return ring
+
+
+def get_system_rings(bonds):
+    '''Returns the smallest set of smallest rings of a ring system. The
+    candidates are the cycles made from the shortest paths from each atom to
+    both ends of each bond (Horton), and the shortest of these that are
+    linearly independent (as sets of bonds) are used.'''
+    bits = {}
+    neighbors = defaultdict(list)
+    for k, (i, j) in enumerate(bonds):
+        bits[i, j] = bits[j, i] = 1 << k
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    count = len(bonds) - len(neighbors) + 1
+
+    candidates = {}
+    for root in neighbors:
+        parents = {root: None}
+        points = deque([root])
+        while points:
+            i = points.popleft()
+            for j in neighbors[i]:
+                if j not in parents:
+                    parents[j] = i
+                    points.append(j)
+
+        paths = {root: ([root], 0)}
+        for i in parents:
+            path = [i]
+            value = 0
+            while path[-1] not in paths:
+                parent = parents[path[-1]]
+                value ^= bits[path[-1], parent]
+                path.append(parent)
+            rest, rest_value = paths[path.pop()]
+            paths[i] = (path + rest, value ^ rest_value)
+
+        for i, j in bonds:
+            if parents[i] == j or parents[j] == i:
+                continue
+            path1, value1 = paths[i]
+            path2, value2 = paths[j]
+            if set(path1[:-1]) & set(path2[:-1]):
+                continue
+            value = value1 ^ value2 ^ bits[i, j]
+            if value not in candidates:
+                ring = path1[::-1] + path2[:-1]
+                candidates[value] = order_ring(ring)
+
+    basis = {}
+    rings = []
+    ordered = sorted(candidates.items(), key=lambda x: (len(x[1]), x[1]))
+    for value, ring in ordered:
+        while value:
+            pivot = value.bit_length() - 1
+            if pivot not in basis:
+                basis[pivot] = value
+                rings.append(ring)
+                break
+            value ^= basis[pivot]
+        if len(rings) == count:
+            break
+    return rings
+
 
-        # [Link1, 0, Link2, 1, 2, Link2, Link1]
-        # goes to [Link1, 0, Link2, Link2, Link1]
-        start = temp.index(True, 1) + 1     # +1 include the second True value
-        # Hack to fix the issue with 3 link atoms listed
-        start -= sum(temp) % 2
-        end = temp[::-1].index(True, 1) + 1
-        final.append(cycle[:start] + cycle[-end:])
-    return final
+def get_rings(graph):
+    '''Returns the smallest set of smallest rings of the graph. Each ring is
+    a list of the atoms in the order they are bonded.'''
+    rings = []
+    for bonds in get_ring_systems(graph):
+        rings.extend(get_system_rings(bonds))
+    return sorted(rings)
 
 
-def get_noncycles(structure, cycles):
-    cycle_set = set(sum([[y.value for y in x] for x in cycles], []))
+def get_noncycles(graph, cycles):
+    cycle_set = set(graph.atoms[i] for cycle in cycles for i in cycle)
     noncycles = {}
-    for atom in structure.atoms:
+    for atom in graph.atoms:
         if atom not in cycle_set:
             noncycles[atom] = []
         for bond in atom.bonds:
@@ -183,30 +213,30 @@ def identify_noncycle_types(noncycles):
 
 
 def get_fused_cycles(cycles):
-    cycle_sets = [set([x.value.id for x in y]) for y in cycles]
-    sets = []
-    used = []
-    notused = []
-    for i, cycle1 in enumerate(cycle_sets):
-        temp = [i]
-        if i in used:
+    '''Groups the cycles that share atoms with each other.'''
+    atom_cycles = defaultdict(list)
+    for i, cycle in enumerate(cycles):
+        for atom in cycle:
+            atom_cycles[atom].append(i)
+
+    groups = []
+    used = [False] * len(cycles)
+    for i in xrange(len(cycles)):
+        if used[i]:
             continue
-        full_cycle = cycle1
-        for j, cycle2 in enumerate(cycle_sets):
-            if i >= j:
-                continue
-            if full_cycle & cycle2:
-                full_cycle |= cycle2
-                temp.append(j)
-        if len(temp) > 1:
-            sets.append(temp)
-            used.extend(temp)
-        else:
-            notused.append(i)
-
-    temp1 = [[cycles[x] for x in y] for y in sets]
-    temp2 = [[cycles[x]] for x in notused]
-    return temp1 + temp2
+        used[i] = True
+        group = [i]
+        points = deque([i])
+        while points:
+            j = points.popleft()
+            for atom in cycles[j]:
+                for k in atom_cycles[atom]:
+                    if not used[k]:
+                        used[k] = True
+                        group.append(k)
+                        points.append(k)
+        groups.append([cycles[x] for x in group])
+    return groups
 
 
 def sort_fused_cycles(cycles):
@@ -217,33 +247,35 @@ def sort_fused_cycles(cycles):
             continue
 
         # max of three rings, maybe generallize later
-        sets = [set([x.value.id for x in ring]) for ring in fused_cycle]
+        sets = [set(ring) for ring in fused_cycle]
 
         if len(sets) == 2:
             if len(sets[0]) >= len(sets[1]):
                 ordering = [0, 1]
             else:
                 ordering = [1, 0]
+        elif len(sets) == 3:
+            # The ring that is fused to both of the others goes in the middle
+            ordering = [0, 1, 2]
+            for i in xrange(3):
+                others = [x for x in xrange(3) if x != i]
+                if all(sets[i] & sets[x] for x in others):
+                    ordering = [others[0], i, others[1]]
+                    break
         else:
-            if not (sets[0] & sets[1]):
-                ordering = [0, 2, 1]
-            else:
-                if len(sets[0]) == len(sets[2]):
-                    ordering = [0, 1, 2]
-                else:
-                    ordering = [2, 0, 1]
+            ordering = range(len(sets))
         temp = [fused_cycle[i] for i in ordering]
         sorted_cycles.append(temp)
     return sorted_cycles
 
 
-def identify_cycle_types(structure, cycles):
+def identify_cycle_types(graph, cycles):
     types = []
     for cycle_group in cycles:
         lengths = [len(x) for x in cycle_group]
         if len(lengths) == 3:
             if lengths == [5, 6, 5]:
-                core = identify_core(cycle_group)
+                core = identify_core(graph, cycle_group)
                 types.append(core)
             elif lengths == [6, 5, 6]:
                 types.append("7")
@@ -251,24 +283,23 @@ def identify_cycle_types(structure, cycles):
                 types.append("10")
         elif len(lengths) == 2:
             if lengths == [6, 5]:
-                core = identify_core(cycle_group)
+                core = identify_core(graph, cycle_group)
                 types.append(core)
             else:
                 types.append("9")
         else:
-            ring_type = identify_single_ring(cycle_group[0])
+            ring_type = identify_single_ring(graph, cycle_group[0])
             types.append(ring_type)
     return types
 
 
-def identify_core(fused_cycle):
+def identify_core(graph, fused_cycle):
     pairs = []
     for ring in fused_cycle:
         temp = []
-        for node in ring:
-            ele = node.value.element
-            children = [x for x in node.children if x.value.element == "H"]
-            temp.append((node.value, (ele, len(children))))
+        for atom in ring:
+            pair = (graph.element(atom), graph.count_hydrogens(atom))
+            temp.append((atom, pair))
         pairs.append(temp)
     if len(pairs) == 2:
         side, _ = identify_core_side(pairs[1])
@@ -276,7 +307,7 @@ def identify_core(fused_cycle):
     else:
         side1, name_atoms1 = identify_core_side(pairs[0])
         side2, name_atoms2 = identify_core_side(pairs[2])
-        dist = graph_distance(name_atoms1[0], name_atoms2[0])
+        dist = graph_distance(graph, name_atoms1[0], name_atoms2[0])
         if dist == 4:
             start = 'C'
         elif dist == 5:
@@ -308,8 +339,8 @@ def identify_core_side(pairs):
     return ''.join([x[0] for x in results]), name_atoms
 
 
-def identify_single_ring(ring):
-    elements = [x.value.element for x in ring]
+def identify_single_ring(graph, ring):
+    elements = [graph.element(x) for x in ring]
     ring_type = '4'
     if 'S' in elements:
         ring_type = '5'
@@ -329,15 +360,14 @@ def identify_single_ring(ring):
 def run_name(name):
     from chemtools import gjfwriter
     mol = gjfwriter.NamedMolecule(name).structure
-    links, tree = breadth_first_search(mol)
+    graph = Graph(mol)
 
-    cycles, link_nodes = get_cycles(links, tree)
-    pruned_cycles = prune_cycles(cycles, link_nodes)
-    fused = get_fused_cycles(pruned_cycles)
+    cycles = get_rings(graph)
+    fused = get_fused_cycles(cycles)
     sorted_cycles = sort_fused_cycles(fused)
-    temp = identify_cycle_types(mol, sorted_cycles)
+    temp = identify_cycle_types(graph, sorted_cycles)
 
-    noncycles = get_noncycles(mol, pruned_cycles)
+    noncycles = get_noncycles(graph, cycles)
     pruned_noncycles = prune_noncycles(noncycles)
     temp2 = identify_noncycle_types(pruned_noncycles)
     return set(temp + temp2)
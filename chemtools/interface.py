@@ -1,77 +1,150 @@
 import os
 import re
-from cStringIO import StringIO
-import zipfile
+from itertools import izip
+import multiprocessing
 import logging
 
 import gjfwriter
 import mol_name
 import dataparser
 import ml
+from fileparser import get_pool
 from data.models import JobTemplate
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_multi_molecule(molecules, options, mol_form, job_form):
-    buff = StringIO()
-    zfile = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
-    mol_settings = dict(mol_form.cleaned_data)
-
-    generrors = []
+# Zips of fewer molecules than this are built without the worker pool
+POOL_MIN_MOLECULES = 16
+# Seconds to wait for each molecule that is built in the worker pool
+POOL_TIMEOUT = 60
+# The scale of the images in the zips
+ZIP_IMAGE_SCALE = 10
+
+MOLECULE_FILES = {
+    ".png": lambda out: out.get_png(ZIP_IMAGE_SCALE),
+    ".mol2": lambda out: out.get_mol2(),
+    ".gjf": lambda out: out.get_gjf(),
+}
+
+
+def get_molecule_files(job):
+    '''Builds the files of a (name, extensions, mol_settings) job, in a
+    worker, and returns the (extension, data) pairs that were made along with
+    the error that stopped the rest, if there was one.'''
+    name, extensions, mol_settings = job
+    files = []
+    try:
+        out = gjfwriter.NamedMolecule(name, **mol_settings)
+        for ext in extensions:
+            files.append((ext, MOLECULE_FILES[ext](out)))
+    except Exception as e:
+        return files, "%s" % e
+    return files, None
+
+
+def get_chunk_files(jobs):
+    return [get_molecule_files(x) for x in jobs]
+
+
+def map_molecule_files(jobs, pool=False):
+    '''Yields get_molecule_files of each of the jobs. The worker pool is
+    only used if pool is set. That must not be done in the threaded web
+    process, where the fork could copy locks that are held by other threads
+    into the workers.'''
+    if not pool or len(jobs) < POOL_MIN_MOLECULES:
+        return (get_molecule_files(x) for x in jobs)
+    # The chunks are made here because the results of a chunked imap can
+    # not be waited on with a timeout
+    chunksize = max(1, len(jobs) // (4 * multiprocessing.cpu_count()))
+    chunks = [jobs[i:i + chunksize] for i in xrange(0, len(jobs), chunksize)]
+    results = get_pool().imap(get_chunk_files, chunks)
+    return (x for chunk in chunks
+            for x in results.next(POOL_TIMEOUT * len(chunk)))
+
+
+def get_job_data(job_settings, name):
+    '''Returns the job settings of the molecule name.'''
+    d = dict(job_settings)
+    d["name"] = re.sub(r"{{\s*name\s*}}", name, d["name"])
+    return d
+
+
+def get_multi_molecule(molecules, options, mol_settings, job_settings=None,
+                       cache=None, pool=False):
+    '''Yields the (filename, data) zip entries of the files of the molecules.
+    The entries of each structure are given as soon as it is built, so they
+    never all have to be in memory. If pool is set, the structures are built
+    in the worker pool (see map_molecule_files).'''
+
+    steps = [".png", ".mol2", ".job"]
+    steps = [x for x, y in zip(steps, ["image", "mol2", "job"]) if y in options]
+    if "gjf" in options or not steps:
+        steps.append(".gjf")
+
+    entries = []
+    jobs = []
     for name in molecules:
-        try:
-            dnew = job_form.get_single_data(name)
+        if job_settings is not None:
+            dnew = get_job_data(job_settings, name)
             mol_name = dnew['name']
-        except AttributeError:
+        else:
+            dnew = None
             mol_name = name
 
-        try:
+        files = {}
+        key = None
+        if ".png" in steps and cache is not None:
             out = gjfwriter.NamedMolecule(name, **mol_settings)
-            others = False
-
-            if "image" in options:
-                zfile.writestr(mol_name + ".png", out.get_png(10))
-                others = True
-            if "mol2" in options:
-                zfile.writestr(mol_name + ".mol2", out.get_mol2())
-                others = True
-            if "job" in options:
-                zfile.writestr(mol_name + ".job", JobTemplate.render(**dnew))
-                others = True
-
-            if "gjf" in options or not others:
-                zfile.writestr(mol_name + ".gjf", out.get_gjf())
+            key = out.get_image_key(ZIP_IMAGE_SCALE)
+            if key is not None:
+                image = cache.get(key)
+                if image is not None:
+                    files[".png"] = image
+        extensions = [x for x in steps if x != ".job" and x not in files]
+        entries.append((name, mol_name, dnew, files, key))
+        jobs.append((name, extensions, mol_settings))
 
+    generrors = []
+    results = map_molecule_files(jobs, pool=pool)
+    for (name, mol_name, dnew, files, key), (new, error) in izip(entries,
+                                                                   results):
+        new = dict(new)
+        files.update(new)
+        if key is not None and ".png" in new:
+            cache.set(key, new[".png"])
+        try:
+            for ext in steps:
+                if ext == ".job":
+                    data = JobTemplate.render(**dnew)
+                elif ext in files:
+                    data = files[ext]
+                else:
+                    raise ValueError(error)
+                yield mol_name + ext, data
         except Exception as e:
             logger.warn("Multigen error: %s - %s" % (name, e))
             generrors.append("%s - %s" % (name, e))
     if generrors:
-        zfile.writestr("errors.txt", '\n'.join(generrors))
-
-    zfile.close()
-    buff.flush()
-
-    ret_zip = buff.getvalue()
-    buff.close()
-    return ret_zip
+        yield "errors.txt", '\n'.join(generrors)
 
 
 def get_multi_job(string, form):
-    buff = StringIO()
-    zfile = zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED)
-
+    '''Yields the (filename, data) zip entries of the job files of the
+    names.'''
+    generrors = []
     for name in mol_name.name_expansion(string):
         if not name:
             continue
         name, _ = os.path.splitext(name)
-        dnew = form.get_single_data(name)
-        zfile.writestr("%s.job" % dnew["name"], JobTemplate.render(**dnew))
-
-    zfile.close()
-    buff.flush()
-
-    ret_zip = buff.getvalue()
-    buff.close()
-    return ret_zip
+        try:
+            dnew = form.get_single_data(name)
+            data = JobTemplate.render(**dnew)
+        except Exception as e:
+            logger.warn("Multijob error: %s - %s" % (name, e))
+            generrors.append("%s - %s" % (name, e))
+            continue
+        yield "%s.job" % dnew["name"], data
+    if generrors:
+        yield "errors.txt", '\n'.join(generrors)
@@ -0,0 +1,117 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chemtools.structure import from_name
+from chemtools.fileparser import Log
+
+
+ID_NAMES = [
+    "4a_TON_x1",
+    "4a_TON_x2",
+    "4a_TON_x4",
+    "4a_TON_x4_y2",
+    "4a_TON_x4_y4",
+    "4a_TON_x4_y4_z2",
+    "4a_TON_x4_y4_z5",
+]
+
+LOG_NAMES = [
+    "A_TON_A_A.log",
+    "A_TON_A_A_TD.log",
+    "A_CON_A_A_TDDFT.log",
+    "crazy.log",
+    "1_04_0.log",
+    "transform.log",
+]
+
+
+def timeit(func, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        total = time.time() - start
+        if best is None or total < best:
+            best = total
+    return best
+
+
+def write_structure(struct):
+    struct.gjf
+    struct.mol2
+    struct.json
+
+
+def use_list_scans(struct):
+    '''Swaps the indexed atom and bond lists for plain lists so that the ids
+    fall back to list.index scans.'''
+    atoms = list(struct.atoms)
+    bonds = list(struct.bonds)
+    for atom in atoms:
+        atom.parent = atoms
+    for bond in bonds:
+        bond.parent = bonds
+    struct.atoms = atoms
+    struct.bonds = bonds
+
+
+def benchmark_ids(stdout, names=ID_NAMES):
+    stdout.write("Writing gjf/mol2/json (seconds)\n")
+    stdout.write("%8s %8s %10s %10s %8s\n" %
+                 ("atoms", "bonds", "scan", "indexed", "speedup"))
+    for name in names:
+        struct = from_name(name)
+        indexed = timeit(lambda: write_structure(struct))
+        use_list_scans(struct)
+        scan = timeit(lambda: write_structure(struct))
+        stdout.write("%8d %8d %10.4f %10.4f %8.1f\n" %
+                     (len(struct.atoms), len(struct.bonds), scan, indexed,
+                      scan / indexed))
+
+
+class ScanLog(Log):
+    '''A Log that passes every line to every parser instead of only to the
+    parsers that are waiting for it.'''
+
+    def parse_line(self, line, parsers):
+        for parser in parsers.values():
+            parser.parse(line)
+        self.prevline = line.strip()
+
+
+def benchmark_parsing(stdout, names=LOG_NAMES):
+    stdout.write("Parsing Gaussian logs (seconds)\n")
+    stdout.write("%-22s %8s %10s %10s %8s\n" %
+                 ("log", "lines", "scan", "dispatch", "speedup"))
+    for name in names:
+        path = os.path.join(settings.MEDIA_ROOT, "tests", name)
+        with open(path, 'r') as f:
+            lines = sum(1 for x in f)
+        dispatch = timeit(lambda: Log(path))
+        scan = timeit(lambda: ScanLog(path))
+        if Log(path).format_data() != ScanLog(path).format_data():
+            raise CommandError("Parsed values differ: %s" % name)
+        stdout.write("%-22s %8d %10.4f %10.4f %8.1f\n" %
+                     (name, lines, scan, dispatch, scan / dispatch))
+
+
+BENCHMARKS = {
+    "ids": benchmark_ids,
+    "parsing": benchmark_parsing,
+}
+
+
+class Command(BaseCommand):
+    args = 'name [name ...]'
+    help = 'Run performance benchmarks (%s)' % ', '.join(sorted(BENCHMARKS))
+
+    def handle(self, *args, **options):
+        names = args or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: '%s'" % name)
+        for name in names:
+            BENCHMARKS[name](self.stdout)
@@ -14,6 +14,30 @@ ARYL = [x for x in ARYL if len(x) == 1]
 XGROUPS = XGROUPS[:-1]
 RGROUPS = RGROUPS[:-1]
 
+# The groups that each end feature column is for. Aryl and X groups are in
+# FIRST and r groups are in SECOND, which the decay features have twice (for
+# the first and second r group on each aryl group).
+FIRST = ARYL + XGROUPS
+SECOND = ['*'] + RGROUPS
+END_LENGTH = len(FIRST) + 2 * len(SECOND)
+ARYL_COLUMNS = dict((x, i) for i, x in enumerate(ARYL))
+FIRST_COLUMNS = dict((x, i) for i, x in enumerate(FIRST))
+SECOND_COLUMNS = dict((x, i) for i, x in enumerate(SECOND))
+BOTH_COLUMNS = dict((x, i) for i, x in enumerate(FIRST + SECOND))
+LAST_COLUMNS = dict((x, len(FIRST) + len(SECOND) + i)
+                    for i, x in enumerate(SECOND))
+# The core features are whether the core is a T core followed by the columns
+# of each part of the core in CORE_COMBO.
+CORE_LENGTH = 1 + sum(len(x) for x in CORE_COMBO)
+CORE_COLUMNS = [dict((x, 1 + sum(len(y) for y in CORE_COMBO[:i]) + j)
+                     for j, x in enumerate(base))
+                for i, base in enumerate(CORE_COMBO)]
+# The core, the three ends, the n, m, x, y, z values and the constant
+DECAY_LENGTH = CORE_LENGTH + 3 * END_LENGTH + 6
+# The (ratio matrix, shortest index) of the aryl group lengths, see
+# get_ratio_matrix
+RATIO_MATRIX = None
+
 
 class MultiStageRegression(object):
     def __init__(self, model=svm.SVR()):
@@ -79,91 +103,123 @@ def get_extra_features(n, m, x, y, z):
     return [int(group[1:]) for group in [n, m, x, y, z]]
 
 
+def get_column(columns, char):
+    try:
+        return columns[char]
+    except KeyError:
+        raise ValueError("%r is not a valid group" % char)
+
+
+def get_end_binary_columns(end, limit=4):
+    '''Returns the columns that are set for an end in the binary features,
+    the number of columns used, and the number of aryl/X groups.'''
+    end = end.replace('-', '')  # no support for flipping yet
+    columns = []
+    used = 0
+    count = 0
+    for char in end:
+        if char in FIRST_COLUMNS:
+            if count == limit:
+                break
+            count += 1
+            columns.append(used + FIRST_COLUMNS[char])
+            used += len(FIRST)
+        else:
+            columns.append(used + get_column(SECOND_COLUMNS, char))
+            used += len(SECOND)
+    return columns, used, count
+
+
 def get_end_binary(left, center, right, limit=4):
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    length = len(first) + 2 * len(second)
     endfeatures = []
     for end in [left, center, right]:
-        partfeatures = []
-        end = end.replace('-', '')  # no support for flipping yet
-        count = 0
-        for char in end:
-            base = second
-            if char in first:
-                if count == limit:
-                    break
-                count += 1
-                base = first
-            temp = [0] * len(base)
-            temp[base.index(char)] = 1
-            partfeatures.extend(temp)
-        partfeatures += [0] * length * (limit - count)
+        columns, used, count = get_end_binary_columns(end, limit=limit)
+        partfeatures = [0] * used
+        for i in columns:
+            partfeatures[i] = 1
+        partfeatures += [0] * END_LENGTH * (limit - count)
         endfeatures.extend(partfeatures)
     return endfeatures
 
 
-def get_end_decay(left, center, right, power=1, H=1, lacunarity=1):
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    both = first + 2 * second
-    length = len(both)
+def get_end_decay_columns(end):
+    '''Returns the (column, distance) of each group of an end in the decay
+    features, where the distance is which aryl group from the core it is
+    on.'''
+    end = end.replace('-', '')  # no support for flipping yet
+    columns = []
+    for i, char in enumerate(end):
+        if i % 3 == 2 and char in SECOND_COLUMNS:
+            idx = LAST_COLUMNS[char]
+        else:
+            idx = get_column(BOTH_COLUMNS, char)
+        columns.append((idx, i / 3 + 1))
+    return columns
+
+
+def get_end_decay_features(ends, get_columns, power=1, H=1, lacunarity=1):
     endfeatures = []
-    for end in [left, center, right]:
-        end = end.replace('-', '')  # no support for flipping yet
-
-        partfeatures = [0] * length
-        for i, char in enumerate(end):
-            count = i / 3
-            part = i % 3
-            idx = both.index(char)
-            if char in second and part == 2:
-                idx = both.index(char, idx + 1)
-            partfeatures[idx] += decay_function(count + 1, power=power,
+    for end in ends:
+        partfeatures = [0] * END_LENGTH
+        for idx, distance in get_columns(end):
+            partfeatures[idx] += decay_function(distance, power=power,
                                                 H=H, lacunarity=lacunarity)
         endfeatures.extend(partfeatures)
     return endfeatures
 
 
+def get_end_decay(left, center, right, power=1, H=1, lacunarity=1):
+    return get_end_decay_features([left, center, right],
+                                  get_end_decay_columns, power=power, H=H,
+                                  lacunarity=lacunarity)
+
+
+def get_ratio_matrix():
+    '''Returns the ratios of the lengths of the aryl groups to each other and
+    the index of the shortest one. These only depend on the fragment files,
+    so they are only found once.'''
+    global RATIO_MATRIX
+    if RATIO_MATRIX is None:
+        lengths = []
+        for name in ARYL:
+            struct = from_data(name)
+            atoms = [x.atoms[1] for x in struct.open_ends("~")]
+            lengths.append(norm(atoms[0].xyz - atoms[1].xyz))
+        lengths = numpy.array([lengths])
+        RATIO_MATRIX = (lengths / lengths.T, lengths.argmin())
+    return RATIO_MATRIX
+
+
+def get_end_decay_corrected_columns(end):
+    '''Returns the (column, distance) of each group of an end in the decay
+    features, where the distance is the length of the aryl groups up to it
+    relative to the shortest one.'''
+    ratio_matrix, minlen = get_ratio_matrix()
+    end = end.replace('-', '')  # no support for flipping yet
+
+    columns = []
+    arylparts = []
+    for i, char in enumerate(end):
+        if char in ARYL_COLUMNS:
+            arylparts.append(ARYL_COLUMNS[char])
+        if i % 3 == 2 and char in SECOND_COLUMNS:
+            idx = LAST_COLUMNS[char]  # go to the second rgroup
+        else:
+            idx = get_column(BOTH_COLUMNS, char)
+        if char in ARYL_COLUMNS:
+            distance = ratio_matrix[arylparts[-1], arylparts].sum()
+        elif arylparts:
+            distance = ratio_matrix[minlen, arylparts].sum()
+        else:
+            distance = 1
+        columns.append((idx, distance))
+    return columns
+
+
 def get_end_decay_corrected(left, center, right, power=1, H=1, lacunarity=1):
-    lengths = []
-    for name in ARYL:
-        struct = from_data(name)
-        atoms = [x.atoms[1] for x in struct.open_ends("~")]
-        lengths.append(norm(atoms[0].xyz - atoms[1].xyz))
-    lengths = numpy.array([lengths])
-    minlen = lengths.argmin()
-    ratio_matrix = lengths / lengths.T
-
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    both = first + 2 * second
-    length = len(both)
-    endfeatures = []
-    for end in [left, center, right]:
-        end = end.replace('-', '')  # no support for flipping yet
-
-        partfeatures = [0] * length
-        arylparts = []
-        for i, char in enumerate(end):
-            if char in ARYL:
-                arylparts.append(ARYL.index(char))
-            part = i % 3
-            idx = both.index(char)
-            if char in second and part == 2:
-                idx = both.index(char, idx + 1)  # go to the second rgroup
-            if char in ARYL:
-                distance = ratio_matrix[arylparts[-1], arylparts].sum()
-            elif char in XGROUPS + second:
-                if arylparts:
-                    distance = ratio_matrix[minlen, arylparts].sum()
-                else:
-                    distance = 1
-
-            partfeatures[
-                idx] += decay_function(distance, power=power, H=H, lacunarity=lacunarity)
-        endfeatures.extend(partfeatures)
-    return endfeatures
+    return get_end_decay_features([left, center, right],
+                                  get_end_decay_corrected_columns,
+                                  power=power, H=H, lacunarity=lacunarity)
 
 
 def get_binary_feature_vector(exactname, limit=4):
@@ -192,19 +248,110 @@ def get_decay_distance_correction_feature_vector(exactname, power=1, H=1, lacuna
     return corefeatures + endfeatures + extrafeatures + [1]
 
 
+def get_binary_feature_matrix(exactnames, limit=4):
+    '''Returns the binary features of the names as rows. This is not the
+    same layout as get_binary_feature_vector, which leaves out the columns of
+    any r groups that are missing so its length depends on the name. Here
+    each end always gets limit * END_LENGTH columns so that the rows line up,
+    which means a model has to be trained on these rows to use them.'''
+    exactnames = list(exactnames)
+    block = limit * END_LENGTH
+    X = numpy.zeros((len(exactnames), CORE_LENGTH + 3 * block + 6))
+    for i, exactname in enumerate(exactnames):
+        left, core, center, right, n, m, x, y, z = exactname.split('_')
+        X[i, :CORE_LENGTH] = get_core_features(core)
+        for j, end in enumerate([left, center, right]):
+            columns, _, _ = get_end_binary_columns(end, limit=limit)
+            X[i, [CORE_LENGTH + j * block + k for k in columns]] = 1
+        X[i, -6:-1] = get_extra_features(n, m, x, y, z)
+        X[i, -1] = 1
+    return X
+
+
+def get_decay_matrix(exactnames, get_columns, power=1, H=1, lacunarity=1,
+                     errors=None):
+    '''Returns the decay features of the names as rows, the same as the
+    vectors with the end columns given by get_columns. Only the columns that
+    are set for each name are found, using the *_COLUMNS maps, and then they
+    are filled in for all of the rows at once. If errors is a list, the
+    (index, error) of each name that is not valid is added to it and its row
+    is left as zeros instead of raising the ValueError.'''
+    exactnames = list(exactnames)
+    X = numpy.zeros((len(exactnames), DECAY_LENGTH))
+    rows, columns, values = [], [], []
+    end_rows, end_columns, distances = [], [], []
+    for i, exactname in enumerate(exactnames):
+        try:
+            left, core, center, right, n, m, x, y, z = exactname.split('_')
+            core_columns = [get_column(c, char)
+                            for c, char in zip(CORE_COLUMNS, core[1:])]
+            extras = get_extra_features(n, m, x, y, z)
+            ends = []
+            for j, end in enumerate([left, center, right]):
+                offset = CORE_LENGTH + j * END_LENGTH
+                ends.extend((offset + idx, distance)
+                            for idx, distance in get_columns(end))
+        except ValueError as e:
+            if errors is None:
+                raise
+            errors.append((i, e))
+            continue
+
+        if core[0] == "T":
+            core_columns.append(0)
+        rows.extend([i] * (len(core_columns) + len(extras) + 1))
+        columns.extend(core_columns)
+        columns.extend(xrange(DECAY_LENGTH - 6, DECAY_LENGTH))
+        values.extend([1] * len(core_columns) + extras + [1])
+        end_rows.extend([i] * len(ends))
+        end_columns.extend(x for x, _ in ends)
+        distances.extend(x for _, x in ends)
+
+    X[numpy.array(rows, dtype=int), numpy.array(columns, dtype=int)] = values
+    # A group can be in an end more than once, so its values have to add up
+    weights = decay_function(numpy.array(distances, dtype=float),
+                             power=power, H=H, lacunarity=lacunarity)
+    numpy.add.at(X, (numpy.array(end_rows, dtype=int),
+                     numpy.array(end_columns, dtype=int)), weights)
+    return X
+
+
+def get_decay_feature_matrix(exactnames, power=1, H=1, lacunarity=1,
+                             errors=None):
+    return get_decay_matrix(exactnames, get_end_decay_columns, power=power,
+                            H=H, lacunarity=lacunarity, errors=errors)
+
+
+def get_decay_distance_correction_feature_matrix(exactnames, power=1, H=1,
+                                                 lacunarity=1, errors=None):
+    return get_decay_matrix(exactnames, get_end_decay_corrected_columns,
+                            power=power, H=H, lacunarity=lacunarity,
+                            errors=errors)
+
+
 def decay_function(distance, power=1, H=1, lacunarity=1):
     return (lacunarity * (distance ** -H)) ** power
 
 
-def get_properties_from_decay_with_predictions(feature):
+Property = namedtuple("Property", ("title", "short", "units", "value",
+                                   "error"))
+
+
+def predict_properties(features):
+    '''Returns the predicted properties of each row of features. All of the
+    rows are predicted with a single call to the latest model.'''
     pred = Predictor.objects.latest()
     model = pred.get_predictors()
 
-    homo, lumo, gap = model.predict(feature)[0]
-    Property = namedtuple("Property", ("title", "short", "units", "value",
-                                       "error"))
-    return (
-        Property("HOMO", "homo", "eV", homo, pred.homo_error),
-        Property("LUMO", "lumo", "eV", lumo, pred.lumo_error),
-        Property("Excitation Energy", "gap", "eV", gap, pred.gap_error),
-    )
+    results = []
+    for homo, lumo, gap in model.predict(numpy.array(features)):
+        results.append((
+            Property("HOMO", "homo", "eV", homo, pred.homo_error),
+            Property("LUMO", "lumo", "eV", lumo, pred.lumo_error),
+            Property("Excitation Energy", "gap", "eV", gap, pred.gap_error),
+        ))
+    return results
+
+
+def get_properties_from_decay_with_predictions(feature):
+    return predict_properties(feature)[0]
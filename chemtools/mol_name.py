@@ -2,31 +2,134 @@ import re
 import itertools
 import collections
 import random
+import threading
 
 from constants import SCORES, DCORES, CORES, RGROUPS, XGROUPS, ARYL, ARYL0, \
     ARYL2, NEEDSPACE, TURNING, VALID_SIDE_TOKENS, BENZO_MULTI, BENZO_ONE, \
     BENZO_TWO, CHAIN, UNKNOWN
 
 
-def name_expansion(string, rand=None):
+class LRUCache(object):
+    '''A bounded mapping that drops the least recently used item once more
+    than maxsize items are stored. Lookups are counted as hits and misses so
+    the cache can be monitored.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+# Number of distinct names whose analysis is kept around. The same names get
+# parsed over and over by the views, the data loader and the structure code,
+# so the results are shared through these caches.
+NAME_CACHE_SIZE = 4096
+NAME_CACHE = LRUCache(NAME_CACHE_SIZE)
+TOKEN_CACHE = LRUCache(NAME_CACHE_SIZE)
+AUTOFLIP_CACHE = LRUCache(NAME_CACHE_SIZE)
+
+
+NameInfo = collections.namedtuple("NameInfo", [
+    "name",
+    "sets",
+    "nm",
+    "xyz",
+    "exact_name",
+    "exact_name_spacers",
+    "structure_type",
+    "error",
+])
+
+
+# Random expansions with at most this many names are picked from a shuffled
+# list of all of their indices. Larger ones draw the indices one at a time.
+EXPANSION_SHUFFLE_SIZE = 100000
+
+EXPANSION_VARIABLES = {
+    "SCORES":   ','.join(SCORES),
+    "DCORES":   ','.join(DCORES),
+    "CORES":    ','.join(CORES),
+    "RGROUPS":  ','.join(RGROUPS),
+    "XGROUPS":  ','.join(XGROUPS),
+    "ARYL":     ','.join(ARYL),
+    "ARYL0":    ','.join(ARYL0),
+    "ARYL2":    ','.join(ARYL2),
+}
+
+EXPANSION_OPERATIONS = {
+    "": lambda x: x,
+    "L": lambda x: x.lower(),
+    "U": lambda x: x.upper()
+}
+
+
+def _split_molecules(string):
+    count = 0
+    parts = ['']
+    for i, char in enumerate(string):
+        if char == "," and not count:
+            parts.append('')
+        else:
+            if char == "{":
+                count += 1
+            elif char == "}":
+                count -= 1
+            parts[-1] += char
+    assert not count
+    return parts
+
+
+def _get_expansion_parts(string):
+    '''Splits an expansion string into its comma separated parts. Each part
+    is a (static, groups) pair where static is the list of the text between
+    the braces and groups is the list of the choices for each brace group.'''
     braceparse = re.compile(r"""(\{[^\{\}]*\})""")
     varparse = re.compile(r"\$\w*")
 
-    variables = {
-        "SCORES":   ','.join(SCORES),
-        "DCORES":   ','.join(DCORES),
-        "CORES":    ','.join(CORES),
-        "RGROUPS":  ','.join(RGROUPS),
-        "XGROUPS":  ','.join(XGROUPS),
-        "ARYL":     ','.join(ARYL),
-        "ARYL0":    ','.join(ARYL0),
-        "ARYL2":    ','.join(ARYL2),
-    }
-
     def get_var(name):
         newname = name.group(0).lstrip("$")
         try:
-            x = variables[newname]
+            x = EXPANSION_VARIABLES[newname]
         except:
             try:
                 int(newname)  # internal variable
@@ -35,67 +138,107 @@ def name_expansion(string, rand=None):
                 x = ''
         return x
 
-    def split_molecules(string):
-        count = 0
-        parts = ['']
-        for i, char in enumerate(string):
-            if char == "," and not count:
-                parts.append('')
+    parts = []
+    for part in _split_molecules(string):
+        if set('{}').intersection(part):
+            split = re.split(braceparse, part)
+            swapped = [re.sub(varparse, get_var, x) for x in split]
+            # every other one has {}, remove them and split
+            groups = [x[1:-1].split(',') for x in swapped[1::2]]
+            parts.append((swapped[::2], groups))
+        else:
+            parts.append(([part], []))
+    return parts
+
+
+def _fill_groups(static, values):
+    currentvalues = []
+    for item in values:
+        if '$' in item:
+            split = item.strip('$').split('.')
+            num = int(split[0])
+            if len(split) > 1:
+                op = EXPANSION_OPERATIONS[split[1].upper()]
             else:
-                if char == "{":
-                    count += 1
-                elif char == "}":
-                    count -= 1
-                parts[-1] += char
-        assert not count
-        return parts
-
-    def expand(items):
-        swapped = [re.sub(varparse, get_var, x) for x in items]
-        withbrace = swapped[1::2]  # every other one has {}
-        withoutbrace = swapped[::2]
-
-        # remove {} from x and split
-        cleaned = [x[1:-1].split(',') for x in withbrace]
-        operations = {
-            "": lambda x: x,
-            "L": lambda x: x.lower(),
-            "U": lambda x: x.upper()
-        }
+                op = EXPANSION_OPERATIONS['']
+            item = op(currentvalues[num])
+        currentvalues.append(item)
+    return ''.join(sum(zip(static, currentvalues), ()) + (static[-1], ))
+
+
+def _get_part_size(groups):
+    return reduce(lambda x, y: x * len(y), groups, 1)
+
+
+def _get_indexed_name(parts, index):
+    '''Returns the name at position index of the full expansion without
+    generating any of the names before it.'''
+    for static, groups in parts:
+        size = _get_part_size(groups)
+        if index >= size:
+            index -= size
+            continue
+
+        values = []
+        for group in reversed(groups):
+            index, idx = divmod(index, len(group))
+            values.append(group[idx])
+        return _fill_groups(static, values[::-1])
+    raise IndexError("expansion index out of range")
+
+
+def name_expansion_count(string):
+    '''Returns the number of names that string expands to. This is computed
+    without expanding the names, so duplicate names are counted each time.'''
+    return sum(_get_part_size(groups)
+               for _, groups in _get_expansion_parts(string))
+
+
+def _get_random_indices(total):
+    '''Yields every index below total once, in a random order. total may be
+    too large for xrange, so the indices are drawn one at a time unless they
+    are few enough to shuffle.'''
+    if total <= EXPANSION_SHUFFLE_SIZE:
+        indices = range(total)
+        random.shuffle(indices)
+        for i in indices:
+            yield i
+        return
+
+    seen = set()
+    while len(seen) < total:
+        index = random.randrange(total)
+        if index not in seen:
+            seen.add(index)
+            yield index
 
-        out = []
-        for group in itertools.product(*cleaned):
-            currentvalues = []
-            for i, item in enumerate(group):
-                if '$' in item:
-                    split = item.strip('$').split('.')
-                    num = int(split[0])
-                    if len(split) > 1:
-                        op = operations[split[1].upper()]
-                    else:
-                        op = operations['']
-                    x = op(currentvalues[num])
-                else:
-                    x = group[i]
-                currentvalues.append(x)
-            out.append(currentvalues)
 
-        return [''.join(sum(zip(withoutbrace, y), ()) + (swapped[-1], ))
-                for y in out]
+def name_expansion(string, rand=None):
+    '''Lazily yields the unique names that string expands to.
 
-    braces = []
-    for part in split_molecules(string):
-        if set('{}').intersection(part):
-            split = re.split(braceparse, part)
-            braces.extend(expand(split))
-        else:
-            braces.append(part)
-    temp = collections.OrderedDict(zip(braces, itertools.repeat(True)))
+    If rand is given and smaller than the number of names, rand names are
+    picked at random from the expansion instead. If there are fewer than rand
+    unique names, all of them are given.
+    '''
+    parts = _get_expansion_parts(string)
+    total = sum(_get_part_size(groups) for _, groups in parts)
 
-    if rand is not None and rand < len(temp.keys()):
-        return random.sample(temp.keys(), rand)
+    if rand is not None and rand < total:
+        indices = _get_random_indices(total)
+        names = (_get_indexed_name(parts, i) for i in indices)
     else:
-        return temp.keys()
+        names = (_fill_groups(static, values)
+                 for static, groups in parts
+                 for values in itertools.product(*groups))
+
+    seen = set()
+    for name in names:
+        if rand is not None and len(seen) >= rand:
+            return
+        if name in seen:
+            continue
+        yield name
+        seen.add(name)
 
 
 def parse_options(parts):
@@ -132,6 +275,16 @@ def parse_cores(parts):
 
 
 def tokenize(string):
+    try:
+        return list(TOKEN_CACHE[string])
+    except KeyError:
+        pass
+    tokens = _tokenize(string)
+    TOKEN_CACHE[string] = tuple(tokens)
+    return tokens
+
+
+def _tokenize(string):
     rxgroups = ''.join(XGROUPS + RGROUPS)
     match = '(1?\d|\(-?\d+\)|-|[%s])' % rxgroups
     tokens = [x for x in re.split(match, string) if x and x != '_']
@@ -304,6 +457,13 @@ def parse_name(name):
         (1, 1, 1)
     )
     '''
+    info = analyze_name(name)
+    if info.sets is None:
+        raise info.error
+    return list(info.sets), info.nm, info.xyz
+
+
+def _parse_name(name):
     parts = name.split("_")
 
     parts, nm, xyz = parse_options(parts)
@@ -321,24 +481,22 @@ def parse_name(name):
 
         sides = get_sides(parts, core_idx)
 
-        parsedsides = tuple(parse_end_name(x) if x else None for x in sides)
+        parsedsides = tuple(tuple(parse_end_name(x)) if x else None
+                            for x in sides)
 
         check_sides(parsedsides, len(partsets), idx, nm)
         output.append((core, parsedsides))
 
     if len(output) > 1 and nm[1] > 1:
         raise Exception(8, "Can not do m expansion and have multiple cores")
-    return output, nm, xyz
+    return tuple(output), nm, xyz
 
 
 def get_structure_type(name):
-    try:
-        output, nm, xyz = parse_name(name)
-    except Exception as e:
-        # This will not return, but it is added for completeness
-        return UNKNOWN
-        # raise Exception(12, "Unknown structure type")
+    return analyze_name(name).structure_type
+
 
+def _get_structure_type(output):
     if len(output) > 1:
         structure_type = BENZO_MULTI
     elif output[0][0] is None:
@@ -351,7 +509,15 @@ def get_structure_type(name):
 
 
 def get_exact_name(name, spacers=False):
-    output, nm, xyz = parse_name(name)
+    info = analyze_name(name)
+    if info.exact_name is None:
+        raise info.error
+    if spacers:
+        return info.exact_name_spacers
+    return info.exact_name
+
+
+def _get_exact_name(output, nm, xyz, spacers=False):
     sidefuncs = (
         lambda num: num == 0 and nm[0] == 1,
         lambda num: nm[1] == 1,
@@ -419,6 +585,16 @@ def autoflip_end_name(name):
 
 
 def autoflip_name(name):
+    try:
+        return AUTOFLIP_CACHE[name]
+    except KeyError:
+        pass
+    value = _autoflip_name(name)
+    AUTOFLIP_CACHE[name] = value
+    return value
+
+
+def _autoflip_name(name):
     parts = name.split("_")
 
     parts, nm, xyz = parse_options(parts)
@@ -441,3 +617,45 @@ def autoflip_name(name):
         output.append('_'.join(temp))
 
     return '_'.join(output)
+
+
+def analyze_name(name):
+    '''Returns a NameInfo record with everything that is derived from parsing
+    a molecule name. The records are cached, so they must not be modified.
+
+    If the name can not be parsed, the fields that depend on the parse are
+    None, the structure type is UNKNOWN, and error holds the exception.
+    '''
+    try:
+        return NAME_CACHE[name]
+    except KeyError:
+        pass
+
+    sets = nm = xyz = exact_name = exact_name_spacers = error = None
+    structure_type = UNKNOWN
+    try:
+        sets, nm, xyz = _parse_name(name)
+        structure_type = _get_structure_type(sets)
+        exact_name_spacers = _get_exact_name(sets, nm, xyz, spacers=True)
+        exact_name = _get_exact_name(sets, nm, xyz)
+    except Exception as e:
+        error = e
+
+    info = NameInfo(name, sets, nm, xyz, exact_name, exact_name_spacers,
+                    structure_type, error)
+    NAME_CACHE[name] = info
+    return info
+
+
+def get_cache_stats():
+    '''Returns the hit/miss counters of the name caches.'''
+    return {
+        "names": NAME_CACHE.get_stats(),
+        "tokens": TOKEN_CACHE.get_stats(),
+        "autoflip": AUTOFLIP_CACHE.get_stats(),
+    }
+
+
+def clear_caches():
+    for cache in (NAME_CACHE, TOKEN_CACHE, AUTOFLIP_CACHE):
+        cache.clear()
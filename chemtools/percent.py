@@ -1,52 +1,60 @@
 import math
 import base64
+import itertools
+from collections import namedtuple
 
 import cairo
 import numpy
 
 from project.utils import StringIO
-from graph import get_cycles, prune_cycles, get_fused_cycles, sort_fused_cycles, identify_core
-from graph import Tree, breadth_first_search, graph_distance
-from utils import calculate_bonds
-from structure import from_xyz
+from graph import Graph, get_rings, get_fused_cycles, sort_fused_cycles, identify_core
+from graph import breadth_first_search
+from utils import get_bonds
+from structure import Structure
+from fileparser import LogReader, LogCache
 
 
-def bfs_fill(start, ignore):
-    tree = Tree(start)
-    visited = [tree.value]
-    visited.extend(ignore)
+# The version of the orbital percents in a LogCache (see SQLiteCache)
+PERCENT_VERSION = 1
+# The width of the numbers in the orbital coefficient blocks of Gaussian logs
+COEFF_WIDTH = 10
+# How many orbitals below the HOMO and above the LUMO are in a percent table
+PERCENT_WINDOW = 0
+PERCENT_HEADER = ["Name", "Orbital", "Number", "Energy", "Total", "Vertical",
+                  "Vertical %", "Horizontal", "Horizontal %"]
 
-    points = tree.search()
+Orbitals = namedtuple("Orbitals",
+                      ["atom_idxs", "elements", "coeffs", "occupied", "energies"])
 
-    other_atoms = []
-    while points:
-        point = points.pop(0)
-        if point.value not in visited:
-            other_atoms.append(point)
-            visited.append(point.value)
-            points.extend(point.search())
-    return other_atoms
 
+def bfs_fill(graph, start, ignore):
+    '''Returns the atoms that can be reached from start without going
+    through any of the atoms in ignore.'''
+    return [i for i, _ in breadth_first_search(graph, start, ignore)
+            if i != start]
 
-def get_core_indices(cycles):
+
+def get_core_indices(graph, cycles):
     types = []
     for cycle_group in cycles:
         lengths = [len(x) for x in cycle_group]
         if lengths == [5, 6, 5] or lengths == [6, 5]:
-            core = identify_core(cycle_group)
+            core = identify_core(graph, cycle_group)
             types.append((core, cycle_group))
     return types
 
 
 def get_group_indices(mol):
-    links, tree = breadth_first_search(mol)
+    graph = Graph(mol)
 
-    cycles, link_nodes = get_cycles(links, tree)
-    pruned_cycles = prune_cycles(cycles, link_nodes)
-    fused = get_fused_cycles(pruned_cycles)
+    # Only the molecule with the first atom is used, stacked structures have
+    # a copy of it for each layer.
+    molecule = set(i for i, _ in breadth_first_search(graph, 0))
+    cycles = [x for x in get_rings(graph) if x[0] in molecule]
+    fused = get_fused_cycles(cycles)
     sorted_cycles = sort_fused_cycles(fused)
 
-    results = get_core_indices(sorted_cycles)
+    results = get_core_indices(graph, sorted_cycles)
     if len(results) != 1:
         raise ValueError("Something is not right with this structure")
     
@@ -54,99 +62,110 @@ def get_group_indices(mol):
     left_ring, center_ring, right_ring = filtered_cycles
 
     def get_joint(ring1, ring2):
-        return set([x.value.id for x in ring1]) & set([x.value.id for x in ring2])
+        return set(ring1) & set(ring2)
 
     link_ids = get_joint(left_ring, center_ring) | get_joint(center_ring, right_ring)
-    vert_seeds = [x.value for x in center_ring if x.value.id not in link_ids] 
-    horz_seeds = [x.value for x in left_ring + right_ring if x.value.id not in link_ids]
-
-    def check_atoms(atoms, ids):
-        return atoms[0].id in ids or atoms[1].id in ids
-
-    horz_seeds = [x for x in horz_seeds if not any(check_atoms(y.atoms, link_ids) for y in x.bonds)]
+    vert_seeds = [x for x in center_ring if x not in link_ids]
+    horz_seeds = [x for x in left_ring + right_ring if x not in link_ids]
+    horz_seeds = [x for x in horz_seeds
+                  if not any(y in link_ids for y in graph.neighbors[x])]
 
-    ignore_idxs = [x.value for x in sum(filtered_cycles, [])]
+    ignore_idxs = set(sum(filtered_cycles, []))
     # sum to collect all end nodes (should be 2 for each)
-    vert_nodes = sum([bfs_fill(x, ignore_idxs) for x in vert_seeds], [])
-    horz_nodes = sum([bfs_fill(x, ignore_idxs) for x in horz_seeds], [])
-    # subtract 1 because it was 1 indexed
-    return [x.value.id - 1 for x in vert_nodes], [x.value.id - 1 for x in horz_nodes]
+    vert_nodes = sum([bfs_fill(graph, x, ignore_idxs) for x in vert_seeds], [])
+    horz_nodes = sum([bfs_fill(graph, x, ignore_idxs) for x in horz_seeds], [])
+    return vert_nodes, horz_nodes
 
 
-def get_coordinates(f):
-    with f:
-        coords = []
-        state = 0
-        for line in f:
-            if "Coordinates" in line:
-                state = 1
-                continue
+def get_coordinates(reader):
+    coords = []
+    state = 0
+    for line in reader.lines(reader.first("orientation", 0)):
+        if "Coordinates" in line:
+            state = 1
+            continue
 
-            if "------------" in line and state == 1:
-                state = 2
-                continue
+        if "------------" in line and state == 1:
+            state = 2
+            continue
 
-            if "------------" in line and state == 2:
-                break
+        if "------------" in line and state == 2:
+            break
 
-            if state != 2:
-                continue
+        if state != 2:
+            continue
 
-            parts = line.strip().split()
-            coords.append([float(x) for x in parts[3:]])
+        parts = line.strip().split()
+        coords.append([float(x) for x in parts[3:]])
     return coords
 
                 
-def get_numbers(f):
-    with f:
-
-        collect = False
-        orb_values = []
-        occupied_orbs = []
-        last_orb_count = -1
-        num_basis = -1
-        atom_idxs = []
-        elements = []
-
-        for line in f:
-            if "NBasis=" in line:
-                num_basis = int(line.strip().split()[1])
-                orb_values = [[] for i in xrange(num_basis)]
-                atom_idxs = [-1 for i in xrange(num_basis)]
-
-            if "Molecular Orbital Coefficients:" in line:
-                collect = True
-                continue
-            if "Density Matrix:" in line:
-                break
-            if not collect:
-                continue
-
-            if "Eigenvalues --" in line:
-                continue
-
-            data = line.strip().split()
-            if data[0] in ('V', 'O'):
-                temp = [x == 'O' for x in data]
-                occupied_orbs.extend(temp)
-                last_orb_count = len(temp)
-                continue
-
-            if len(data) < last_orb_count + 1 or last_orb_count == -1:
-                # This skips the line that counts orbital numbers
-                continue
-            if "1S" in data:
-                # This is one indexed
-                atom_idx = int(data[1]) - 1
-                if len(elements) == atom_idx:
-                    elements.append(data[2])
-
-            # This is one indexed
-            idx = int(data[0]) - 1
-            numbers = [float(x) for x in data[-last_orb_count:]]
-            orb_values[idx].extend(numbers) 
-            atom_idxs[idx] = atom_idx
-    return atom_idxs, elements, orb_values, occupied_orbs
+def read_block(lines, count):
+    '''Reads the fixed width numbers at the ends of the lines into a
+    len(lines) x count array.'''
+    width = COEFF_WIDTH * count
+    tails = [x.rstrip()[-width:].rjust(width) for x in lines]
+    values = numpy.array(tails, dtype='S%d' % width).view('S%d' % COEFF_WIDTH)
+    return values.astype(float).reshape(len(lines), count)
+
+
+def get_orbitals(reader):
+    '''Reads the molecular orbital coefficients into an NBasis x NMO array.
+    The rows of each block after the first one are in the same order, so
+    only the labels of the first block are used to find the atom of each
+    basis function.'''
+    # Start at the last basis size before the orbitals
+    orbitals = reader.first("orbitals", len(reader))
+    starts = [x for x in reader.offsets("basis") if x < orbitals]
+    if not starts or orbitals == len(reader):
+        return Orbitals(numpy.zeros(0, dtype=int), [],
+                        numpy.zeros((0, 0)), [], numpy.zeros(0))
+
+    line = next(reader.lines(starts[-1]))
+    num_basis = int(line.strip().split()[1])
+    atom_idxs = numpy.zeros(num_basis, dtype=int) - 1
+    elements = []
+    blocks = []
+    occupied = []
+    energies = []
+
+    lines = reader.lines(orbitals)
+    for line in lines:
+        if "Molecular Orbital Coefficients" in line:
+            continue
+        data = line.split()
+        if not data or not all(x.isdigit() for x in data):
+            # The end of the orbitals
+            break
+        count = len(data)
+
+        line = next(lines)
+        if "Eigenvalues --" not in line:
+            occupied.extend(x[-1] == 'O' for x in line.split())
+            line = next(lines)
+        energies.append(read_block([line], count)[0])
+
+        rows = list(itertools.islice(lines, num_basis))
+        if not blocks:
+            atom_idx = -1
+            for i, row in enumerate(rows):
+                label = row.rstrip()[:-COEFF_WIDTH * count].split()
+                if len(label) > 2:
+                    # This is one indexed
+                    atom_idx = int(label[1]) - 1
+                    if len(elements) == atom_idx:
+                        elements.append(label[2])
+                atom_idxs[i] = atom_idx
+        blocks.append(read_block(rows, count))
+
+    return Orbitals(atom_idxs, elements, numpy.hstack(blocks), occupied,
+                    numpy.hstack(energies))
+
+
+def get_numbers(reader):
+    orbitals = get_orbitals(reader)
+    return (orbitals.atom_idxs, orbitals.elements, orbitals.coeffs,
+            orbitals.occupied)
 
 
 def get_homo_index(occupied_orbs):
@@ -155,14 +174,27 @@ def get_homo_index(occupied_orbs):
             return i - 1
 
 
-def calculate_groups(values, atom_idxs, vert_idxs, horz_idxs):
-    valuesq = [x ** 2 for x in values]
-    vert = sum(x for i, x in zip(atom_idxs, valuesq) if i in vert_idxs)
-    horz = sum(x for i, x in zip(atom_idxs, valuesq) if i in horz_idxs)
+def get_group_populations(coeffs, atom_idxs, vert_idxs, horz_idxs):
+    '''Returns the total, vertical, vertical percent, horizontal, and
+    horizontal percent populations of every orbital (column) of coeffs.'''
+    squares = coeffs ** 2
+    vert = squares[numpy.in1d(atom_idxs, list(vert_idxs))].sum(0)
+    horz = squares[numpy.in1d(atom_idxs, list(horz_idxs))].sum(0)
     total = vert + horz
     return total, vert, 100 * vert / total, horz, 100 * horz / total
 
 
+def get_orbital_populations(populations, idx):
+    return tuple(float(x[idx]) for x in populations)
+
+
+def calculate_groups(values, atom_idxs, vert_idxs, horz_idxs):
+    coeffs = numpy.array(values, dtype=float).reshape(-1, 1)
+    populations = get_group_populations(coeffs, numpy.array(atom_idxs),
+                                        vert_idxs, horz_idxs)
+    return get_orbital_populations(populations, 0)
+
+
 def draw(xvals, yvals, vert, horz):
     offset = 0.25
     scale = 10
@@ -207,25 +239,87 @@ def draw(xvals, yvals, vert, horz):
     return string
 
 
-def compute_axes_percents(f):
-    data = f.read() 
-    coords = get_coordinates(StringIO(data))
-    atom_idxs, elements, orb_values, occupied_orbs = get_numbers(StringIO(data))
-    body = '\n'.join("%s %f %f %f" % (ele, x, y, z) for ele, (x, y, z) in zip(elements, coords))
-    bonds = calculate_bonds(body)
-    mol = from_xyz(StringIO(body + "\n\n" + bonds))
+def get_axes_populations(f):
+    with LogReader(f) as reader:
+        coords = get_coordinates(reader)
+        orbitals = get_orbitals(reader)
+    if not orbitals.elements:
+        raise ValueError("The log does not have any orbitals")
+    bonds = get_bonds(orbitals.elements, coords)
+    mol = Structure.from_arrays(coords, orbitals.elements, bonds)
 
     vert_idxs, horz_idxs = get_group_indices(mol)
     vert_idxs = set(vert_idxs)
     horz_idxs = set(horz_idxs)
-    center_idxs = [i for i in xrange(len(coords)) if i not in vert_idxs and i not in horz_idxs]
 
-    homo_idx = get_homo_index(occupied_orbs)
-    homo_values = [x[homo_idx] for x in orb_values]
-    lumo_values = [x[homo_idx + 1] for x in orb_values]
+    populations = get_group_populations(orbitals.coeffs, orbitals.atom_idxs,
+                                        vert_idxs, horz_idxs)
+    return coords, orbitals, vert_idxs, horz_idxs, populations
+
 
-    homo_res = calculate_groups(homo_values, atom_idxs, vert_idxs, horz_idxs)
-    lumo_res = calculate_groups(lumo_values, atom_idxs, vert_idxs, horz_idxs)
+def compute_axes_percents(f):
+    coords, orbitals, vert_idxs, horz_idxs, populations = \
+        get_axes_populations(f)
+    homo_idx = get_homo_index(orbitals.occupied)
+    homo_res = get_orbital_populations(populations, homo_idx)
+    lumo_res = get_orbital_populations(populations, homo_idx + 1)
     # X and Y coordinates are flipped in Gaussian files
     image = draw([x[1] for x in coords], [x[0] for x in coords], vert_idxs, horz_idxs)
-    return ("HOMO", ) + homo_res, ("LUMO", ) + lumo_res, image 
+    return ("HOMO", ) + homo_res, ("LUMO", ) + lumo_res, image
+
+
+def compute_orbital_percents(f):
+    '''Returns the index of the HOMO and the (energy, total, vertical,
+    vertical percent, horizontal, horizontal percent) of every orbital.'''
+    coords, orbitals, vert_idxs, horz_idxs, populations = \
+        get_axes_populations(f)
+    homo_idx = get_homo_index(orbitals.occupied)
+    if homo_idx is None:
+        raise ValueError("The HOMO could not be found")
+    values = numpy.vstack((orbitals.energies, ) + populations).T
+    return homo_idx, [tuple(float(x) for x in row) for row in values]
+
+
+def get_orbital_label(idx, homo_idx):
+    if idx <= homo_idx:
+        diff = homo_idx - idx
+        return "HOMO-%d" % diff if diff else "HOMO"
+    diff = idx - homo_idx - 1
+    return "LUMO+%d" % diff if diff else "LUMO"
+
+
+def get_window_percents(homo_idx, values, window=PERCENT_WINDOW):
+    '''Returns the rows for HOMO-window to LUMO+window of the values from
+    compute_orbital_percents.'''
+    start = max(0, homo_idx - window)
+    end = min(len(values), homo_idx + window + 2)
+    rows = []
+    for idx in xrange(start, end):
+        label = get_orbital_label(idx, homo_idx)
+        # Orbital numbers are one indexed
+        rows.append((label, idx + 1) + values[idx])
+    return rows
+
+
+def get_percent_table(files, window=PERCENT_WINDOW, cache=None):
+    '''Returns the PERCENT_HEADER rows for HOMO-window to LUMO+window of
+    each of the files, and the errors of the files that could not be used.
+    The percents of all the orbitals are cached, so each file is only parsed
+    once no matter what window is used.'''
+    if cache is None:
+        with LogCache(":memory:") as cache:
+            return get_percent_table(files, window=window, cache=cache)
+    rows = []
+    errors = []
+    for f in files:
+        name = getattr(f, "name", f)
+        try:
+            homo_idx, values = cache.get_value(f, "orbital_percents",
+                                               PERCENT_VERSION,
+                                               compute_orbital_percents)
+        except Exception as e:
+            errors.append("%s: %s" % (name, e))
+            continue
+        rows.extend((name, ) + x for x in get_window_percents(homo_idx,
+                                                              values, window))
+    return rows, errors
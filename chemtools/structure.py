@@ -1,6 +1,6 @@
 import os
 import math
-import copy
+import collections
 import string
 from itertools import product
 import logging
@@ -11,7 +11,7 @@ import cairo
 from constants import COLORS2, CONNECTIONS, DATAPATH, ARYL, XGROUPS, MASSES
 from mol_name import parse_name
 from utils import get_full_rotation_matrix, get_angles, replace_geom_vars, \
-    convert_zmatrix_to_cart, calculate_bonds, \
+    convert_zmatrix_to_cart, get_bonds, parse_geometry, \
     get_axis_rotation_matrix
 from project.utils import StringIO
 import fileparser
@@ -19,6 +19,18 @@ import fileparser
 
 logger = logging.getLogger(__name__)
 
+# Templates of the parsed fragment data files keyed by file name. Each is a
+# (coords, elements, bonds) tuple that from_data builds new structures from.
+FRAGMENT_CACHE = {}
+
+# The offsets (in Angstroms) from the bond axis of each line that a bond of a
+# given type is drawn with. All other bonds are one line on the axis.
+BOND_LINE_OFFSETS = {
+    '2': (0.1, -0.1),
+    '3': (0.2, 0.0, -0.2),
+    'Ar': (0.1, -0.1),
+}
+
 
 def from_xyz(file):
     atoms = []
@@ -43,13 +55,8 @@ def from_xyz(file):
     return Structure(atoms, bonds)
 
 
-def from_data(filename):
-    '''Reads basic data files.'''
-    atomtypes = {'C': '4', 'N': '3', 'O': '2', 'P': '3', 'S': '2'}
-    if len(filename) == 3:
-        convert = {"XX": filename[1], "YY": filename[2]}
-        filename = filename[0] + \
-            atomtypes[convert["XX"]] + atomtypes[convert["YY"]]
+def _load_fragment(filename):
+    '''Parses a fragment data file into a read only template.'''
     # try to load file with lowercase name then upper
     paths = [
         os.path.join(DATAPATH, filename),
@@ -67,11 +74,32 @@ def from_data(filename):
         raise Exception(3, "Bad Substituent Name: %s" % filename)
 
     structure = from_xyz(f)
+    coords = structure.coords.copy()
+    coords.flags.writeable = False
+    elements = tuple(structure.elements)
+    bonds = tuple((x.atoms[0].id - 1, x.atoms[1].id - 1, x.type)
+                  for x in structure.bonds)
+    return coords, elements, bonds
+
+
+def from_data(filename):
+    '''Reads basic data files.'''
+    atomtypes = {'C': '4', 'N': '3', 'O': '2', 'P': '3', 'S': '2'}
+    convert = {}
     if len(filename) == 3:
-        for atom in structure.atoms:
-            if atom.element in convert:
-                atom.element = convert[atom.element]
-    return structure
+        convert = {"XX": filename[1], "YY": filename[2]}
+        filename = filename[0] + \
+            atomtypes[convert["XX"]] + atomtypes[convert["YY"]]
+
+    try:
+        coords, elements, bonds = FRAGMENT_CACHE[filename]
+    except KeyError:
+        coords, elements, bonds = _load_fragment(filename)
+        FRAGMENT_CACHE[filename] = coords, elements, bonds
+
+    if convert:
+        elements = [convert.get(x, x) for x in elements]
+    return Structure.from_arrays(coords, elements, bonds)
 
 
 def from_gjf(file):
@@ -132,8 +160,6 @@ def from_gjf(file):
             for i, x in enumerate(comp[::2]):
                 bonds.append("%s %s %s" % (main, x, comp[2 * i + 1]))
         bonds_string = "\n".join(bonds)
-    else:
-        bonds_string = ''
 
     body = parts[2].strip()
     start = body.index('\n')
@@ -146,10 +172,13 @@ def from_gjf(file):
     if len(geom[:geom.index("\n")].strip().split()) < 4:
         geom = convert_zmatrix_to_cart(geom)
 
-    if not has_bonds:
-        bonds_string = calculate_bonds(geom)
-    f = StringIO(geom + "\n\n" + bonds_string)
-    return from_xyz(f)
+    if has_bonds:
+        f = StringIO(geom + "\n\n" + bonds_string)
+        return from_xyz(f)
+
+    elements, coords = parse_geometry(geom)
+    bonds = get_bonds(elements, coords)
+    return Structure.from_arrays(coords, elements, bonds)
 
 
 def from_log(file):
@@ -290,20 +319,165 @@ def from_name(name):
     return structure
 
 
+class IndexedList(list):
+    '''A list with a lazily built map of items to their positions.
+
+    This makes index lookups constant time, which is what the atom and bond
+    ids are based on. Any change to the list drops the map so that it gets
+    rebuilt on the next lookup. version counts the changes so that anything
+    else built from the list can tell when it is out of date.'''
+    _index = None
+    version = 0
+
+    def __init__(self, *args):
+        super(IndexedList, self).__init__(*args)
+        self._index = None
+
+    def index(self, value, *args):
+        if args:
+            return super(IndexedList, self).index(value, *args)
+        if self._index is None:
+            index = {}
+            for i, item in enumerate(self):
+                index.setdefault(item, i)
+            self._index = index
+        try:
+            return self._index[value]
+        except KeyError:
+            raise ValueError("%r is not in list" % (value, ))
+
+
+def _invalidating(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._index = None
+        self.version += 1
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ("append", "extend", "insert", "remove", "pop", "reverse",
+              "sort", "__setitem__", "__delitem__", "__setslice__",
+              "__delslice__", "__iadd__", "__imul__"):
+    setattr(IndexedList, _name, _invalidating(_name))
+
+
+def _changed(items):
+    '''Marks a change to the items of an atom or bond list that does not go
+    through the list itself.'''
+    if isinstance(items, IndexedList):
+        items.version += 1
+
+
+class AtomBlock(object):
+    '''Contiguous storage for the atoms of a structure.
+
+    The coordinates of all the atoms are held in one N x 3 array with the
+    elements in a parallel array. Each atom is rebound to be a view into
+    these arrays so that whole structure transforms can be done as single
+    matrix operations.'''
+
+    def __init__(self, atoms):
+        # The list the block was built from and its version at the time, so
+        # that changes to it can be noticed without comparing the atoms
+        self.source = atoms
+        self.version = getattr(atoms, "version", None)
+        self.atoms = list(atoms)
+        self.valid = True
+
+        n = len(self.atoms)
+        self.coords = numpy.empty((n, 3))
+        self.elements = numpy.empty(n, dtype=object)
+        for i, atom in enumerate(self.atoms):
+            self.coords[i] = atom._xyz
+            self.elements[i] = atom._element[0]
+
+        for i, atom in enumerate(self.atoms):
+            # Any other block that was sharing this atom is now out of date
+            if atom._block is not None:
+                atom._block.valid = False
+            atom._block = self
+            atom._xyz = self.coords[i]
+            atom._element = self.elements[i:i + 1]
+
+
+class Connectivity(object):
+    '''Compressed sparse row adjacency of the atoms of a structure.
+
+    The neighbors of atom i are indices[indptr[i]:indptr[i + 1]], and the
+    positions and types of the bonds to them are at the same places in
+    bond_idxs and bond_types.'''
+
+    def __init__(self, atoms, bonds):
+        index = dict((atom, i) for i, atom in enumerate(atoms))
+        pairs = numpy.array([[index[x] for x in bond.atoms] for bond in bonds],
+                            dtype=int).reshape(-1, 2)
+        types = numpy.array([bond.type for bond in bonds], dtype=object)
+
+        first = numpy.concatenate((pairs[:, 0], pairs[:, 1]))
+        second = numpy.concatenate((pairs[:, 1], pairs[:, 0]))
+        order = numpy.argsort(first, kind="mergesort")
+        self.indices = second[order]
+        self.bond_idxs = numpy.tile(numpy.arange(len(bonds)), 2)[order]
+        self.bond_types = types[self.bond_idxs]
+        self.pairs = pairs
+        self.types = types
+        self.indptr = numpy.zeros(len(atoms) + 1, dtype=int)
+        numpy.cumsum(numpy.bincount(first, minlength=len(atoms)),
+                     out=self.indptr[1:])
+
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def neighbor_lists(self):
+        '''Returns the neighbors of all the atoms as a list of lists.'''
+        indices = self.indices.tolist()
+        indptr = self.indptr.tolist()
+        return [indices[x:y] for x, y in zip(indptr, indptr[1:])]
+
+
 class Atom(object):
 
     def __init__(self, x, y, z, element, parent=None):
         self.parent = parent
-        self.element = element
-        self.xyz = numpy.array([[x, y, z]], dtype=float).T
+        self._block = None
+        self._xyz = numpy.array([x, y, z], dtype=float)
+        self._element = numpy.array([element], dtype=object)
         self.bonds = []
 
+    def __getstate__(self):
+        # Detach from the block so copies get their own storage
+        state = self.__dict__.copy()
+        state["_block"] = None
+        state["_xyz"] = self._xyz.copy()
+        state["_element"] = self._element.copy()
+        return state
+
     def remove(self):
         self.parent.remove(self)
 
+    @property
+    def element(self):
+        return self._element[0]
+
+    @element.setter
+    def element(self, value):
+        self._element[0] = value
+        _changed(self.parent)
+
+    @property
+    def xyz(self):
+        return self._xyz.reshape(3, 1)
+
+    @xyz.setter
+    def xyz(self, value):
+        self._xyz[:] = numpy.asarray(value, dtype=float).ravel()
+
     @property
     def xyz_tuple(self):
-        return tuple(self.xyz.T.tolist()[0])
+        return tuple(self._xyz.tolist())
 
     @property
     def id(self):
@@ -388,6 +562,7 @@ class Bond(object):
         for atom in value:
             atom.bonds.append(self)
         self._atoms = value
+        _changed(self.parent)
 
     @property
     def id(self):
@@ -416,9 +591,119 @@ class Bond(object):
 class Structure(object):
 
     def __init__(self, atoms, bonds):
-        self.atoms = atoms
-        self.bonds = bonds
+        self.atoms = IndexedList(atoms)
+        self.bonds = IndexedList(bonds)
+        for atom in self.atoms:
+            atom.parent = self.atoms
+        for bond in self.bonds:
+            bond.parent = self.bonds
         self.frozen = []
+        self._block = None
+        self._connectivity = None
+        self._open_ends = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_block"] = None
+        state["_connectivity"] = None
+        state["_open_ends"] = None
+        return state
+
+    def _get_block(self):
+        '''Returns the packed atom storage, rebuilding it if the atoms have
+        changed since it was last built.'''
+        block = self._block
+        version = getattr(self.atoms, "version", None)
+        if block is None or not block.valid:
+            changed = True
+        elif version is None:
+            # A plain list can only be checked by comparing the atoms
+            changed = block.atoms != self.atoms
+        else:
+            changed = block.source is not self.atoms or \
+                block.version != version
+        if changed:
+            block = AtomBlock(self.atoms)
+            self._block = block
+        return block
+
+    @property
+    def coords(self):
+        '''Returns an N x 3 array of the atom coordinates. Changes to this
+        array are reflected in the atoms.'''
+        return self._get_block().coords
+
+    @property
+    def elements(self):
+        '''Returns an array of the atom elements.'''
+        return self._get_block().elements
+
+    def _get_version(self):
+        '''Returns the versions of the atom and bond lists, or None if they
+        can not be tracked.'''
+        versions = [getattr(x, "version", None) for x in (self.atoms,
+                                                          self.bonds)]
+        if None in versions:
+            return None
+        return (id(self.atoms), id(self.bonds)) + tuple(versions)
+
+    @property
+    def adjacency(self):
+        '''Returns the Connectivity of the atoms. This is cached until the
+        atoms or bonds are changed.'''
+        version = self._get_version()
+        if self._connectivity is None or version is None or \
+                self._connectivity[0] != version:
+            connectivity = Connectivity(self.atoms, self.bonds)
+            self._connectivity = (version, connectivity)
+        return self._connectivity[1]
+
+    def _get_open_ends(self, build=True):
+        '''Returns the (bond, connection) pairs of the open bonds in bond
+        order, and a map of each connection type to its open bonds. This is
+        cached until the atoms or bonds are changed. Without build, None is
+        returned if the cached values are out of date.'''
+        version = self._get_version()
+        if self._open_ends is None or version is None or \
+                self._open_ends[0] != version:
+            if not build:
+                return None, None
+            ends = []
+            for bond in self.bonds:
+                connection = bond.connection()
+                if connection:
+                    ends.append((bond, connection))
+            self._set_open_ends(ends)
+        return self._open_ends[1:]
+
+    def _set_open_ends(self, ends):
+        types = dict((x, []) for x in CONNECTIONS)
+        for bond, connection in ends:
+            for x in set(connection):
+                types[x].append(bond)
+        self._open_ends = (self._get_version(), ends, types)
+
+    @classmethod
+    def from_arrays(cls, coords, elements, bonds):
+        '''Builds a structure from an N x 3 array of coordinates, a list of
+        elements, and a list of (index1, index2, type) bonds.'''
+        coords = numpy.asarray(coords).tolist()
+        atoms = [Atom(x, y, z, e) for (x, y, z), e in zip(coords, elements)]
+        bonds = [Bond((atoms[i], atoms[j]), t) for i, j, t in bonds]
+        return cls(atoms, bonds)
+
+    def clone(self):
+        '''Returns a copy of the structure built from its coordinate block,
+        elements, and bond index pairs.'''
+        bonds = [(x.atoms[0].id - 1, x.atoms[1].id - 1, x.type)
+                 for x in self.bonds]
+        struct = Structure.from_arrays(self.coords, self.elements, bonds)
+        # Keep the bond ordering of each atom, it determines the gjf output
+        for atom, new_atom in zip(self.atoms, struct.atoms):
+            new_atom.bonds = [struct.bonds[x.id - 1] for x in atom.bonds]
+        for pair in self.frozen:
+            struct.frozen.append(tuple(struct.atoms[x.id - 1] for x in pair))
+        return struct
 
     @classmethod
     def concatenate(cls, structures):
@@ -437,6 +722,43 @@ class Structure(object):
     # DISPLAY
     ###########################################################################
 
+    def get_bond_lines(self, hydrogens=True, fancy_bonds=True):
+        '''Returns a (type, lines) pair for each bond that is drawn, where
+        lines is a list of the (x1, y1, x2, y2) end points of the lines of the
+        bond in the xy plane. The perpendicular offsets of all of the bonds
+        are computed together.'''
+        adjacency = self.adjacency
+        pairs = adjacency.pairs
+        types = adjacency.types
+        if not hydrogens:
+            keep = (self.elements[pairs] != 'H').all(1)
+            pairs = pairs[keep]
+            types = types[keep]
+
+        coords = self.coords[:, :2]
+        starts = coords[pairs[:, 0]]
+        ends = coords[pairs[:, 1]]
+        temp = ends - starts
+        mags = numpy.linalg.norm(temp, axis=1)
+        units = numpy.column_stack((-temp[:, 1] / mags, temp[:, 0] / mags))
+
+        lines = [None] * len(pairs)
+        groups = collections.defaultdict(list)
+        for i, bond_type in enumerate(types):
+            offsets = (0.0, )
+            if fancy_bonds:
+                offsets = BOND_LINE_OFFSETS.get(bond_type, offsets)
+            groups[offsets].append(i)
+
+        for offsets, idxs in groups.items():
+            shifts = (numpy.array(offsets)[None, :, None] *
+                      units[idxs][:, None, :])
+            points = numpy.concatenate((shifts + starts[idxs][:, None, :],
+                                        shifts + ends[idxs][:, None, :]), 2)
+            for i, value in zip(idxs, points.tolist()):
+                lines[i] = (types[i], value)
+        return lines
+
     def draw(self, scale, svg=False, hydrogens=True, colors=True,
              fancy_bonds=True):
         '''Draws a basic image of the molecule.'''
@@ -460,46 +782,30 @@ class Structure(object):
         ctx.translate(-mins[0], -mins[1])
         ctx.set_line_width(0.1)
 
-        def draw_bond(ctx, coords1, coords2, unit, factors):
-            for x in factors:
-                ctx.move_to(*(x * unit + coords1))
-                ctx.line_to(*(x * unit + coords2))
-                ctx.stroke()
+        coords = self.coords
+        elements = self.elements
+        lines = self.get_bond_lines(hydrogens=hydrogens,
+                                    fancy_bonds=fancy_bonds)
 
         ctx.set_source_rgb(*COLORS2['1'])
-        for bond in self.bonds:
-            if not hydrogens and any(x.element == 'H' for x in bond.atoms):
-                continue
+        for bond_type, points in lines:
             if colors:
-                ctx.set_source_rgb(*COLORS2[bond.type])
-
-            coords1 = numpy.array(bond.atoms[0].xyz_tuple[:2])
-            coords2 = numpy.array(bond.atoms[1].xyz_tuple[:2])
-
-            temp = (coords2 - coords1)
-            mag = numpy.linalg.norm(temp)
-            unit = numpy.array([-temp[1] / mag, temp[0] / mag])
-            if fancy_bonds:
-                if bond.type == '2':
-                    draw_bond(ctx, coords1, coords2, unit, [0.1, -0.1])
-                elif bond.type == '3':
-                    draw_bond(ctx, coords1, coords2, unit, [0.2, 0.0, -0.2])
-                elif bond.type == 'Ar':
-                    ctx.save()
-                    ctx.set_dash([0.3, 0.15])
-                    draw_bond(ctx, coords1, coords2, unit, [0.1, -0.1])
-                    ctx.restore()
-                else:
-                    draw_bond(ctx, coords1, coords2, unit, [0.0])
-            else:
-                draw_bond(ctx, coords1, coords2, unit, [0.0])
+                ctx.set_source_rgb(*COLORS2[bond_type])
+            if fancy_bonds and bond_type == 'Ar':
+                ctx.save()
+                ctx.set_dash([0.3, 0.15])
+            for x1, y1, x2, y2 in points:
+                ctx.move_to(x1, y1)
+                ctx.line_to(x2, y2)
+                ctx.stroke()
+            if fancy_bonds and bond_type == 'Ar':
+                ctx.restore()
 
-        for atom in self.atoms:
-            if not hydrogens and atom.element == 'H':
+        for (x, y), element in zip(coords[:, :2].tolist(), elements):
+            if not hydrogens and element == 'H':
                 continue
-            ctx.set_source_rgb(*COLORS2[atom.element])
-            point = atom.xyz_tuple
-            ctx.arc(point[0], point[1], 0.25, 0, 2 * math.pi)
+            ctx.set_source_rgb(*COLORS2[element])
+            ctx.arc(x, y, 0.25, 0, 2 * math.pi)
             ctx.fill()
 
         if svg:
@@ -557,14 +863,12 @@ class Structure(object):
     ###########################################################################
 
     def rotate_3d(self, rotation_matrix, point, offset):
-        for atom in self.atoms:
-            coords = atom.xyz - point
-            atom.xyz = rotation_matrix.dot(coords) + offset
+        coords = self.coords
+        coords[:] = rotation_matrix.dot((coords - point.T).T).T + offset.T
 
     def displace(self, displacement):
         '''Runs a uniform displacement on all the atoms in the structure.'''
-        for atom in self.atoms:
-            atom.xyz += displacement
+        self.coords[:] += displacement.T
 
     def reflect_ends(self, angle=180):
         bonds = self.open_ends('~')
@@ -576,9 +880,9 @@ class Structure(object):
 
     def bounding_box(self):
         '''Returns the bounding box of the structure.'''
-        coords = numpy.hstack([x.xyz for x in self.atoms])
-        mins = numpy.min(coords, 1)
-        maxs = numpy.max(coords, 1)
+        coords = self.coords
+        mins = numpy.min(coords, 0)
+        maxs = numpy.max(coords, 0)
         return mins, maxs
 
     ###########################################################################
@@ -588,25 +892,20 @@ class Structure(object):
     def open_ends(self, connections=CONNECTIONS):
         '''Returns a list of any bonds that contain non-standard elements.'''
         connections = set(connections)
-        openbonds = []
-        for bond in self.bonds:
-            # !!
-            if set(bond.connection()) & connections:
-                openbonds.append(bond)
-        return openbonds
+        ends, _ = self._get_open_ends()
+        return [bond for bond, x in ends if set(x) & connections]
 
     def next_open(self, connections=CONNECTIONS, skip=False):
         '''Returns the next open bond of the given connection type.'''
         # scans for the first available bond in order of importance.
-        bonds = self.open_ends()
+        _, types = self._get_open_ends()
         found = False
         for conn in connections:
-            for bond in bonds:
-                if conn in bond.connection():
-                    if skip and not found:
-                        found = True
-                        continue
-                    return bond
+            for bond in types.get(conn, []):
+                if skip and not found:
+                    found = True
+                    continue
+                return bond
 
     def close_ends(self):
         '''Converts any non-standard atoms into Hydrogens.'''
@@ -631,6 +930,11 @@ class Structure(object):
         else:
             raise Exception(6, "bad bond")
 
+        # Any open ends that were already found are updated instead of
+        # being found again
+        ends1, _ = self._get_open_ends(build=False)
+        ends2, _ = fragment._get_open_ends(build=False)
+
         # saved to prevent overwriting them
         R2xyz = R2.xyz.copy()
         C1xyz = C1.xyz.copy()
@@ -655,6 +959,11 @@ class Structure(object):
         for x in (bond2, R1, R2):
             x.remove()
 
+        if ends1 is not None:
+            self._set_open_ends([x for x in ends1 if x[0] is not bond1])
+        if ends2 is not None:
+            fragment._set_open_ends([x for x in ends2 if x[0] is not bond2])
+
         if freeze:
             self.frozen.append(bond1.atoms)
 
@@ -685,7 +994,7 @@ class Structure(object):
         idxs = [self.bonds.index(x) for x in ends]
         structures = []
         for i in xrange(n):
-            struct = copy.deepcopy(self)
+            struct = self.clone()
             newends = [struct.bonds[x] for x in idxs]
             # newends twice to keep on single axis
             structures.append((struct, newends * 2))
@@ -700,38 +1009,38 @@ class Structure(object):
             # means there is nothing to stack
             if axis <= 1:
                 continue
-            axisfrags = copy.deepcopy(frags)
+            axisfrags = list(frags)
             for num in xrange(1, axis):
                 displace = numpy.zeros((3, 1))
                 displace[i] = num * (2 + size[i])
                 for f in axisfrags:
-                    a = copy.deepcopy(f)
+                    a = f.clone()
                     a.displace(displace)
                     frags.append(a)
         return Structure.concatenate(frags)
 
     def perturb(self, delta=0.1):
-        for atom in self.atoms:
-            atom.xyz += numpy.random.uniform(-delta, delta, size=(3, 1))
+        coords = self.coords
+        coords[:] += numpy.random.uniform(-delta, delta, size=coords.shape)
 
     ###########################################################################
     # Properties
     ###########################################################################
 
     def get_center(self):
-        totals = numpy.zeros((3, 1))
-        for atom in self.atoms:
-            totals += atom.xyz
+        totals = self.coords.sum(0).reshape(3, 1)
         return totals / len(self.atoms)
 
+    def get_masses(self):
+        return numpy.array([MASSES[x] for x in self.elements])
+
     def get_mass(self):
-        return sum(MASSES[atom.element] for atom in self.atoms)
+        return self.get_masses().sum()
 
     def get_mass_center(self):
-        totals = numpy.zeros((3, 1))
-        for atom in self.atoms:
-            totals += atom.xyz * MASSES[atom.element]
-        return totals / self.get_mass()
+        masses = self.get_masses()
+        totals = masses.dot(self.coords).reshape(3, 1)
+        return totals / masses.sum()
 
     def get_moment_of_inertia(self, direction=None, offset=None):
         if direction is None:
@@ -741,9 +1050,6 @@ class Structure(object):
 
         direction = direction / numpy.linalg.norm(direction)
 
-        total = 0
-        for atom in self.atoms:
-            dist = numpy.linalg.norm(
-                numpy.cross((atom.xyz - offset).T, direction.T))
-            total += MASSES[atom.element] * dist ** 2
-        return total
+        dists = numpy.linalg.norm(
+            numpy.cross(self.coords - offset.T, direction.T), axis=1)
+        return self.get_masses().dot(dists ** 2)
@@ -1,10 +1,16 @@
 import os
+import sys
+import subprocess
+import shutil
+import tempfile
 from itertools import product
 import csv
+import cPickle
 
 from django.test import SimpleTestCase
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 import numpy
 import mock
 
@@ -17,7 +23,10 @@ import structure
 import fileparser
 import graph
 import random_gen
+import percent
+import interface
 from management.commands.update_ml import lock
+from management.commands import benchmark
 from project.utils import StringIO
 from data.models import DataPoint
 
@@ -122,6 +131,15 @@ METHANE_REPLACED = """
  H                  1            1.07000000    3            109.47121829    2            120.00000060    0
 """
 METHANE_CART = """
+ C 0.00000000 0.00000000 0.00000000
+ H 1.07000000 0.00000000 0.00000000
+ H -0.35666635 1.00880579 0.00000000
+ H -0.35666635 -0.50440312 -0.87365131
+ H -0.35666686 -0.50440269 0.87365135
+"""
+# Output from the previous Z-matrix converter. It did not keep track of the
+# sign of the dihedrals, so only the distances between atoms are comparable.
+METHANE_CART_UNSIGNED = """
  C 0.00000000 0.00000000 0.00000000
  H 1.07000000 0.00000000 0.00000000
  H -0.35666635 1.00880579 0.00000000
@@ -132,8 +150,8 @@ METHANE_ALL = """
 C 0.000000 0.000000 0.000000
 H 1.070000 0.000000 0.000000
 H -0.356666 1.008806 0.000000
-H -0.356666 -0.504403 0.873651
-H -0.356667 -0.504403 -0.873651
+H -0.356666 -0.504403 -0.873651
+H -0.356667 -0.504403 0.873651
 
 1  2 1.0 3 1.0 4 1.0 5 1.0
 2
@@ -187,6 +205,20 @@ BENZENE = """
    D9           179.98917535
    """
 BENZENE_CART = """
+ C 0.00000000 0.00000000 0.00000000
+ C 1.39516000 0.00000000 0.00000000
+ C 2.09269800 1.20775100 0.00000000
+ C 1.39504400 2.41626000 -0.00119900
+ C 0.00021900 2.41618200 -0.00167800
+ C -0.69738200 1.20797600 -0.00068200
+ H -0.54975900 -0.95231700 0.00045000
+ H 1.94466800 -0.95251300 0.00131500
+ H 3.19237800 1.20783100 0.00063400
+ H 1.94524400 3.36840300 -0.00125800
+ H -0.54990300 3.36846300 -0.00263100
+ H -1.79698600 1.20815900 -0.00086200
+"""
+BENZENE_CART_UNSIGNED = """
  C 0.00000000 0.00000000 0.00000000
  C 1.39516000 0.00000000 0.00000000
  C 2.09269800 1.20775100 0.00000000
@@ -288,6 +320,28 @@ Title Card Required
 B 5 1 F
 """
 
+ORBITALS_LOG = """
+    NBasis=     5 NAE=     2 NBE=     2 NFC=     0 NFV=     0
+     Molecular Orbital Coefficients:
+                              1         2         3
+                              O         O         V
+     Eigenvalues --   -11.00000  -0.50000   0.20000
+   1 1   C  1S          0.90000   0.10000   0.20000
+   2        2S          0.10000   0.50000  -0.30000
+   3        2PX         0.00000   0.30000   0.40000
+   4        2PY         0.00000   0.20000   0.50000
+   5 2   H  1S          0.05000  -0.40000   0.60000
+                              4         5
+                              V         V
+     Eigenvalues --     0.40000   0.60000
+   1 1   C  1S          0.30000  -0.10000
+   2        2S          0.10000   0.20000
+   3        2PX        -0.60000   0.00000
+   4        2PY         0.20000   0.70000
+   5 2   H  1S          0.10000  -0.50000
+     Density Matrix:
+"""
+
 # hashlib.sha224(string).hexdigest()
 PNG_HASH = "4cbf2c82970819ccbe66025fdbc627171af31571c96e06323a98c945"
 SVG_HASH = "c095979c874d01bd997ac6435b9e72a74e510060aad2df7ca4d58c1d"
@@ -367,6 +421,160 @@ class StructureTestCase(SimpleTestCase):
             }
         self.assertEqual(atom.json, data)
 
+    def test_atom_element_setter(self):
+        atom = structure.Atom(0, 0, 0, "C")
+        atom.element = "H"
+        self.assertEqual(str(atom), "H 0.000000 0.000000 0.000000")
+
+    def test_coords_shared_with_atoms(self):
+        struct = structure.from_name("TON")
+        coords = struct.coords
+        self.assertEqual(coords.shape, (len(struct.atoms), 3))
+        coords[0] = [1., 2., 3.]
+        self.assertEqual(struct.atoms[0].xyz_tuple, (1., 2., 3.))
+        struct.atoms[1].xyz = numpy.array([[4., 5., 6.]]).T
+        self.assertEqual(struct.coords[1].tolist(), [4., 5., 6.])
+        struct.atoms[2].element = "Si"
+        self.assertEqual(struct.elements[2], "Si")
+
+    def test_coords_after_remove(self):
+        struct = structure.from_name("TON")
+        atom = struct.atoms[0]
+        atom.remove()
+        self.assertEqual(struct.coords.shape, (len(struct.atoms), 3))
+        self.assertEqual(struct.atoms[0].xyz_tuple,
+                         tuple(struct.coords[0].tolist()))
+
+    def test_coords_block_reused(self):
+        struct = structure.from_name("TON")
+        self.assertIs(struct._get_block(), struct._get_block())
+        block = struct._get_block()
+        struct.atoms.append(structure.Atom(0, 0, 0, "H"))
+        self.assertIsNot(struct._get_block(), block)
+        self.assertEqual(struct.coords.shape, (len(struct.atoms), 3))
+
+    def test_ids(self):
+        struct = structure.from_name("TON")
+        for i, atom in enumerate(struct.atoms):
+            self.assertEqual(atom.id, i + 1)
+        for i, bond in enumerate(struct.bonds):
+            self.assertEqual(bond.id, i + 1)
+
+    def test_ids_after_remove(self):
+        struct = structure.from_name("TON")
+        struct.bonds[0].remove()
+        struct.atoms[0].remove()
+        self.assertEqual(struct.atoms[0].id, 1)
+        self.assertEqual(struct.bonds[0].id, 1)
+        self.assertEqual(struct.atoms[-1].id, len(struct.atoms))
+
+    def test_indexed_list(self):
+        items = structure.IndexedList(['a', 'b', 'c'])
+        self.assertEqual(items.index('c'), 2)
+        items.remove('a')
+        self.assertEqual(items.index('c'), 1)
+        items.insert(0, 'd')
+        self.assertEqual(items.index('c'), 2)
+        items.append('a')
+        self.assertEqual(items.index('a'), 3)
+        with self.assertRaises(ValueError):
+            items.index('z')
+
+    def test_adjacency(self):
+        struct = structure.from_name("4_TON")
+        adjacency = struct.adjacency
+        self.assertIs(struct.adjacency, adjacency)
+        for i, atom in enumerate(struct.atoms):
+            expected = sorted(x.id - 1 for x in atom.connected_atoms())
+            self.assertEqual(sorted(adjacency.neighbors(i)), expected)
+        for i, j, t in zip(adjacency.indices, adjacency.bond_idxs,
+                           adjacency.bond_types):
+            self.assertIn(struct.atoms[i], struct.bonds[j].atoms)
+            self.assertEqual(struct.bonds[j].type, t)
+
+        struct.bonds[0].remove()
+        adjacency2 = struct.adjacency
+        self.assertIsNot(adjacency2, adjacency)
+        self.assertEqual(len(adjacency2.indices), 2 * len(struct.bonds))
+
+    def test_get_bond_lines(self):
+        struct = structure.from_name("TON")
+        lines = struct.get_bond_lines()
+        self.assertEqual(len(lines), len(struct.bonds))
+        for bond, (bond_type, points) in zip(struct.bonds, lines):
+            self.assertEqual(bond_type, bond.type)
+            offsets = structure.BOND_LINE_OFFSETS.get(bond.type, (0.0, ))
+            self.assertEqual(len(points), len(offsets))
+            start = numpy.array(bond.atoms[0].xyz_tuple[:2])
+            end = numpy.array(bond.atoms[1].xyz_tuple[:2])
+            for offset, point in zip(offsets, points):
+                point = numpy.array(point)
+                # Each line is parallel to the bond and offset from it
+                self.assertTrue(numpy.allclose(point[2:] - point[:2],
+                                               end - start))
+                self.assertAlmostEqual(
+                    numpy.linalg.norm(point[:2] - start), abs(offset))
+
+        lines = struct.get_bond_lines(hydrogens=False, fancy_bonds=False)
+        bonds = [x for x in struct.bonds
+                 if all(y.element != 'H' for y in x.atoms)]
+        self.assertEqual([x for x, _ in lines], [x.type for x in bonds])
+        self.assertTrue(all(len(x) == 1 for _, x in lines))
+
+    def test_next_open(self):
+        struct = structure.from_data("TON")
+        bonds = [x for x in struct.bonds if x.connection()]
+        self.assertEqual(struct.open_ends(), bonds)
+        self.assertEqual(struct.open_ends('~'),
+                         [x for x in bonds if '~' in x.connection()])
+        first, second = [x for x in bonds if '~' in x.connection()][:2]
+        self.assertIs(struct.next_open('~'), first)
+        self.assertIs(struct.next_open('~', skip=True), second)
+
+        part = structure.from_data("4")
+        struct.merge(first, part.next_open(), part)
+        self.assertNotIn(first, struct.open_ends())
+        self.assertIs(struct.next_open('~'), second)
+        self.assertEqual(struct.open_ends(),
+                         [x for x in struct.bonds if x.connection()])
+
+        struct.close_ends()
+        self.assertEqual(struct.open_ends(), [])
+        self.assertIsNone(struct.next_open())
+
+    def test_rotate_3d(self):
+        struct = structure.from_name("TON")
+        expected = [x.xyz.copy() for x in struct.atoms]
+        rot = utils.get_axis_rotation_matrix(
+            numpy.array([[1., 2., 3.]]).T, 0.5)
+        point = numpy.array([[1., 0., 0.]]).T
+        offset = numpy.array([[0., 1., 0.]]).T
+        struct.rotate_3d(rot, point, offset)
+        for atom, xyz in zip(struct.atoms, expected):
+            value = rot.dot(xyz - point) + offset
+            self.assertTrue(numpy.allclose(atom.xyz, value))
+
+    def test_displace(self):
+        struct = structure.from_name("TON")
+        expected = struct.coords + [1., 2., 3.]
+        struct.displace(numpy.array([[1., 2., 3.]]).T)
+        self.assertTrue(numpy.allclose(struct.coords, expected))
+
+    def test_clone(self):
+        struct = structure.from_name("4(20)a_TON_n2")
+        clone = struct.clone()
+        self.assertEqual(struct.gjf, clone.gjf)
+        self.assertEqual(struct.mol2, clone.mol2)
+        self.assertEqual(len(clone.frozen), 2)
+        for pair in clone.frozen:
+            for atom in pair:
+                self.assertIs(atom.parent, clone.atoms)
+
+        clone.displace(numpy.array([[1., 0., 0.]]).T)
+        clone.atoms[0].element = "Si"
+        self.assertNotEqual(struct.gjf, clone.gjf)
+        self.assertEqual(struct.atoms[0].element, "C")
+
     def test_get_mass(self):
         struct = structure.from_name("TON")
         result = struct.get_mass()
@@ -420,6 +628,28 @@ class StructureTestCase(SimpleTestCase):
         with self.assertRaises(Exception):
             structure.from_data("filename")
 
+    def test_from_data_cache(self):
+        struct1 = structure.from_data("4")
+        struct2 = structure.from_data("4")
+        self.assertIn("4", structure.FRAGMENT_CACHE)
+        self.assertIsNot(struct1.atoms[0], struct2.atoms[0])
+        struct1.displace(numpy.array([[1., 0., 0.]]).T)
+        struct1.atoms[0].element = "Si"
+        struct3 = structure.from_data("4")
+        self.assertEqual(struct2.mol2, struct3.mol2)
+
+    def test_from_data_core(self):
+        struct = structure.from_data("TON")
+        elements = set(struct.elements)
+        self.assertIn("O", elements)
+        self.assertIn("N", elements)
+        self.assertNotIn("XX", elements)
+        self.assertNotIn("YY", elements)
+        struct = structure.from_data("TSP")
+        elements = set(struct.elements)
+        self.assertIn("S", elements)
+        self.assertIn("P", elements)
+
     def test_from_gjf(self):
         path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.gjf")
         s = structure.from_gjf(open(path, 'r'))
@@ -779,6 +1009,42 @@ class NamedMoleculeTestCase(SimpleTestCase):
     #     string = obj.get_svg_data_url()
     #     self.assertEqual(SVG_HASH, hashlib.sha224(string).hexdigest())
 
+    @mock.patch("chemtools.structure.Structure.draw")
+    def test_get_image_cache(self, draw):
+        draw.side_effect = lambda *args, **kwargs: StringIO(str(args))
+        with gjfwriter.ImageCache(":memory:") as cache:
+            obj = gjfwriter.NamedMolecule("24a_TON")
+            first = obj.get_png(cache=cache)
+            obj = gjfwriter.NamedMolecule("24a_TON")
+            self.assertEqual(obj.get_png(cache=cache), first)
+            self.assertEqual(draw.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            obj.get_png(scale=20, cache=cache)
+            obj.get_svg(cache=cache)
+            obj.get_png(hydrogens=False, cache=cache)
+            self.assertEqual(draw.call_count, 4)
+            self.assertEqual(len(cache), 4)
+
+            obj = gjfwriter.NamedMolecule("24a_TON", perturb=1.0)
+            self.assertIsNone(obj.get_image_key())
+            obj.get_png(cache=cache)
+            self.assertEqual(draw.call_count, 5)
+            self.assertEqual(len(cache), 4)
+
+    def test_image_cache_eviction(self):
+        with gjfwriter.ImageCache(":memory:", maxsize=2) as cache:
+            for key in "abc":
+                cache.set(key, key * 3)
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("c"), "ccc")
+
+    def test_image_cache_no_sqlite(self):
+        with mock.patch.object(fileparser, "sqlite3", None):
+            with self.assertRaises(ImportError):
+                gjfwriter.ImageCache(':memory:')
+
     def test_get_property_limits(self):
         expected = {
             'm': [-5.5421310841370435, -2.4789919135053662, 2.8719047861895461],
@@ -797,6 +1063,20 @@ class NamedMoleculeTestCase(SimpleTestCase):
         results = obj.get_property_limits()
         self.assertEqual(expected, results)
 
+    def test_predict_molecules(self):
+        names = ["24b_TON", "24b_TON_n2", "bad_name"]
+        molecules = [gjfwriter.NamedMolecule(x) for x in names]
+        with mock.patch("chemtools.gjfwriter.predict_properties",
+                        side_effect=ml.predict_properties) as predict:
+            results = gjfwriter.predict_molecules(molecules)
+        self.assertEqual(predict.call_count, 1)
+        self.assertEqual(len(results), len(names))
+        for name, (predictions, limits) in zip(names, results):
+            obj = gjfwriter.NamedMolecule(name)
+            self.assertEqual(predictions, obj.get_property_predictions())
+            self.assertEqual(limits, obj.get_property_limits())
+        self.assertEqual(results[2][0], {})
+
     def test_autoflip_name(self):
         names = (
             ("5555", "55-55-"),
@@ -1012,6 +1292,75 @@ class MolNameTestCase(SimpleTestCase):
         for name, result in names:
             self.assertEqual(set(mol_name.name_expansion(name)), set(result))
 
+    def test_name_expansion_duplicates(self):
+        names = [
+            ("a,b,a", ["a", "b"]),
+            ("{a,a}b,ab", ["ab"]),
+            ("{a,b}{a,a}", ["aa", "ba"]),
+        ]
+        for name, result in names:
+            self.assertEqual(list(mol_name.name_expansion(name)), result)
+
+    def test_name_expansion_count(self):
+        names = [
+            ("a", 1),
+            ("a,b,a", 3),
+            ("{a,b}{c,d}{$0}", 4),
+            ("{a,b}{c,d},e{f,g}", 6),
+            ("{$ARYL}{$RGROUPS}_{$CORES}",
+                len(constants.ARYL) * len(constants.RGROUPS) *
+                len(constants.CORES)),
+        ]
+        for name, result in names:
+            self.assertEqual(mol_name.name_expansion_count(name), result)
+
+    def test_name_expansion_lazy(self):
+        string = "{$ARYL}{$RGROUPS}{$RGROUPS}_{$CORES}_{$ARYL}" * 3
+        names = mol_name.name_expansion(string)
+        first = next(names)
+        self.assertEqual(first, mol_name._get_indexed_name(
+            mol_name._get_expansion_parts(string), 0))
+
+    def test_name_expansion_random(self):
+        string = "{$ARYL}{$RGROUPS}{$RGROUPS}_{$CORES}_{$ARYL}" * 3
+        names = list(mol_name.name_expansion(string, rand=5))
+        self.assertEqual(len(set(names)), 5)
+        for name in names:
+            self.assertEqual(len(name.split('_')), 7)
+
+    def test_name_expansion_random_large(self):
+        string = "{$ARYL}{$RGROUPS}{$RGROUPS}_{$CORES}_{$ARYL}" * 4
+        self.assertTrue(mol_name.name_expansion_count(string) > 2 ** 63)
+        names = list(mol_name.name_expansion(string, rand=5))
+        self.assertEqual(len(set(names)), 5)
+
+    def test_name_expansion_random_duplicates(self):
+        names = list(mol_name.name_expansion("{a,a,b}c", rand=2))
+        self.assertEqual(sorted(names), ["ac", "bc"])
+        for size in (mol_name.EXPANSION_SHUFFLE_SIZE, 0):
+            with mock.patch("chemtools.mol_name.EXPANSION_SHUFFLE_SIZE", size):
+                for i in xrange(50):
+                    names = mol_name.name_expansion("{A,A,A,A,A,B}_TON",
+                                                    rand=2)
+                    self.assertEqual(sorted(names), ["A_TON", "B_TON"])
+                names = mol_name.name_expansion("{A,A,A,A,A,B}_TON", rand=3)
+                self.assertEqual(sorted(names), ["A_TON", "B_TON"])
+
+    def test_name_expansion_random_none(self):
+        self.assertEqual(list(mol_name.name_expansion("{a,b}", rand=0)), [])
+
+    def test_name_expansion_random_all(self):
+        names = mol_name.name_expansion("{a,b}{c,d}", rand=10)
+        self.assertEqual(list(names), ["ac", "ad", "bc", "bd"])
+
+    def test_get_indexed_name(self):
+        string = "{a,b}{c,d}{$0.U},e{f,g}"
+        parts = mol_name._get_expansion_parts(string)
+        names = [mol_name._get_indexed_name(parts, i) for i in xrange(6)]
+        self.assertEqual(names, list(mol_name.name_expansion(string)))
+        with self.assertRaises(IndexError):
+            mol_name._get_indexed_name(parts, 6)
+
     def test_local_vars_case(self):
         names = [
             ("{a,b}{$0.U}", ["aA", "bB"]),
@@ -1063,6 +1412,51 @@ class MolNameTestCase(SimpleTestCase):
             res = mol_name.get_structure_type(name)
             self.assertEqual(res, expected)
 
+    def test_get_structure_type_invalid(self):
+        res = mol_name.get_structure_type("TON_n2_m2")
+        self.assertEqual(res, constants.UNKNOWN)
+
+    def test_analyze_name(self):
+        info = mol_name.analyze_name("4a_TON_4b_4c")
+        self.assertEqual(info.exact_name, "4aaA_TON_4bbA_4ccA_n1_m1_x1_y1_z1")
+        self.assertEqual(info.exact_name_spacers,
+                         "4aaA**_TON_4bbA**_4ccA**_n1_m1_x1_y1_z1")
+        self.assertEqual(info.structure_type, constants.BENZO_TWO)
+        self.assertEqual(info.nm, (1, 1))
+        self.assertEqual(info.xyz, (1, 1, 1))
+        self.assertIsNone(info.error)
+        self.assertEqual(list(info.sets), mol_name.parse_name(info.name)[0])
+
+    def test_analyze_name_error(self):
+        info = mol_name.analyze_name("TON_n2_m2")
+        self.assertIsNone(info.sets)
+        self.assertIsNone(info.exact_name)
+        self.assertEqual(info.structure_type, constants.UNKNOWN)
+        self.assertEqual(info.error.args[0], 7)
+        with self.assertRaises(Exception) as e:
+            mol_name.get_exact_name("TON_n2_m2")
+        self.assertIs(e.exception, info.error)
+
+    def test_name_cache(self):
+        mol_name.clear_caches()
+        first = mol_name.analyze_name("4a_TON")
+        self.assertIs(mol_name.analyze_name("4a_TON"), first)
+        mol_name.get_exact_name("4a_TON")
+        mol_name.get_structure_type("4a_TON")
+        stats = mol_name.get_cache_stats()["names"]
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["size"], 1)
+
+    def test_name_cache_bounded(self):
+        cache = mol_name.NAME_CACHE
+        mol_name.clear_caches()
+        for i in xrange(cache.maxsize + 10):
+            mol_name.analyze_name("4a_TON_n%d" % (i + 1))
+        self.assertEqual(len(cache), cache.maxsize)
+        self.assertNotIn("4a_TON_n1", cache)
+        self.assertIn("4a_TON_n%d" % (cache.maxsize + 10), cache)
+
 
 class ExtractorTestCase(SimpleTestCase):
 
@@ -1070,6 +1464,32 @@ class ExtractorTestCase(SimpleTestCase):
         call_command("extract")
 
 
+class BenchmarkTestCase(SimpleTestCase):
+
+    def test_benchmark_ids(self):
+        f = StringIO()
+        benchmark.benchmark_ids(f, names=["4a_TON", "4a_TON_x2"])
+        lines = f.getvalue().strip().split('\n')
+        self.assertEqual(len(lines), 4)
+
+    def test_benchmark_parsing(self):
+        f = StringIO()
+        benchmark.benchmark_parsing(f, names=["A_TON_A_A_TD.log"])
+        lines = f.getvalue().strip().split('\n')
+        self.assertEqual(len(lines), 3)
+
+    def test_benchmark_unknown(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark", "ids", "nope")
+
+    def test_benchmark_parsing_differs(self):
+        with mock.patch.object(benchmark.ScanLog, "format_data",
+                               return_value=''):
+            with self.assertRaises(CommandError):
+                benchmark.benchmark_parsing(StringIO(),
+                                            names=["A_TON_A_A.log"])
+
+
 class UpdateMLTestCase(SimpleTestCase):
 
     def setUp(self):
@@ -1174,6 +1594,56 @@ class MLTestCase(SimpleTestCase):
         self.assertEqual(ml.get_decay_distance_correction_feature_vector(name),
                          DECAY_DISTANCE_CORRECTION_FEATURE_VECTOR)
 
+    def test_get_decay_feature_matrix(self):
+        names = [
+            "A**_TON_A**_A**_n1_m1_x1_y1_z1",
+            "A**_TON_2**4aa3**5aa2**5aa4aaA**_A**_n1_m1_x1_y1_z1",
+            "4aaA_CSN_A_A_n2_m1_x1_y1_z1",
+            "4aa4aa4aa_TPC_5ba4aa_-_n1_m3_x1_y2_z1",
+        ]
+        functions = [
+            (ml.get_decay_feature_matrix, ml.get_decay_feature_vector),
+            (ml.get_decay_distance_correction_feature_matrix,
+             ml.get_decay_distance_correction_feature_vector),
+        ]
+        for kwargs in [{}, {"power": 2, "H": 0.5, "lacunarity": 1.5}]:
+            for matrix_function, vector_function in functions:
+                X = matrix_function(iter(names), **kwargs)
+                self.assertEqual(X.shape,
+                                 (len(names), len(DECAY_FEATURE_VECTOR)))
+                for row, name in zip(X, names):
+                    vector = vector_function(name, **kwargs)
+                    for x, y in zip(row, vector):
+                        self.assertAlmostEqual(x, y)
+        self.assertEqual(ml.get_decay_feature_matrix([]).shape,
+                         (0, len(DECAY_FEATURE_VECTOR)))
+
+    def test_get_binary_feature_matrix(self):
+        names = [
+            "A**_TON_A**_A**_n1_m1_x1_y1_z1",
+            "4aa5aa6aa7aa_TON_A_A_n1_m1_x1_y1_z1",
+            "4aa5aa6aa7aa_TON_4aa5aa6aa7aa_4aa5aa6aa7aa_n1_m1_x1_y1_z1",
+        ]
+        X = ml.get_binary_feature_matrix(names)
+        full = ml.get_binary_feature_vector(names[2])
+        self.assertEqual(X.shape, (3, len(full)))
+        self.assertEqual(X[2].tolist(), full)
+        for row, name in zip(X, names):
+            vector = ml.get_binary_feature_vector(name)
+            self.assertEqual(row.sum(), sum(vector))
+            self.assertEqual(row[-6:].tolist(), vector[-6:])
+
+    def test_get_feature_matrix_invalid(self):
+        with self.assertRaises(ValueError):
+            ml.get_decay_feature_matrix(["4Q_TON_A_A_n1_m1_x1_y1_z1"])
+        names = ["A**_TON_A**_A**_n1_m1_x1_y1_z1", "4Q_TON_A_A_n1_m1_x1_y1_z1"]
+        errors = []
+        X = ml.get_decay_feature_matrix(names, errors=errors)
+        self.assertEqual([x for x, _ in errors], [1])
+        self.assertIsInstance(errors[0][1], ValueError)
+        self.assertEqual(X[0].tolist(), DECAY_FEATURE_VECTOR)
+        self.assertFalse(X[1].any())
+
     def test_MultiStageRegression(self):
         n = 5
         m = 2
@@ -1213,6 +1683,257 @@ class FileParserTestCase(SimpleTestCase):
         logset.parse_files([])
         self.assertEqual("\n\n", logset.format_output(errors=False))
 
+    def test_parse_files_unordered(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        files = ["A_TON_A_A.log", "A.log", "crazy.log", "transform.log"]
+        paths = [os.path.join(base, x) for x in files]
+        logset = fileparser.LogSet()
+        logset.parse_files(paths)
+        expected = sorted(logset.output)
+
+        with fileparser.LogCache(':memory:') as cache:
+            # The first gets cached so there is a mix of both
+            cache.get_log(paths[0])
+            logset = fileparser.LogSet(cache=cache)
+            logset.parse_files(paths, ordered=False, chunksize=1)
+            self.assertEqual(expected, sorted(logset.output))
+            self.assertEqual(len(logset.logs), len(files))
+            self.assertEqual(cache.hits, 1)
+
+    def test_parse_files_error(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        paths = [os.path.join(base, x) for x in ("A_TON_A_A.log", "A.log")]
+        missing = os.path.join(base, "missing.log")
+        logset = fileparser.LogSet()
+        logset.parse_files([paths[0], missing, paths[1]])
+
+        names = [x.split(',')[0] for x in logset.output]
+        self.assertEqual(names, paths)
+        self.assertEqual(len(logset.errors), 1)
+        self.assertTrue(logset.errors[0].startswith(missing + ": IOError"))
+
+    def test_iter_logs_all_cached(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with fileparser.LogCache(':memory:') as cache:
+            cache.get_log(path)
+            logset = fileparser.LogSet(cache=cache)
+            results = list(logset.iter_logs([path, path]))
+            self.assertEqual([x[0] for x in results], [path, path])
+            self.assertEqual(cache.hits, 2)
+
+    def test_standalone_stdout(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        paths = [os.path.join(base, x) for x in ("A_TON_A_A.log", "A.log")]
+        script = os.path.join(os.path.dirname(fileparser.__file__),
+                              "fileparser.py")
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "output.txt")
+            with open(os.devnull, 'w') as devnull:
+                output = subprocess.check_output(
+                    [sys.executable, script, "-E", "-o", "-"] + paths,
+                    stderr=devnull)
+                subprocess.check_call(
+                    [sys.executable, script, "-E", "-o", path] + paths,
+                    stderr=devnull)
+            # stdout ends with an extra blank line
+            with open(path, 'r') as f:
+                self.assertEqual(output, f.read() + '\n')
+        finally:
+            shutil.rmtree(tempdir)
+
+        lines = output.split('\n')
+        self.assertEqual(lines[0], fileparser.Log.format_header())
+        # A.log has two jobs
+        names = [x.split(',')[0] for x in lines[1:-4]]
+        self.assertEqual(names, [paths[0], paths[1], paths[1]])
+        self.assertEqual(lines[-4:], ["", "---- Errors (0) ----", "", ""])
+
+    def test_get_pool(self):
+        self.assertIs(fileparser.get_pool(), fileparser.get_pool())
+
+    def test_parse_files_cache(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        files = ["A_TON_A_A.log", "A.log", "crazy.log"]
+        paths = [os.path.join(base, x) for x in files]
+        logset = fileparser.LogSet(split_iter=True)
+        logset.parse_files(paths)
+        expected = logset.format_output()
+
+        with fileparser.LogCache(':memory:') as cache:
+            for i in xrange(2):
+                logset = fileparser.LogSet(split_iter=True, cache=cache)
+                logset.parse_files(paths)
+                self.assertEqual(expected, logset.format_output())
+            self.assertEqual(cache.misses, len(files))
+            self.assertEqual(cache.hits, len(files))
+            self.assertEqual(len(cache), len(files))
+
+    def test_log_cache_file_object(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            data = f.read()
+        expected = fileparser.Log(path).format_data()
+
+        with fileparser.LogCache(':memory:') as cache:
+            cache.get_log(path)
+            f = StringIO(data, name=path)
+            log = cache.get_log(f)
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(expected, log.format_data())
+            self.assertEqual(log.format_gjf(), fileparser.Log(path).format_gjf())
+
+    def test_log_cache_name(self):
+        # Some of the parsers use the name of the file
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            data = f.read()
+
+        with fileparser.LogCache(':memory:') as cache:
+            for name in ("A_TON_A_A.log", "TON.log"):
+                log = cache.get_log(StringIO(data, name=name))
+                expected = fileparser.Log(StringIO(data, name=name))
+                self.assertEqual(expected.format_data(), log.format_data())
+            self.assertEqual(cache.hits, 0)
+
+    def test_log_cache_no_sqlite(self):
+        with mock.patch.object(fileparser, "sqlite3", None):
+            with self.assertRaises(ImportError):
+                fileparser.LogCache(':memory:')
+
+    def test_log_cache_changed_file(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "A.log")
+            shutil.copy(os.path.join(base, "A_TON_A_A.log"), path)
+            with fileparser.LogCache(':memory:') as cache:
+                cache.get_log(path)
+                cache.get_log(path)
+                self.assertEqual(cache.hits, 1)
+
+                shutil.copy(os.path.join(base, "A_TON_A_A_TD.log"), path)
+                log = cache.get_log(path)
+                self.assertEqual(cache.misses, 2)
+                expected = fileparser.Log(path).format_data()
+                self.assertEqual(expected, log.format_data())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_log_cache_version(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with fileparser.LogCache(':memory:') as cache:
+            cache.get_log(path)
+            version = fileparser.Log.get_version()
+            with mock.patch.object(fileparser, "LOG_CACHE_VERSION", 2):
+                self.assertNotEqual(version, fileparser.Log.get_version())
+                cache.get_log(path)
+            self.assertEqual(cache.misses, 2)
+
+    def test_log_cache_eviction(self):
+        with fileparser.LogCache(':memory:', maxsize=2) as cache:
+            for i, digest in enumerate("abc"):
+                cache.set(digest, "key", "1", i)
+                cache.get("a", "key", "1")
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get("a", "key", "1"), 0)
+            self.assertIsNone(cache.get("b", "key", "1"))
+            self.assertEqual(cache.get("c", "key", "1"), 2)
+            self.assertIsNone(cache.get("c", "key", "2"))
+
+    def test_log_cache_get_value(self):
+        function = mock.Mock(return_value=(1, "a"))
+        f = StringIO("data")
+        with fileparser.LogCache(':memory:') as cache:
+            self.assertEqual(cache.get_value(f, "key", 1, function), (1, "a"))
+            self.assertEqual(cache.get_value(f, "key", 1, function), (1, "a"))
+        function.assert_called_once_with(f)
+
+    def test_log_cache_bad_file(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with fileparser.LogCache(':memory:') as cache:
+            cache.conn.execute("DROP TABLE logs")
+            log = cache.get_log(path)
+            self.assertEqual(log.format_data(),
+                             fileparser.Log(path).format_data())
+
+    def test_convergence(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "1_04_0.log")
+        log = fileparser.Log(path)
+        self.assertEqual(log["Convergence"], "YES YES NO YES")
+
+    def test_partial_log(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "transform.log")
+        with open(path, 'r') as f:
+            data = f.read()
+        tempdir = tempfile.mkdtemp()
+        try:
+            temp_path = os.path.join(tempdir, "transform.log")
+            log = fileparser.PartialLog(temp_path)
+            chunk = 100000
+            for i in xrange(0, len(data), chunk):
+                with open(temp_path, 'a') as f:
+                    f.write(data[i:i + chunk])
+                read = log.update()
+                self.assertEqual(log.offset, data.rfind('\n', 0, i + chunk) + 1)
+                self.assertLessEqual(read, chunk + 1000)
+                if i == chunk * 3:
+                    status = log.format_status().split(',')
+                    self.assertEqual(status[2:4], ["Running", "6"])
+                    self.assertEqual(status[5], "NO NO NO NO")
+            self.assertEqual(log.update(), 0)
+
+            expected = fileparser.Log(temp_path)
+            for split_iter in (False, True):
+                self.assertEqual(expected.format_data(split_iter),
+                                 log.get_log().format_data(split_iter))
+            self.assertEqual(expected.format_gjf(), log.get_log().format_gjf())
+            status = log.format_status().split(',')
+            self.assertEqual(status[2:], ["Completed", "56", "-2611.4497154",
+                                          "YES YES YES YES"])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_partial_log_state(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A.log")
+        with open(path, 'r') as f:
+            data = f.read()
+        tempdir = tempfile.mkdtemp()
+        try:
+            temp_path = os.path.join(tempdir, "A.log")
+            with open(temp_path, 'w') as f:
+                f.write(data[:len(data) // 3])
+            log = fileparser.PartialLog(temp_path)
+            log.update()
+
+            state = cPickle.loads(cPickle.dumps(log.get_state()))
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            log = fileparser.PartialLog.from_state(state)
+            log.update()
+
+            expected = fileparser.Log(temp_path).format_data(split_iter=True)
+            self.assertEqual(expected,
+                             log.get_log().format_data(split_iter=True))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_partial_log_replaced(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "A.log")
+            shutil.copy(os.path.join(base, "transform.log"), path)
+            log = fileparser.PartialLog(path)
+            log.update()
+
+            shutil.copy(os.path.join(base, "A_TON_A_A.log"), path)
+            log.update()
+            expected = fileparser.Log(path).format_data()
+            self.assertEqual(expected, log.get_log().format_data())
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_format_header(self):
         path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
         log = fileparser.Log(path)
@@ -1372,6 +2093,82 @@ class FileParserTestCase(SimpleTestCase):
         # Check if one of the huge vaules in it
         self.assertIn("-50394.5620476", actual[1])
 
+    def test_parse_dispatch(self):
+        names = [
+            "A_TON_A_A.log",
+            "A_TON_A_A_TD.log",
+            "A_CON_A_A_TDDFT.log",
+            "crazy.log",
+            "methane_windows.log",
+        ]
+        for name in names:
+            path = os.path.join(settings.MEDIA_ROOT, "tests", name)
+            log = fileparser.Log(path)
+            scan = benchmark.ScanLog(path)
+            self.assertEqual(log.parsers, scan.parsers)
+            self.assertEqual(log.format_data(split_iter=True),
+                             scan.format_data(split_iter=True))
+
+    def test_parse_dispatch_split_keys(self):
+        # Wrap the archive block so that keys like \HF= get split over lines
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            lines = f.read().split('\n')
+        start = [i for i, x in enumerate(lines) if x.startswith(" 1\\1\\")][0]
+        end = [i for i, x in enumerate(lines) if "\\@" in x][0] + 1
+        block = ''.join(x[1:] for x in lines[start:end])
+        for width in (3, 13):
+            wrapped = [' ' + block[i:i + width]
+                       for i in xrange(0, len(block), width)]
+            string = '\n'.join(lines[:start] + wrapped + lines[end:])
+            log = fileparser.Log(StringIO(string, name="A_TON_A_A.log"))
+            scan = benchmark.ScanLog(StringIO(string, name="A_TON_A_A.log"))
+            self.assertEqual(log.parsers, scan.parsers)
+
+    def test_log_reader(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            data = f.read()
+        for f in (path, StringIO(data, name=path)):
+            with fileparser.LogReader(f) as reader:
+                self.assertEqual(reader.name, path)
+                self.assertEqual(len(reader), len(data))
+                index = reader.build_index()
+                self.assertEqual(set(index), set(fileparser.SECTION_MARKERS))
+                for name, offsets in index.items():
+                    marker = fileparser.SECTION_MARKERS[name]
+                    lines = [x for x in data.split('\n') if marker in x]
+                    self.assertEqual(len(offsets), len(lines))
+                    for offset in offsets:
+                        line = next(reader.lines(offset))
+                        self.assertIn(marker, line)
+                        self.assertTrue(offset == 0 or data[offset - 1] == '\n')
+
+    def test_log_reader_lines(self):
+        data = "a\nbb\nccc\n"
+        with fileparser.LogReader(StringIO(data)) as reader:
+            self.assertEqual(list(reader.lines()), ["a\n", "bb\n", "ccc\n"])
+            self.assertEqual(list(reader.lines(2)), ["bb\n", "ccc\n"])
+            self.assertEqual(list(reader.lines(2, 5)), ["bb\n"])
+            self.assertIsNone(reader.first("orbitals"))
+            self.assertEqual(reader.last("orbitals", 10), 10)
+
+    def test_log_reader_rewinds(self):
+        f = StringIO("a\nbb\n")
+        f.read()
+        with fileparser.LogReader(f) as reader:
+            self.assertEqual(list(reader.lines()), ["a\n", "bb\n"])
+
+    def test_log_reader_empty(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "empty.log")
+        open(path, 'w').close()
+        try:
+            with fileparser.LogReader(path) as reader:
+                self.assertEqual(list(reader.lines()), [])
+                self.assertEqual(reader.offsets("start"), [])
+        finally:
+            os.remove(path)
+
     def test_Output_newline(self):
         out = fileparser.Output()
         string = "Some message"
@@ -1392,6 +2189,141 @@ class FileParserTestCase(SimpleTestCase):
         self.assertEqual(test.format_output(errors=True), expected)
 
 
+class PercentTestCase(SimpleTestCase):
+
+    def test_get_coordinates(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        log = fileparser.Log(path)
+        expected = [[float(y) for y in x.split()[1:]]
+                    for x in log["PartialGeometry"].strip().split('\n')]
+        with fileparser.LogReader(path) as reader:
+            coords = percent.get_coordinates(reader)
+        self.assertEqual(len(coords), len(expected))
+        self.assertEqual(len(coords[0]), 3)
+
+    def test_get_numbers_no_orbitals(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with fileparser.LogReader(path) as reader:
+            atom_idxs, elements, orb_values, occupied = \
+                percent.get_numbers(reader)
+        self.assertEqual(elements, [])
+        self.assertEqual(occupied, [])
+
+    def test_get_orbitals(self):
+        with fileparser.LogReader(StringIO(ORBITALS_LOG)) as reader:
+            orbitals = percent.get_orbitals(reader)
+        self.assertEqual(orbitals.atom_idxs.tolist(), [0, 0, 0, 0, 1])
+        self.assertEqual(orbitals.elements, ["C", "H"])
+        self.assertEqual(orbitals.occupied, [True, True, False, False, False])
+        self.assertEqual(orbitals.coeffs.shape, (5, 5))
+        self.assertEqual(orbitals.coeffs[:, 3].tolist(),
+                         [0.3, 0.1, -0.6, 0.2, 0.1])
+        self.assertEqual(orbitals.coeffs[4].tolist(),
+                         [0.05, -0.4, 0.6, 0.1, -0.5])
+        self.assertEqual(orbitals.energies.tolist(),
+                         [-11.0, -0.5, 0.2, 0.4, 0.6])
+
+    def test_get_group_populations(self):
+        with fileparser.LogReader(StringIO(ORBITALS_LOG)) as reader:
+            orbitals = percent.get_orbitals(reader)
+        populations = percent.get_group_populations(
+            orbitals.coeffs, orbitals.atom_idxs, set([0]), set([1]))
+        for i in xrange(orbitals.coeffs.shape[1]):
+            values = orbitals.coeffs[:, i].tolist()
+            expected = percent.calculate_groups(
+                values, orbitals.atom_idxs.tolist(), set([0]), set([1]))
+            results = percent.get_orbital_populations(populations, i)
+            for x, y in zip(results, expected):
+                self.assertAlmostEqual(x, y)
+        vert = sum(x ** 2 for x in orbitals.coeffs[:4, 1])
+        horz = orbitals.coeffs[4, 1] ** 2
+        results = percent.get_orbital_populations(populations, 1)
+        self.assertAlmostEqual(results[0], vert + horz)
+        self.assertAlmostEqual(results[2], 100 * vert / (vert + horz))
+
+    def test_get_group_indices(self):
+        mol = gjfwriter.NamedMolecule("4_TON_4_4").structure
+        vert, horz = percent.get_group_indices(mol)
+        self.assertTrue(vert)
+        self.assertTrue(horz)
+        self.assertFalse(set(vert) & set(horz))
+        stacked = gjfwriter.NamedMolecule("4_TON_4_4_x2").structure
+        self.assertEqual(percent.get_group_indices(stacked), (vert, horz))
+
+    def test_get_window_percents(self):
+        values = [(float(x), ) * 6 for x in xrange(5)]
+        rows = percent.get_window_percents(1, values, window=1)
+        self.assertEqual([x[0] for x in rows],
+                         ["HOMO-1", "HOMO", "LUMO", "LUMO+1"])
+        self.assertEqual(rows[1], ("HOMO", 2) + values[1])
+        rows = percent.get_window_percents(1, values, window=5)
+        self.assertEqual([x[1] for x in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[-1][0], "LUMO+2")
+
+    def test_get_percent_table_errors(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        rows, errors = percent.get_percent_table([path], window=2)
+        self.assertEqual(rows, [])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("does not have any orbitals", errors[0])
+
+    def test_get_percent_table_closes_cache(self):
+        with mock.patch.object(fileparser.LogCache, "close") as close:
+            percent.get_percent_table([], window=2)
+            close.assert_called_once_with()
+            close.reset_mock()
+            cache = fileparser.LogCache(":memory:")
+            percent.get_percent_table([], window=2, cache=cache)
+            self.assertFalse(close.called)
+
+
+class InterfaceTestCase(SimpleTestCase):
+
+    def test_get_multi_molecule(self):
+        names = list(mol_name.name_expansion("{4,5}{a,b}_TON_{A,B}_{4,5}"))
+        names.append("AA_TON")
+        self.assertTrue(len(names) >= interface.POOL_MIN_MOLECULES)
+        entries = list(interface.get_multi_molecule(names, ["gjf", "mol2"],
+                                                    {}, pool=True))
+        expected = list(interface.get_multi_molecule(names, ["gjf", "mol2"],
+                                                     {}))
+        self.assertEqual(entries, expected)
+
+        results = dict(entries)
+        files = set(x + y for x in names[:-1] for y in (".gjf", ".mol2"))
+        self.assertEqual(set(results) - files, set(["errors.txt"]))
+        self.assertIn("AA_TON", results["errors.txt"])
+        for name in names[:2]:
+            obj = gjfwriter.NamedMolecule(name)
+            self.assertEqual(results[name + ".gjf"], obj.get_gjf())
+
+    def test_map_molecule_files_no_pool(self):
+        jobs = [("TON", [".gjf"], {})] * interface.POOL_MIN_MOLECULES
+        with mock.patch("chemtools.interface.get_pool") as get_pool:
+            results = list(interface.map_molecule_files(jobs))
+        self.assertFalse(get_pool.called)
+        self.assertEqual(len(results), len(jobs))
+
+    def test_get_multi_job_errors(self):
+        def get_single_data(name):
+            if name == "B":
+                raise ValueError("bad name")
+            return {"name": name, "custom_template": True,
+                    "template": u"{{ name }}"}
+
+        form = mock.MagicMock()
+        form.get_single_data.side_effect = get_single_data
+        entries = list(interface.get_multi_job("A,B,C", form))
+        self.assertEqual(entries, [("A.job", u"A"), ("C.job", u"C"),
+                                   ("errors.txt", "B - bad name")])
+
+    def test_get_job_data(self):
+        settings = {"name": "{{ name }}_TD", "nodes": 1}
+        results = interface.get_job_data(settings, "TON")
+        self.assertEqual(results, {"name": "TON_TD", "nodes": 1})
+        self.assertEqual(settings["name"], "{{ name }}_TD")
+
+
 class UtilsTestCase(SimpleTestCase):
 
     def test_replace_geom_vars(self):
@@ -1411,6 +2343,71 @@ class UtilsTestCase(SimpleTestCase):
         results = utils.convert_zmatrix_to_cart(string)
         self.assertEqual(BENZENE_CART.strip(), results.strip())
 
+    def test_zmatrix_to_cart_previous_distances(self):
+        pairs = [
+            (METHANE, METHANE_CART_UNSIGNED),
+            (BENZENE, BENZENE_CART_UNSIGNED),
+        ]
+        for zmatrix, cart in pairs:
+            geom, variables = zmatrix.strip().split("\n\n")
+            string = utils.replace_geom_vars(geom, variables)
+            elements, coords = utils.zmatrix_to_cart(string)
+            expected_elements, expected = utils.parse_geometry(cart)
+            self.assertEqual(elements, expected_elements)
+            dists = numpy.linalg.norm(
+                coords[:, None] - coords[None, :], axis=2)
+            expected_dists = numpy.linalg.norm(
+                expected[:, None] - expected[None, :], axis=2)
+            self.assertTrue(numpy.allclose(dists, expected_dists, atol=1e-5))
+
+    def test_zmatrix_to_cart_dihedrals(self):
+        geom, variables = BENZENE.strip().split("\n\n")
+        string = utils.replace_geom_vars(geom, variables)
+        elements, coords = utils.zmatrix_to_cart(string)
+        for i, line in enumerate(string.split("\n")):
+            items = line.split()
+            if len(items) < 7:
+                continue
+            a, b, c = [coords[int(x) - 1] for x in items[1:7:2]]
+            radius, angle, dihedral = [float(x) for x in items[2:7:2]]
+            self.assertAlmostEqual(
+                numpy.linalg.norm(coords[i] - a), radius)
+
+            vec1 = coords[i] - a
+            vec2 = b - a
+            value = numpy.degrees(numpy.arccos(
+                vec1.dot(vec2) / numpy.linalg.norm(vec1) /
+                numpy.linalg.norm(vec2)))
+            self.assertAlmostEqual(value, angle)
+
+            axis = (b - a) / numpy.linalg.norm(b - a)
+            vec1 = (coords[i] - a) - (coords[i] - a).dot(axis) * axis
+            vec2 = (c - b) - (c - b).dot(axis) * axis
+            value = numpy.degrees(numpy.arctan2(
+                numpy.cross(axis, vec1).dot(vec2), vec1.dot(vec2)))
+            self.assertAlmostEqual(value, dihedral)
+
+    def test_calculate_bonds(self):
+        results = utils.calculate_bonds(METHANE_CART)
+        expected = "1 2 1\n1 3 1\n1 4 1\n1 5 1"
+        self.assertEqual(results, expected)
+
+    def test_get_bonds(self):
+        numpy.random.seed(0)
+        elements = [["C", "H", "N", "O", "S", "Si", "Xx"][x]
+                    for x in numpy.random.randint(0, 7, size=200)]
+        coords = numpy.random.uniform(-6, 6, size=(200, 3))
+        expected = []
+        for i, j in zip(*numpy.triu_indices(len(coords), 1)):
+            dist = numpy.linalg.norm(coords[i] - coords[j])
+            bond = utils.get_bond(elements[i], elements[j], dist)
+            if bond is not None:
+                expected.append((i, j, bond))
+        self.assertEqual(utils.get_bonds(elements, coords), expected)
+
+    def test_get_bonds_single_atom(self):
+        self.assertEqual(utils.get_bonds(["C"], [[0., 0., 0.]]), [])
+
     def test_find_repeating(self):
         tests = (
             ("4", ('4', 1)),
@@ -1482,6 +2479,35 @@ class GraphTestCase(SimpleTestCase):
         # self.assertEqual(graph.run_name("TON_7_CCC_94_EON"), set(
         #     ["TON", '7', "CCC", '9', '4', "E/ZON"]))
 
+    def test_get_rings(self):
+        mol = gjfwriter.NamedMolecule("4_TON").structure
+        g = graph.Graph(mol)
+        rings = graph.get_rings(g)
+        self.assertEqual(sorted(len(x) for x in rings), [5, 5, 6, 6])
+        for ring in rings:
+            for i, j in zip(ring, ring[1:] + ring[:1]):
+                self.assertIn(j, g.neighbors[i])
+        fused = graph.sort_fused_cycles(graph.get_fused_cycles(rings))
+        self.assertEqual(sorted([len(x) for x in y] for y in fused),
+                         [[5, 6, 5], [6]])
+
+    def test_get_rings_polymer(self):
+        mol = gjfwriter.NamedMolecule("TON_n3").structure
+        g = graph.Graph(mol)
+        self.assertEqual(len(graph.get_ring_systems(g)), 3)
+        self.assertEqual(len(graph.get_rings(g)), 9)
+
+    def test_graph_distance(self):
+        mol = gjfwriter.NamedMolecule("4_TON").structure
+        g = graph.Graph(mol)
+        for i, distance in graph.breadth_first_search(g, 0):
+            self.assertEqual(graph.graph_distance(g, 0, i), distance)
+        ring = graph.get_rings(g)[0]
+        ignore = set(ring[1:])
+        reached = [i for i, _ in graph.breadth_first_search(g, ring[0],
+                                                            ignore)]
+        self.assertFalse(ignore & set(reached))
+
 
 class RandomGenTestCase(SimpleTestCase):
     def test_random_names(self):
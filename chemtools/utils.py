@@ -4,6 +4,18 @@ import numpy
 from constants import BOND_LENGTHS
 
 
+# In order of preference
+BOND_TYPES = ["3", "2", "Ar", "1"]
+# The longest distance that get_bond could call a bond
+MAX_BOND_DISTANCE = 2 * max(max(x.values()) for x in BOND_LENGTHS.values())
+# The cell itself and the half of its neighbors that come after it, so that
+# each pair of cells is only compared once
+CELL_NEIGHBORS = [(0, 0, 0)] + [
+    (x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)
+    if (x, y, z) > (0, 0, 0)
+]
+
+
 def get_axis_rotation_matrix(axis, theta):
     # http://stackoverflow.com/questions/6721544/circular-rotation-around-an-arbitrary-axis
     ct = math.cos(theta)
@@ -38,72 +50,43 @@ def get_full_rotation_matrix(vector, azimuth, altitude):
     return rotxy.dot(rotz)
 
 
-def project_plane(normal, vec):
-    n = normal / numpy.linalg.norm(normal)
-    return vec - vec.T.dot(n) * n
-
-
-def angle_between(vec1, vec2):
-    dot = vec1.T.dot(vec2)[0, 0]
-    cross = numpy.cross(vec1.T, vec2.T)
-    norm = numpy.linalg.norm(cross)
-    # This is more numerically stable than the expected equation
-    # angle = acos((a * b) / (|a| * |b|))
-    return math.atan2(norm, dot)
-
-
-def get_dihedral(axis, coord1, coord2, coord3, coord4):
-    plane1 = project_plane(axis, coord4 - coord3)
-    plane2 = project_plane(axis, coord1 - coord2)
-    return angle_between(plane1, plane2)
-
-
 def new_point(coord1=None, radius=None,
               coord2=None, angle=None,
               coord3=None, dihedral=None):
+    '''Places a point from its Z-matrix values using the natural extension
+    reference frame (NERF) method. The coordinates are 1D arrays.'''
     if coord1 is None:
-        return numpy.zeros((3, 1))
+        return numpy.zeros(3)
 
-    coord = coord1 + numpy.array([[radius, 0., 0.]]).T
     if coord2 is None:
-        return coord
-
-    axis = numpy.cross((coord2 - coord1).T, (coord - coord1).T).T
-    if not numpy.abs(axis).sum():
-        # Note: This hack is required for things that are highly planar (ie
-        # Benzene). As expected the cross product of such vectors is < 0, 0, 0>
-        # ; however, this does not account for the sign of the zero! This extra
-        # bit of information determines which side of the zero point to go from
-        # and can mean the difference in the correct result and garbage.
-        # The string comparison is required because that is the only way to
-        # determine if it is negative zero.
-        if str(axis[2, 0]) == '-0.0':
-            axis = numpy.array([[0., 0., -1.]]).T
-        else:
-            axis = numpy.array([[0., 0., 1.]]).T
-    curr_angle = angle_between(coord2 - coord1, coord - coord1)
-    rot = get_axis_rotation_matrix(axis, math.radians(angle) - curr_angle)
-    coord = rot.dot(coord - coord1) + coord1
-    if coord3 is None:
-        return coord
+        return coord1 + [radius, 0., 0.]
 
-    axis = (coord2 - coord1)
-    curr_angle = get_dihedral(axis, coord, coord1, coord2, coord3)
-    r_dihedral = math.radians(dihedral)
-
-    def inner(rotation_amount):
-        rot = get_axis_rotation_matrix(axis, rotation_amount)
-        new_coord = rot.dot(coord - coord1) + coord1
-        angle = get_dihedral(axis, new_coord, coord1, coord2, coord3)
-        val = max(angle, r_dihedral) - min(angle, r_dihedral)
-        if val > math.pi:
-            val = (2 * math.pi) - angle
-        return val, new_coord
-
-    rotation_amount = curr_angle - math.radians(dihedral)
-    neg_val, neg_coord = inner(-rotation_amount)
-    pos_val, pos_coord = inner(rotation_amount)
-    return pos_coord if pos_val < neg_val else neg_coord
+    theta = math.radians(angle)
+    bond = coord2 - coord1
+    bond /= numpy.linalg.norm(bond)
+    if coord3 is None:
+        # Without a dihedral the point goes in the plane of the bond and the
+        # x axis (which is where the second point gets placed).
+        normal = numpy.cross(coord2 - coord1, [radius, 0., 0.])
+        if not numpy.abs(normal).sum():
+            # Note: This is required for things that are highly planar (ie
+            # Benzene). The cross product of such vectors is < 0, 0, 0>;
+            # however, the sign of the zero determines which side of the axis
+            # to go to and can mean the difference in the correct result and
+            # garbage.
+            normal = numpy.array([0., 0., -1. if numpy.signbit(normal[2])
+                                  else 1.])
+        normal /= numpy.linalg.norm(normal)
+        return coord1 + radius * (math.cos(theta) * bond +
+                                  math.sin(theta) * numpy.cross(normal, bond))
+
+    phi = math.radians(dihedral)
+    normal = numpy.cross(coord3 - coord2, bond)
+    normal /= numpy.linalg.norm(normal)
+    perp = numpy.cross(bond, normal)
+    return coord1 + radius * (math.cos(theta) * bond +
+                              math.sin(theta) * math.cos(phi) * perp +
+                              math.sin(theta) * math.sin(phi) * normal)
 
 
 def replace_geom_vars(geom, variables):
@@ -115,27 +98,32 @@ def replace_geom_vars(geom, variables):
     return geom
 
 
-def convert_zmatrix_to_cart(string):
-    elems = []
-    coords = []
-    for i, line in enumerate(x for x in string.split('\n') if x):
+def zmatrix_to_cart(string):
+    '''Returns the elements and an N x 3 array of the cartesian coordinates
+    of a Z-matrix.'''
+    lines = [x for x in string.split('\n') if x.strip()]
+    elements = []
+    coords = numpy.zeros((len(lines), 3))
+    for i, line in enumerate(lines):
         items = line.split()
-        elems.append(items[0])
+        elements.append(items[0])
         use = items[1:7]
         use[0::2] = [coords[int(x) - 1] for x in use[0::2]]
         use[1::2] = [float(x) for x in use[1::2]]
-        point = new_point(*use)
-        coords.append(point)
+        coords[i] = new_point(*use)
+    return elements, coords
 
+
+def convert_zmatrix_to_cart(string):
+    elements, coords = zmatrix_to_cart(string)
     new_string = ''
-    for elem, coord in zip(elems, coords):
-        new_string += " %s %0.8f %0.8f %0.8f\n" % tuple(
-            [elem] + coord.T.tolist()[0])
+    for elem, coord in zip(elements, coords.tolist()):
+        new_string += " %s %0.8f %0.8f %0.8f\n" % tuple([elem] + coord)
     return new_string
 
 
 def get_bond(element1, element2, dist):
-    for key in ["3", "2", "Ar", "1"]:
+    for key in BOND_TYPES:
         try:
             if dist < (BOND_LENGTHS[element1][key] + BOND_LENGTHS[element2][key]):
                 return key
@@ -143,23 +131,72 @@ def get_bond(element1, element2, dist):
             continue
 
 
+def get_bonds(elements, coords):
+    '''Returns a list of (index1, index2, type) tuples for all of the bonds
+    between the atoms. This uses the same cutoffs as get_bond, but only
+    compares atoms that are in neighboring cells of a grid with a cell size of
+    the longest possible bond.'''
+    coords = numpy.asarray(coords, dtype=float).reshape(-1, 3)
+    if len(coords) < 2:
+        return []
+
+    # The bond radii of each atom for each of the bond types, missing values
+    # are nan so that they never compare as a bond.
+    radii = numpy.array([[BOND_LENGTHS.get(x, {}).get(key, numpy.nan)
+                          for key in BOND_TYPES] for x in elements])
+
+    cells = numpy.floor((coords - coords.min(0)) / MAX_BOND_DISTANCE)
+    buckets = {}
+    for i, cell in enumerate(cells.astype(int).tolist()):
+        buckets.setdefault(tuple(cell), []).append(i)
+    buckets = {k: numpy.array(v) for k, v in buckets.items()}
+
+    firsts = []
+    seconds = []
+    for (x, y, z), idxs1 in buckets.iteritems():
+        for dx, dy, dz in CELL_NEIGHBORS:
+            idxs2 = buckets.get((x + dx, y + dy, z + dz))
+            if idxs2 is None:
+                continue
+            if (dx, dy, dz) == (0, 0, 0):
+                i, j = numpy.triu_indices(len(idxs1), 1)
+                first, second = idxs1[i], idxs1[j]
+            else:
+                first = numpy.repeat(idxs1, len(idxs2))
+                second = numpy.tile(idxs2, len(idxs1))
+            firsts.append(first)
+            seconds.append(second)
+
+    first = numpy.concatenate(firsts)
+    second = numpy.concatenate(seconds)
+    first, second = numpy.minimum(first, second), numpy.maximum(first, second)
+
+    dists = numpy.sqrt(((coords[first] - coords[second]) ** 2).sum(1))
+    with numpy.errstate(invalid="ignore"):
+        bonded = dists[:, None] < radii[first] + radii[second]
+    has_bond = bonded.any(1)
+    types = bonded.argmax(1)
+
+    first, second, types = first[has_bond], second[has_bond], types[has_bond]
+    order = numpy.lexsort((second, first))
+    return [(i, j, BOND_TYPES[t]) for i, j, t in
+            zip(first[order].tolist(), second[order].tolist(),
+                types[order].tolist())]
+
+
+def parse_geometry(string):
+    '''Returns the elements and an N x 3 array of coordinates from a string
+    of "element x y z" lines.'''
+    temp = [x.split()[-4:] for x in string.split('\n') if x.strip()]
+    elements = [x[0] for x in temp]
+    coords = numpy.array([x[1:] for x in temp], dtype=float).reshape(-1, 3)
+    return elements, coords
+
+
 def calculate_bonds(string):
-    temp = [x.split() for x in string.split('\n') if x.strip()]
-    atoms = [[ele, float(x), float(y), float(z)] for ele, x, y, z in temp]
-
-    bonds = []
-    for i, atom1 in enumerate(atoms):
-        for j, atom2 in enumerate(atoms[i + 1:]):
-            j += i + 1
-            element1, xyz1 = atom1[0], atom1[1:]
-            element2, xyz2 = atom2[0], atom2[1:]
-
-            dist = sum((x - y) ** 2 for (x, y) in zip(xyz1, xyz2)) ** 0.5
-
-            bond = get_bond(element1, element2, dist)
-            if bond is not None:
-                bonds.append("%d %d %s" % (i + 1, j + 1, bond))
-    return "\n".join(bonds)
+    elements, coords = parse_geometry(string)
+    bonds = get_bonds(elements, coords)
+    return "\n".join("%d %d %s" % (i + 1, j + 1, t) for i, j, t in bonds)
 
 
 def factorize(n):
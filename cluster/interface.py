@@ -4,8 +4,8 @@ import logging
 from django.utils import timezone
 
 from models import Job
-from utils import get_ssh_connection_obj, get_sftp_connection_obj, _run_job, \
-    get_jobs, add_fileparser, WANTED_COLS
+from utils import get_pooled_ssh_connection, get_pooled_sftp_connection, \
+    _run_job, get_jobs, add_fileparser, WANTED_COLS
 
 
 logger = logging.getLogger(__name__)
@@ -21,8 +21,8 @@ def run_job(credential, gjfstring, jobstring=None, **kwargs):
         if not credential.user.is_staff:
             results["error"] = "You must be a staff user to submit a job."
             return results
-        ssh = get_ssh_connection_obj(credential)
-        sftp = get_sftp_connection_obj(credential)
+        ssh = get_pooled_ssh_connection(credential)
+        sftp = get_pooled_sftp_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -54,8 +54,8 @@ def run_jobs(credential, names, gjfstrings, jobstring=None, **kwargs):
         if not credential.user.is_staff:
             results["error"] = "You must be a staff user to submit a job."
             return results
-        ssh = get_ssh_connection_obj(credential)
-        sftp = get_sftp_connection_obj(credential)
+        ssh = get_pooled_ssh_connection(credential)
+        sftp = get_pooled_sftp_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -95,7 +95,7 @@ def kill_jobs(credential, jobids):
         if not credential.user.is_staff:
             results["error"] = "You must be a staff user to kill a job."
             return results
-        ssh = credential.get_ssh_connection()
+        ssh = get_pooled_ssh_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -147,7 +147,7 @@ def get_specific_jobs(credential, jobids):
     }
     try:
         results["cluster"] = credential.cluster.name
-        credential.get_ssh_connection()
+        get_pooled_ssh_connection(credential).release()
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -180,8 +180,8 @@ def get_all_log_data(credential):
     }
     try:
         results["cluster"] = credential.cluster.name
-        ssh = credential.get_ssh_connection()
-        sftp = credential.get_sftp_connection()
+        ssh = get_pooled_ssh_connection(credential)
+        sftp = get_pooled_sftp_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -194,7 +194,7 @@ def get_all_log_data(credential):
             results["error"] = err
             return results
 
-        command = "python chemtools/fileparser.py -L -f chemtools/done"
+        command = "python chemtools/fileparser.py -L -C chemtools/logcache -f chemtools/done"
         _, stdout, stderr = ssh.exec_command(command)
 
         if err:
@@ -212,8 +212,8 @@ def get_log_data(credential, names):
     }
     try:
         results["cluster"] = credential.cluster.name
-        ssh = credential.get_ssh_connection()
-        sftp = credential.get_sftp_connection()
+        ssh = get_pooled_ssh_connection(credential)
+        sftp = get_pooled_sftp_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
@@ -233,7 +233,7 @@ def get_log_data(credential, names):
             for filename in names:
                 f.write('chemtools/done/%s.log\n' % filename)
 
-        command = "python chemtools/fileparser.py -L -i chemtools/files"
+        command = "python chemtools/fileparser.py -L -C chemtools/logcache -i chemtools/files"
         _, stdout, stderr = ssh.exec_command(command)
 
         err = stderr.read()
@@ -245,6 +245,47 @@ def get_log_data(credential, names):
     return results
 
 
+def get_log_progress(credential, names):
+    '''Gets the step, energy and convergence of running jobs. The parse of
+    each log picks up where the last call left off.'''
+    results = {
+        "results": None,
+        "error": None,
+    }
+    try:
+        results["cluster"] = credential.cluster.name
+        ssh = get_pooled_ssh_connection(credential)
+        sftp = get_pooled_sftp_connection(credential)
+    except:
+        results["error"] = "Invalid credential"
+        results["cluster"] = None
+        logger.info("Invalid credential %s" % credential)
+        return results
+
+    with ssh, sftp:
+        err = add_fileparser(ssh, sftp)
+        if err:
+            results["error"] = err
+            return results
+
+        with sftp.open("chemtools/files", 'w') as f:
+            for filename in names:
+                f.write('chemtools/%s.log\n' % filename)
+
+        command = "python chemtools/fileparser.py -F chemtools/progress -i chemtools/files"
+        _, stdout, stderr = ssh.exec_command(command)
+
+        # Warnings about single logs also end up in stderr
+        output = stdout.read()
+        err = stderr.read()
+        if err and not output:
+            results["error"] = err
+            return results
+
+        results["results"] = output
+    return results
+
+
 def get_log_status(credential, names):
     results = {
         "results": None,
@@ -252,7 +293,7 @@ def get_log_status(credential, names):
     }
     try:
         results["cluster"] = credential.cluster.name
-        ssh = credential.get_ssh_connection()
+        ssh = get_pooled_ssh_connection(credential)
     except:
         results["error"] = "Invalid credential"
         results["cluster"] = None
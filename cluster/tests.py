@@ -1,5 +1,8 @@
 import os
 import json
+import time
+import socket
+import threading
 
 from django.conf import settings
 from django.test import Client, TestCase
@@ -7,6 +10,7 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
 import mock
+import paramiko
 
 import views
 import models
@@ -14,7 +18,7 @@ import utils
 import interface
 from account.views import account_page
 from project.utils import get_sftp_connection, get_ssh_connection, AESCipher
-from project.utils import SSHClient, SFTPClient
+from project.utils import SSHClient, SFTPClient, ConnectionPool, SHELL_BASES
 from project.utils import StringIO
 
 
@@ -87,6 +91,8 @@ def build_mock_connections(obj):
     obj.addCleanup(patcher_ssh.stop)
     patcher_sftp = mock.patch('cluster.models.get_sftp_connection')
     obj.addCleanup(patcher_sftp.stop)
+    # The pool would otherwise hand out the mocks of an earlier test
+    obj.addCleanup(utils.CONNECTION_POOL.clear)
 
     mock_ssh = mock.MagicMock(SSHClient, name='SSH', autospec=True)
     mock_ssh.exec_command.side_effect = mock_exec_command
@@ -590,6 +596,27 @@ class UtilsTestCase(TestCase):
         ]
         self.assertEqual(results, expected)
 
+    def test_add_fileparser_current(self):
+        ssh = mock.MagicMock(SSHClient)
+        sftp = mock.MagicMock(SFTPClient)
+        digest = utils.get_fileparser_digest()
+        ssh.exec_command.side_effect = [
+            make_io_triplet(stdout=digest + "  chemtools/fileparser.py\n"),
+            make_io_triplet(),
+        ]
+        self.assertIsNone(utils.add_fileparser(ssh, sftp))
+        self.assertFalse(sftp.open.called)
+
+    def test_add_fileparser_changed(self):
+        ssh = mock.MagicMock(SSHClient)
+        sftp = mock.MagicMock(SFTPClient)
+        ssh.exec_command.side_effect = [
+            make_io_triplet(stdout="0" * 40 + "  chemtools/fileparser.py\n"),
+            make_io_triplet(),
+        ]
+        self.assertIsNone(utils.add_fileparser(ssh, sftp))
+        sftp.open.assert_called_once_with("chemtools/fileparser.py", 'w')
+
     def test_AES(self):
         cipher = AESCipher()
         string = "The quick brown fox jumps over the lazy dog."
@@ -821,6 +848,32 @@ class InterfaceTestCase(TestCase):
         with self.credential2.get_ssh_connection() as ssh:
             ssh.exec_command("rm chemtools/fileparser.py")
 
+    def test_get_log_progress(self):
+        self.mock_ssh.exec_command.side_effect = [
+            make_io_triplet(stdout="chemtools/fileparser.py"),
+            make_io_triplet(),
+            make_io_triplet(stdout="Filename,Name,Status,...",
+                            stderr="No handlers could be found"),
+        ]
+        results = interface.get_log_progress(self.credential2, ["A_TON_A_A"])
+        self.assertEqual(results["error"], None)
+        self.assertIn("Status", results["results"])
+        command = self.mock_ssh.exec_command.call_args[0][0]
+        self.assertIn("-F chemtools/progress", command)
+
+    def test_get_log_progress_error(self):
+        self.mock_ssh.exec_command.side_effect = [
+            make_io_triplet(stdout="chemtools/fileparser.py"),
+            make_io_triplet(),
+            make_io_triplet(stderr="Traceback"),
+        ]
+        results = interface.get_log_progress(self.credential2, ["A_TON_A_A"])
+        self.assertEqual(results["error"], "Traceback")
+
+    def test_get_log_progress_invalid_credential(self):
+        results = interface.get_log_progress(None, ["A_TON_A_A"])
+        self.assertEqual(results["error"], CRED_ERROR)
+
     def test_get_log_data_invalid_credential(self):
         results = interface.get_log_data(None, "24a_TON")
         self.assertEqual(results["error"], CRED_ERROR)
@@ -1027,3 +1080,189 @@ class SFTPClientTestCase(TestCase):
         with SFTPClient(test):
             pass
         mock_close.assert_called_once()
+
+
+class MockSSHInterface(paramiko.ServerInterface):
+    '''Accepts the SERVER login and answers every command with no output
+    while recording the commands that were run.'''
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (SERVER["username"], SERVER["password"]):
+            self.server.logins += 1
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.server.commands.append(command)
+        t = threading.Thread(target=self.finish_command, args=(channel, ))
+        t.daemon = True
+        t.start()
+        return True
+
+    def finish_command(self, channel):
+        # The request is only acknowledged after this method returns, and
+        # closing the channel first would make the request fail.
+        time.sleep(0.05)
+        channel.send_exit_status(0)
+        channel.close()
+
+
+class MockSSHServer(object):
+    '''An SSH and SFTP server on a free local port that runs in a thread.'''
+
+    def __init__(self, host_key):
+        self.host_key = host_key
+        self.logins = 0
+        self.commands = []
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+                                            paramiko.SFTPServerInterface)
+            transport.start_server(server=MockSSHInterface(self))
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ConnectionPoolTestCase, cls).setUpClass()
+        cls.host_key = paramiko.RSAKey.generate(1024)
+
+    def setUp(self):
+        self.server = MockSSHServer(self.host_key)
+        self.addCleanup(self.server.close)
+        self.pool = ConnectionPool(max_size=2, max_idle=60, keepalive=5)
+        self.addCleanup(self.pool.clear)
+        self.addCleanup(SHELL_BASES.clear)
+        self.addCleanup(utils.CONNECTION_POOL.clear)
+
+    def connect_ssh(self):
+        return get_ssh_connection("127.0.0.1", SERVER["username"],
+                                  password=SERVER["password"],
+                                  port=self.server.port)
+
+    def connect_sftp(self):
+        return get_sftp_connection("127.0.0.1", SERVER["username"],
+                                   password=SERVER["password"],
+                                   port=self.server.port)
+
+    def test_reuse_ssh(self):
+        for i in xrange(3):
+            with self.pool.acquire("key", self.connect_ssh) as ssh:
+                ssh.exec_command("qstat")[1].read()
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.commands,
+                         [". ~/.bash_profile; "] +
+                         [". ~/.bash_profile; qstat"] * 3)
+        stats = self.pool.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertEqual(stats["size"], 1)
+
+    def test_reuse_sftp(self):
+        for i in xrange(2):
+            with self.pool.acquire("key", self.connect_sftp) as sftp:
+                self.assertFalse(sftp.get_channel().closed)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_separate_keys(self):
+        with self.pool.acquire("key", self.connect_ssh):
+            with self.pool.acquire("key", self.connect_ssh):
+                pass
+        with self.pool.acquire("other", self.connect_ssh):
+            pass
+        self.assertEqual(self.server.logins, 3)
+        self.assertEqual(self.pool.get_stats()["size"], 3)
+
+    def test_max_size(self):
+        connections = [self.pool.acquire("key", self.connect_ssh)
+                       for i in xrange(3)]
+        transports = [x.get_transport() for x in connections]
+        for connection in connections:
+            connection.release()
+        self.assertEqual(self.pool.get_stats()["size"], 2)
+        self.assertFalse(transports[-1].is_active())
+
+    def test_evict_idle(self):
+        with self.pool.acquire("key", self.connect_ssh) as ssh:
+            transport = ssh.get_transport()
+        self.pool.evict(time.time() + 30)
+        self.assertEqual(self.pool.get_stats()["size"], 1)
+        self.pool.evict(time.time() + 61)
+        self.assertEqual(self.pool.get_stats()["size"], 0)
+        self.assertFalse(transport.is_active())
+
+    def test_health_check(self):
+        with self.pool.acquire("key", self.connect_ssh) as ssh:
+            transport = ssh.get_transport()
+        transport.close()
+        with self.pool.acquire("key", self.connect_ssh) as ssh:
+            self.assertTrue(ssh.get_transport().is_active())
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(self.pool.get_stats()["misses"], 2)
+
+    def test_network_error(self):
+        with self.assertRaises(socket.error):
+            with self.pool.acquire("key", self.connect_ssh) as ssh:
+                transport = ssh.get_transport()
+                raise socket.error
+        self.assertEqual(self.pool.get_stats()["size"], 0)
+        self.assertFalse(transport.is_active())
+
+    def test_keepalive(self):
+        with mock.patch.object(paramiko.Transport, "set_keepalive") as keep:
+            with self.pool.acquire("key", self.connect_ssh):
+                pass
+        keep.assert_called_once_with(5)
+
+    def test_shell_base_cached(self):
+        for i in xrange(2):
+            with self.connect_ssh() as ssh:
+                self.assertEqual(ssh.base, ". ~/.bash_profile; ")
+        self.assertEqual(self.server.logins, 2)
+        self.assertEqual(self.server.commands, [". ~/.bash_profile; "])
+
+    def test_interface(self):
+        user = get_user_model().objects.create_user(**USER)
+        cluster = models.Cluster(name="mock", hostname="127.0.0.1",
+                                 port=self.server.port)
+        cluster.save()
+        credential = models.Credential(user=user, cluster=cluster,
+                                       **CREDENTIAL)
+        credential.save()
+        for i in xrange(3):
+            results = interface.get_log_status(credential, ["name"])
+            self.assertIsNone(results["error"])
+        self.assertEqual(self.server.logins, 1)
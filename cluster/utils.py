@@ -1,8 +1,11 @@
+import hashlib
 import threading
 import logging
 from collections import defaultdict
 
-from project.utils import SSHClient, SFTPClient
+from django.conf import settings
+
+from project.utils import SSHClient, SFTPClient, ConnectionPool
 
 from models import Credential, Job
 from data.models import JobTemplate
@@ -41,6 +44,23 @@ def get_sftp_connection_obj(obj):
         raise TypeError
 
 
+CONNECTION_POOL = ConnectionPool(max_size=settings.SSH_POOL_SIZE,
+                                 max_idle=settings.SSH_POOL_IDLE_TIMEOUT,
+                                 keepalive=settings.SSH_KEEPALIVE)
+
+
+def get_pooled_ssh_connection(credential):
+    key = ("ssh", credential.get_long_name())
+    return CONNECTION_POOL.acquire(
+        key, lambda: get_ssh_connection_obj(credential))
+
+
+def get_pooled_sftp_connection(credential):
+    key = ("sftp", credential.get_long_name())
+    return CONNECTION_POOL.acquire(
+        key, lambda: get_sftp_connection_obj(credential))
+
+
 def get_credentials_from_request(request):
     creds = []
     usercreds = request.user.credentials.all()
@@ -90,10 +110,18 @@ def _make_folders(ssh):
     return None
 
 
+def get_fileparser_digest():
+    with open("chemtools/fileparser.py", 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
 def add_fileparser(ssh, sftp):
-    command = "ls chemtools/fileparser.py"
+    # The copy on the cluster is replaced whenever its checksum differs from
+    # the local one, so that every change to the parser gets pushed.
+    command = "sha1sum chemtools/fileparser.py"
     _, stdout, stderr = ssh.exec_command(command)
-    if stderr.read():
+    remote = stdout.read().split()
+    if stderr.read() or not remote or remote[0] != get_fileparser_digest():
         with sftp.open("chemtools/fileparser.py", 'w') as f:
             with open("chemtools/fileparser.py", 'r') as f2:
                 f.write(f2.read())
@@ -172,7 +200,7 @@ def _get_columns(lines):
 
 def _get_jobs(cred, cluster, i, results):
     try:
-        ssh = cred.get_ssh_connection()
+        ssh = get_pooled_ssh_connection(cred)
 
         with ssh:
             # TODO: Make this safer
@@ -1,8 +1,9 @@
 import csv
+from collections import OrderedDict
 
 from django.utils import timezone
 
-from chemtools.ml import get_decay_feature_vector
+from chemtools.ml import get_decay_feature_matrix
 from chemtools.mol_name import get_exact_name
 from models import DataPoint, FeatureVector
 
@@ -40,50 +41,56 @@ def main(csvfile):
     # TODO use Pandas
     reader = csv.reader(csvfile, delimiter=',', quotechar='"')
 
-    points = []
-    feature_vectors = []
+    rows = []
+    for i, row in enumerate(reader):
+        if not i:
+            mapping = get_mapping(row)
+            continue
+        if row == [] or len(row) < max(mapping.values()):
+            continue
+        try:
+            exact_name = get_exact_name(row[mapping["Name"]])
+        except Exception:
+            exact_name = None
+        rows.append((row, exact_name))
 
-    idxs = set()
-    names = set()
     preexist = set(
         FeatureVector.objects.all().values_list("exact_name", flat=True))
+    # The feature vectors of all of the new names are found in one batch,
+    # names that do not have one are just loaded without it.
+    exact_names = [x for x in OrderedDict.fromkeys(x for _, x in rows)
+                   if x is not None and x not in preexist]
+    errors = []
+    FEATURES = get_decay_feature_matrix(exact_names, errors=errors)
+    invalid = set(exact_names[i] for i, _ in errors)
 
+    points = []
+    feature_vectors = []
+    idxs = set()
     now = timezone.now()
 
-    count = 0
-    for i, row in enumerate(reader):
-        if not i:
-            mapping = get_mapping(row)
-            continue
-        if row == [] or len(row) < max(mapping.values()):
+    for i, exact_name in enumerate(exact_names):
+        if exact_name in invalid:
             continue
         try:
-            try:
-                exact_name = get_exact_name(row[mapping["Name"]])
-                try:
-                    decay_feature = get_decay_feature_vector(exact_name)
-                    feature_vector = True
-                    if exact_name not in names and exact_name not in preexist:
-                        temp = FeatureVector(
-                            exact_name=exact_name,
-                            type=FeatureVector.DECAY,
-                            vector=decay_feature,
-                            created=now)
-
-                        temp.clean_fields()
-                        feature_vectors.append(temp)
-                        names.add(exact_name)
-
-                        if len(feature_vectors) > 150:
-                            FeatureVector.objects.bulk_create(feature_vectors)
-                            feature_vectors = []
-
-                except Exception:
-                    feature_vector = None
-            except Exception:
-                feature_vector = None
-                exact_name = None
+            temp = FeatureVector(
+                exact_name=exact_name,
+                type=FeatureVector.DECAY,
+                vector=FEATURES[i].tolist(),
+                created=now)
+            temp.clean_fields()
+        except Exception:
+            invalid.add(exact_name)
+            continue
+        feature_vectors.append(temp)
 
+        if len(feature_vectors) > 150:
+            FeatureVector.objects.bulk_create(feature_vectors)
+            feature_vectors = []
+
+    count = 0
+    for row, exact_name in rows:
+        try:
             band_gap = row[mapping["BandGap"]]
             data = {
                 "name": row[mapping["Name"]],
@@ -104,7 +111,7 @@ def main(csvfile):
             if len(points) > 50:
                 DataPoint.objects.bulk_create(points)
                 points = []
-            if feature_vector is not None:
+            if exact_name is not None and exact_name not in invalid:
                 idxs.add(count)
 
             count += 1
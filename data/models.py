@@ -44,20 +44,31 @@ class DataPoint(models.Model):
 
     @classmethod
     def get_all_data(cls, type=1):
-        data = DataPoint.objects.filter(band_gap__isnull=False,
-                                        exact_name__isnull=False,
-                                        vectors__type=type)
+        # The values and vectors all come from one query on the join table
+        # instead of a query for the vector of each point.
+        Through = cls.vectors.through
+        data = Through.objects.filter(
+            datapoint__band_gap__isnull=False,
+            datapoint__exact_name__isnull=False,
+            featurevector__type=type).order_by("datapoint").values_list(
+            "datapoint__homo", "datapoint__lumo", "datapoint__band_gap",
+            "featurevector__vector")
+        data = list(data)
+        to_python = FeatureVector._meta.get_field("vector").to_python
+
         M = len(data)
         HOMO = numpy.zeros((M, 1))
         LUMO = numpy.zeros((M, 1))
         GAP = numpy.zeros((M, 1))
-        vectors = []
-        for i, x in enumerate(data):
-            HOMO[i] = x.homo
-            LUMO[i] = x.lumo
-            GAP[i] = x.band_gap
-            vectors.append(x.vectors.get(type=type).vector)
-        FEATURE = numpy.array(vectors)
+        FEATURE = numpy.zeros((M, 0))
+        for i, (homo, lumo, band_gap, vector) in enumerate(data):
+            vector = to_python(vector)
+            if not i:
+                FEATURE = numpy.zeros((M, len(vector)))
+            HOMO[i] = homo
+            LUMO[i] = lumo
+            GAP[i] = band_gap
+            FEATURE[i] = vector
         return FEATURE, HOMO, LUMO, GAP
 
 
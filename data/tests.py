@@ -15,6 +15,7 @@ import models
 import load_data
 from account.views import account_page
 from chemtools.constants import RGROUPS, ARYL
+from chemtools.ml import get_decay_feature_vector
 from project.utils import StringIO
 
 
@@ -236,6 +237,29 @@ class ModelTestCase(TestCase):
         self.assertTrue((LUMO == numpy.array([[2.0]])).all())
         self.assertTrue((GAP == numpy.array([[2.0]])).all())
 
+    def test_get_all_data_queries(self):
+        for i in xrange(5):
+            vector = models.FeatureVector(type=1, exact_name="Name%d" % i,
+                                          vector=[i, i + 1, i + 2])
+            vector.save()
+            data = models.DataPoint(name="Name%d" % i, exact_name="Name%d" % i,
+                                    options="", homo=i, lumo=i + 1,
+                                    homo_orbital=1, dipole=0.0, energy=0.0,
+                                    band_gap=1.0)
+            data.save()
+            data.vectors.add(vector)
+        with self.assertNumQueries(1):
+            FEATURE, HOMO, LUMO, GAP = models.DataPoint.get_all_data()
+        self.assertEqual(FEATURE.shape, (6, 3))
+        self.assertEqual(FEATURE[1:].tolist(),
+                         [[i, i + 1, i + 2] for i in xrange(5)])
+        self.assertEqual(HOMO[1:, 0].tolist(), range(5))
+
+    def test_get_all_data_empty(self):
+        FEATURE, HOMO, LUMO, GAP = models.DataPoint.get_all_data(type=3)
+        self.assertEqual(FEATURE.shape[0], 0)
+        self.assertEqual(HOMO.shape, (0, 1))
+
     def test_jobtemplate(self):
         data = OPTIONS.copy()
         data["custom_template"] = True
@@ -274,6 +298,23 @@ class LoadDataTestCase(TestCase):
         with open(path, 'r') as f:
             load_data.main(f)
 
+    def test_load_data_vectors(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "data.csv")
+        with open(path, 'r') as f:
+            load_data.main(f)
+        vectors = models.FeatureVector.objects.all()
+        self.assertTrue(vectors)
+        for vector in vectors:
+            self.assertEqual(vector.vector,
+                             get_decay_feature_vector(vector.exact_name))
+        for point in models.DataPoint.objects.exclude(exact_name=None):
+            try:
+                get_decay_feature_vector(point.exact_name)
+                expected = 1
+            except ValueError:
+                expected = 0
+            self.assertEqual(point.vectors.count(), expected)
+
     def test_load_data_long(self):
         path = os.path.join(settings.MEDIA_ROOT, "tests", "data_long.csv")
         with open(path, 'r') as f:
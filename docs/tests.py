@@ -1,12 +1,14 @@
 import os
 
 from django.test import Client, TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.core.management import call_command
 
 import views
 
 
+@override_settings(IMAGE_CACHE_PATH=':memory:')
 class DocsTestCase(TestCase):
 
     def setUp(self):
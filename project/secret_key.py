@@ -0,0 +1,2 @@
+SECRET_KEY = 'kjt^q!-oe66-dzszq%h7%mosg+95#b106kc)mg@n8&)xc@z_x$x*ehj+jvd(fm6$'
+AES_KEY = b'\x86[Z\xb4\x15\x88\x03\xc2^\xa2H|S\xa6\x15\xd7'
@@ -55,6 +55,21 @@ DATABASES = {
     }
 }
 
+# The sqlite file that parsed logs are cached in (see fileparser.LogCache)
+LOG_CACHE_PATH = os.path.join(ROOT_PATH, 'logcache')
+# The sqlite file that drawn molecules are cached in (see
+# gjfwriter.ImageCache)
+IMAGE_CACHE_PATH = os.path.join(ROOT_PATH, 'imagecache')
+# The zlib level (0-9) that downloaded zips are compressed with. 0 stores the
+# files without compressing them.
+ZIP_COMPRESSION_LEVEL = 6
+# The cluster SSH and SFTP connections that are kept open between requests
+# (see cluster.utils.CONNECTION_POOL). Up to SSH_POOL_SIZE idle connections
+# are kept per credential and closed after SSH_POOL_IDLE_TIMEOUT seconds.
+SSH_POOL_SIZE = 4
+SSH_POOL_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE = 30
+
 AUTH_USER_MODEL = 'account.CustomUser'
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
@@ -181,6 +196,7 @@ INSTALLED_APPS = (
     'docs',
     'data',
     'cluster',
+    'tasks',
     'crispy_forms',
 )
 
@@ -10,6 +10,7 @@ urlpatterns = patterns('',
                        url(r'^u/', include("account.urls")),
                        url(r'^docs/', include("docs.urls")),
                        url(r'^chem/jobs/', include("cluster.urls")),
+                       url(r'^tasks/', include("tasks.urls")),
                        url(r'^chem/', include("data.urls")),
                        url(r'^chem/', include("chem.urls")),
                        url(r'^admin/', include(admin.site.urls)),
@@ -1,6 +1,12 @@
 import os
+import socket
 import cStringIO
 import base64
+import collections
+import threading
+import time
+import zipfile
+import zlib
 
 from Crypto.Cipher import AES
 from Crypto import Random
@@ -37,6 +43,85 @@ class StringIO(object):
         self.close()
 
 
+class ZipBuffer(object):
+    '''A write only file that keeps the bytes written to it until they are
+    taken with pop. It still counts them so tell gives the position in the
+    whole stream.'''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ZipStream(zipfile.ZipFile):
+    '''A zip that is never stored. writestr and close return the bytes they
+    add to the archive so that they can be sent on as soon as each entry is
+    made. The entries are compressed with the given zlib level, and a level
+    of 0 stores them uncompressed.'''
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.level = level
+        self.buffer = ZipBuffer()
+        compression = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+        super(ZipStream, self).__init__(self.buffer, "w", compression,
+                                        allowZip64=True)
+
+    def writestr(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        zinfo = zipfile.ZipInfo(filename=name,
+                                date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(data)
+        zinfo.header_offset = self.buffer.tell()
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            co = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            data = co.compress(data) + co.flush()
+        zinfo.compress_size = len(data)
+        zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+
+        self.buffer.write(zinfo.FileHeader(zip64))
+        self.buffer.write(data)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        return self.buffer.pop()
+
+    def close(self):
+        super(ZipStream, self).close()
+        return self.buffer.pop()
+
+
+def stream_zip(entries, level=zlib.Z_DEFAULT_COMPRESSION):
+    '''Yields the bytes of a zip of the (name, data) entries, one chunk per
+    entry as it is made and then the central directory.'''
+    zfile = ZipStream(level)
+    for name, data in entries:
+        yield zfile.writestr(name, data)
+    yield zfile.close()
+
+
+# The shell prefix found for each (hostname, port, username) so that new
+# connections to the same account do not have to search for it again.
+SHELL_BASES = {}
+
+
 class SSHClient(paramiko.SSHClient):
 
     def __init__(self, *args, **kwargs):
@@ -55,14 +140,24 @@ class SSHClient(paramiko.SSHClient):
 
     def connect(self, *args, **kwargs):
         super(SSHClient, self).connect(*args, **kwargs)
-        self.determine_base()
-
-    def determine_base(self):
+        hostname = args[0] if args else kwargs.get("hostname")
+        if hostname is None:
+            self.determine_base()
+        else:
+            key = (hostname, kwargs.get("port", 22), kwargs.get("username"))
+            self.determine_base(key)
+
+    def determine_base(self, key=None):
+        if key in SHELL_BASES:
+            self.base = SHELL_BASES[key]
+            return
         bases = [". ~/.bash_profile; ", "source .login; ", ". ~/.bashrc; "]
         for base in bases:
             _, _, err = self.exec_command(base)
             if not err.readlines():
                 self.base = base
+                if key is not None:
+                    SHELL_BASES[key] = base
                 return
         raise ValueError("Could not find command base")
 
@@ -111,6 +206,157 @@ def get_ssh_connection(hostname, username, key=None, password=None,
     return client
 
 
+def get_connection_transport(connection):
+    if isinstance(connection, paramiko.SFTPClient):
+        channel = connection.get_channel()
+        if channel is None or channel.closed:
+            return None
+        return channel.get_transport()
+    return connection.get_transport()
+
+
+def connection_is_alive(connection):
+    transport = get_connection_transport(connection)
+    return transport is not None and transport.is_active()
+
+
+def close_connection(connection):
+    transport = get_connection_transport(connection)
+    try:
+        connection.close()
+        # SFTP connections own their transport, closing the client only
+        # closes the channel on it.
+        if transport is not None:
+            transport.close()
+    except Exception:
+        pass
+
+
+class PooledConnection(object):
+    '''An SSH or SFTP connection borrowed from a ConnectionPool. It can be
+    used like the connection it wraps, but leaving the with block gives it
+    back to the pool instead of closing it. Connections that raised a network
+    error are closed instead.'''
+
+    def __init__(self, pool, key, connection):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+
+    def __getattr__(self, key):
+        return getattr(self.connection, key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        errors = (socket.error, EOFError, paramiko.SSHException)
+        if type is not None and issubclass(type, errors):
+            self.close()
+        else:
+            self.release()
+
+    def release(self):
+        if self.connection is not None:
+            self.pool.release(self.key, self.connection)
+            self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            close_connection(self.connection)
+            self.connection = None
+
+
+class ConnectionPool(object):
+    '''Keeps SSH and SFTP connections open between uses so that they do not
+    have to be negotiated and authenticated again. Up to max_size idle
+    connections are kept for each key. They are checked before they are
+    handed out and closed once they have been idle for more than max_idle
+    seconds. New transports send a keepalive every keepalive seconds so that
+    they are not dropped by the server while they wait.'''
+
+    def __init__(self, max_size=4, max_idle=300, keepalive=30):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.hits = 0
+        self.misses = 0
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, connect):
+        '''Returns a PooledConnection for key. An idle connection is used if
+        one is still alive, otherwise connect is called to make a new one.'''
+        stale = self._pop_stale(time.time())
+        connection = None
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                value, _ = idle.pop()
+                if connection_is_alive(value):
+                    connection = value
+                    self.hits += 1
+                    break
+                stale.append(value)
+            else:
+                self.misses += 1
+        for value in stale:
+            close_connection(value)
+
+        if connection is None:
+            connection = connect()
+            transport = get_connection_transport(connection)
+            if transport is not None and self.keepalive:
+                transport.set_keepalive(self.keepalive)
+        return PooledConnection(self, key, connection)
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.max_size and connection_is_alive(connection):
+                idle.append((connection, time.time()))
+                return
+        close_connection(connection)
+
+    def _pop_stale(self, now):
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = [x for x in idle if now - x[1] <= self.max_idle]
+                stale.extend(x[0] for x in idle if now - x[1] > self.max_idle)
+                if fresh:
+                    self._idle[key] = fresh
+                else:
+                    del self._idle[key]
+        return stale
+
+    def evict(self, now=None):
+        '''Closes the connections that have been idle for too long.'''
+        if now is None:
+            now = time.time()
+        for connection in self._pop_stale(now):
+            close_connection(connection)
+
+    def clear(self):
+        with self._lock:
+            connections = [x[0] for idle in self._idle.values() for x in idle]
+            self._idle.clear()
+            self.hits = 0
+            self.misses = 0
+        for connection in connections:
+            close_connection(connection)
+
+    def get_stats(self):
+        with self._lock:
+            size = sum(len(x) for x in self._idle.values())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": size,
+            "maxsize": self.max_size,
+        }
+
+
 class AESCipher(object):
     # http://stackoverflow.com/questions/12524994/encrypt-decrypt-using-pycrypto-aes-256
     BS = AES.block_size
@@ -0,0 +1,12 @@
+from django.contrib import admin
+
+from models import Task
+
+
+class TaskAdmin(admin.ModelAdmin):
+    date_hierarchy = "created"
+    list_display = ("function", "token", "status", "user", "created",
+                    "finished")
+    exclude = ("arguments", )
+
+admin.site.register(Task, TaskAdmin)
@@ -0,0 +1,33 @@
+import time
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from chemtools.fileparser import get_pool
+from tasks.utils import run_tasks
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Run queued tasks'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help='Exit once the queue is empty'),
+        make_option('--sleep', type='float', default=2.0,
+                    help='Seconds to wait when the queue is empty'),
+    )
+
+    def handle(self, *args, **options):
+        # The worker pool is forked before any task can start threads
+        get_pool()
+        while True:
+            count = run_tasks()
+            if count:
+                logger.info("Ran %d task(s)" % count)
+            if options["once"]:
+                return
+            time.sleep(options["sleep"])
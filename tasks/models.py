@@ -0,0 +1,53 @@
+import json
+import cPickle
+
+from django.db import models
+from django.conf import settings
+
+
+class Task(models.Model):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+    token = models.CharField(max_length=32, unique=True)
+    function = models.CharField(max_length=200)
+    arguments = models.BinaryField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='tasks',
+                             null=True, blank=True)
+    status = models.IntegerField(choices=STATUS_CHOICES, default=QUEUED)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    output = models.FileField(upload_to="tasks", null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.function, self.token)
+
+    def get_arguments(self):
+        '''Returns the (args, kwargs) that the function is called with.'''
+        return cPickle.loads(str(self.arguments))
+
+    def get_json(self):
+        output = None
+        if self.output:
+            output = self.output.url
+        return {
+            "token": self.token,
+            "function": self.function,
+            "status": self.get_status_display(),
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error or None,
+            "output": output,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
@@ -0,0 +1,107 @@
+import json
+import shutil
+import tempfile
+
+from django.test import Client, TestCase
+from django.core.files import File
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.contrib.auth import get_user_model
+
+from project.utils import StringIO
+from models import Task
+import utils
+import views
+
+
+def add(x, y=0):
+    return x + y
+
+
+def fail():
+    raise ValueError("bad value")
+
+
+def write_file(string):
+    return File(StringIO(string), name="output.txt")
+
+
+class TaskTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def get_status(self, task):
+        response = self.client.get(reverse(views.task_status,
+                                           args=(task.token, )))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_enqueue(self):
+        user = get_user_model().objects.create_user("user", "a@a.com", "pw")
+        task = utils.enqueue(add, args=(1, ), kwargs={"y": 2}, user=user)
+        self.assertEqual(task.function, "tasks.tests.add")
+        self.assertEqual(task.get_arguments(), ((1, ), {"y": 2}))
+        self.assertEqual(list(user.tasks.all()), [task])
+
+        value = self.get_status(task)
+        self.assertEqual(value["status"], "Queued")
+        self.assertIsNone(value["result"])
+
+        self.assertEqual(utils.run_tasks(), 1)
+        value = self.get_status(task)
+        self.assertEqual(value["status"], "Done")
+        self.assertEqual(value["result"], 3)
+        self.assertIsNone(value["error"])
+        self.assertIsNotNone(value["finished"])
+
+    def test_enqueue_model_instance(self):
+        user = get_user_model().objects.create_user("user", "a@a.com", "pw")
+        with self.assertRaises(TypeError):
+            utils.enqueue(add, args=([user], ))
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_run_task_error(self):
+        task = utils.run_task(utils.enqueue(fail))
+        self.assertEqual(task.status, Task.FAILED)
+        value = self.get_status(task)
+        self.assertEqual(value["status"], "Failed")
+        self.assertEqual(value["error"], "bad value")
+
+    def test_run_task_file(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            task = utils.run_task(utils.enqueue(write_file, args=("data", )))
+            self.assertEqual(task.status, Task.DONE)
+            self.assertTrue(task.output.path.startswith(self.media_root))
+            with open(task.output.path, 'r') as f:
+                self.assertEqual(f.read(), "data")
+            self.assertEqual(self.get_status(task)["output"], task.output.url)
+
+    def test_claim_next_task(self):
+        first = utils.enqueue(add, args=(1, ))
+        second = utils.enqueue(add, args=(2, ))
+        self.assertEqual(utils.claim_next_task(), first)
+        self.assertEqual(utils.claim_next_task(), second)
+        self.assertIsNone(utils.claim_next_task())
+        self.assertEqual(Task.objects.get(id=first.id).status, Task.RUNNING)
+        self.assertEqual(utils.run_tasks(), 0)
+
+    def test_run_tasks_limit(self):
+        for i in xrange(3):
+            utils.enqueue(add, args=(i, ))
+        self.assertEqual(utils.run_tasks(limit=2), 2)
+        self.assertEqual(Task.objects.filter(status=Task.QUEUED).count(), 1)
+
+    def test_run_tasks_command(self):
+        task = utils.enqueue(add, args=(1, ))
+        call_command("run_tasks", once=True)
+        self.assertEqual(Task.objects.get(id=task.id).status, Task.DONE)
+
+    def test_task_status_missing(self):
+        response = self.client.get(reverse(views.task_status,
+                                           args=("0" * 32, )))
+        self.assertEqual(response.status_code, 404)
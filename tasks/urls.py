@@ -0,0 +1,7 @@
+from django.conf.urls import patterns, url
+
+
+urlpatterns = patterns('tasks.views',
+                       url(r"^(?P<token>[0-9a-f]+)/$", "task_status",
+                           name="task_status"),
+                       )
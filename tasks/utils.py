@@ -0,0 +1,108 @@
+import json
+import uuid
+import cPickle
+import cStringIO
+import logging
+
+from django.db import models
+from django.http import HttpResponse
+from django.core.files import File
+from django.core.urlresolvers import reverse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.module_loading import import_by_path
+
+from models import Task
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_argument(obj):
+    # Model instances can hold secrets, such as the decrypted password of a
+    # Credential, which would end up in the task table. Their ids are passed
+    # instead and the function loads them again.
+    if isinstance(obj, models.Model):
+        raise TypeError("Queue the id of %s instead of the instance" %
+                        type(obj).__name__)
+    return None
+
+
+def enqueue(function, args=(), kwargs=None, user=None):
+    '''Adds a call of function to the queue and returns its Task. The
+    function has to be importable by the worker, and the arguments have to
+    be picklable and can not be model instances.'''
+    if kwargs is None:
+        kwargs = {}
+    name = "%s.%s" % (function.__module__, function.__name__)
+    f = cStringIO.StringIO()
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = check_argument
+    pickler.dump((args, kwargs))
+    arguments = f.getvalue()
+    return Task.objects.create(token=uuid.uuid4().hex, function=name,
+                               arguments=arguments, user=user)
+
+
+def get_task_user(request):
+    '''Returns the user that the tasks queued by a request belong to.'''
+    if request.user.is_authenticated():
+        return request.user
+
+
+def get_queued_response(task):
+    '''Returns the response that a view gives instead of its results when
+    they have been queued.'''
+    a = {
+        "token": task.token,
+        "url": reverse("task_status", args=(task.token, )),
+    }
+    return HttpResponse(json.dumps(a), content_type="application/json")
+
+
+def claim_next_task():
+    '''Marks the oldest queued task as running and returns it, or None if
+    nothing is queued. The status is only changed if the task is still
+    queued, so two workers never run the same task.'''
+    queued = Task.objects.filter(status=Task.QUEUED)
+    for task_id in queued.order_by("created", "id").values_list("id",
+                                                                flat=True):
+        claimed = Task.objects.filter(id=task_id, status=Task.QUEUED).update(
+            status=Task.RUNNING, started=timezone.now())
+        if claimed:
+            return Task.objects.get(id=task_id)
+
+
+def run_task(task):
+    '''Calls the function of the task and stores what it returned. A File
+    is saved as the output of the task, anything else is stored as JSON.'''
+    try:
+        function = import_by_path(task.function)
+        args, kwargs = task.get_arguments()
+        value = function(*args, **kwargs)
+        if isinstance(value, File):
+            task.output.save(value.name, value, save=False)
+            value.close()
+        else:
+            task.result = json.dumps(value, cls=DjangoJSONEncoder)
+        task.status = Task.DONE
+    except Exception as e:
+        logger.warn("Task error: %s - %s" % (task.function, e))
+        task.error = str(e)
+        task.status = Task.FAILED
+    task.finished = timezone.now()
+    task.save()
+    return task
+
+
+def run_tasks(limit=None):
+    '''Runs queued tasks until there are none left, or until limit tasks
+    have been run, and returns how many were run.'''
+    count = 0
+    while limit is None or count < limit:
+        task = claim_next_task()
+        if task is None:
+            break
+        run_task(task)
+        count += 1
+    return count
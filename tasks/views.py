@@ -0,0 +1,13 @@
+import json
+
+from django.shortcuts import get_object_or_404
+from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+
+from models import Task
+
+
+def task_status(request, token):
+    task = get_object_or_404(Task, token=token)
+    return HttpResponse(json.dumps(task.get_json(), cls=DjangoJSONEncoder),
+                        content_type="application/json")